@@ -1,18 +1,59 @@
+import argparse
 import logging
 from rtmp import *
+import workers
 
 # Config
 LogLevel = logging.INFO
+StreamPath = '/live/stream'
 
 # Configure logging level and format
 logging.basicConfig(level=LogLevel, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-def process_video(client_state,payload):
-    # print("video...")#payload)
-    print(client_state)
+logger = logging.getLogger('App')
 
-def process_audio(payload):
-    print("audio...")#payload)
+async def process_video(server):
+    async for frame in server.subscribe(StreamPath, kinds=('video',)):
+        logger.debug("video %r", frame)
 
-rtmp_server = RTMPServer(video=process_video,audio=process_audio)
-asyncio.run(rtmp_server.start_server())
+async def process_audio(server):
+    async for frame in server.subscribe(StreamPath, kinds=('audio',)):
+        logger.debug("audio %r", frame)
+
+async def main(server):
+    consumers = [asyncio.ensure_future(process_video(server)), asyncio.ensure_future(process_audio(server))]
+    try:
+        await server.start_server()
+    finally:
+        for consumer in consumers:
+            consumer.cancel()
+        await asyncio.gather(*consumers, return_exceptions=True)
+
+parser = argparse.ArgumentParser(description='RTMP ingest server')
+parser.add_argument('--workers', type=int, default=1, help='number of processes sharing the port (SO_REUSEPORT)')
+parser.add_argument('--handoff', metavar='PATH', help='Unix socket for zero-downtime restarts: take the port over from the server on PATH, then serve the next takeover there')
+parser.add_argument('--drain-timeout', type=float, default=DRAIN_TIMEOUT, help='seconds a replaced server waits for its connections to finish')
+parser.add_argument('--port', type=int, default=1935, help='RTMP port to listen on')
+parser.add_argument('--unix', metavar='PATH', help='also accept RTMP connections on this Unix domain socket')
+parser.add_argument('--origin', metavar='HOST:PORT', help='run as an edge: pull streams nobody publishes here from this origin server')
+parser.add_argument('--push', metavar='HOST:PORT', action='append', default=[], help='restream every published stream to this server, may be given several times')
+args = parser.parse_args()
+
+def address(option, value):
+    host, _, port = value.rpartition(':')
+    if not host or not port.isdigit():
+        parser.error(f'{option} must be HOST:PORT')
+    return (host, int(port))
+
+origin = address('--origin', args.origin) if args.origin else None
+push = [address('--push', value) for value in args.push]
+
+if args.workers > 1:
+    if args.handoff:
+        parser.error('--handoff needs a single worker')
+    if args.unix:
+        parser.error('--unix needs a single worker')
+    workers.serve(args.workers, main=main, port=args.port, origin=origin, push=push)
+else:
+    rtmp_server = RTMPServer(port=args.port, handoff_path=args.handoff, drain_timeout=args.drain_timeout, origin=origin, unix_path=args.unix, push=push)
+    asyncio.run(main(rtmp_server))
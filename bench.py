@@ -0,0 +1,605 @@
+''' Benchmarks for the RTMP server.
+
+    python bench.py ingest --messages 2000 --size 16384 --chunk-size 128
+    python bench.py fanout --messages 300 --size 65536
+    python bench.py idle --connections 10000
+    python bench.py handshake --connections 5000 --concurrency 500
+    python bench.py soak --seconds 600
+    python bench.py transport --messages 5000 --size 16384
+    python bench.py restream --messages 1500 --size 16384
+    python bench.py restream --check
+'''
+import argparse
+import asyncio
+import collections
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import struct
+import sys
+import tempfile
+import time
+import amf
+import bufferpool
+import chunk
+import common
+import handshake
+import loopback
+import rtmp
+import streams
+
+def build_stream(messages, size, chunk_size, channel=rtmp.RTMP_CHANNEL_VIDEO):
+    # Chunk `messages` AVC inter frames of `size` bytes the way an encoder would
+    payload = b'\x27\x01' + bytes(size - 2)
+    out = bytearray()
+    for i in range(messages):
+        hdr = common.Header(channel, i * 33, size, rtmp.RTMP_TYPE_VIDEO, 1)
+        control = common.Header.FULL
+        for offset in range(0, size, chunk_size):
+            out += hdr.toBytes(control)
+            out += payload[offset:offset + chunk_size]
+            control = common.Header.SEPARATOR
+    chunks = messages * -(-size // chunk_size)
+    return bytes(out), chunks
+
+class NullWriter(object):
+    ''' StreamWriter stand-in that throws away everything written to it.'''
+
+    def __init__(self):
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+
+    def writelines(self, data):
+        self.writes += 1
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+    def is_closing(self):
+        return False
+
+async def run_ingest(ingest, data, chunk_size):
+    server = rtmp.RTMPServer(ingest=ingest)
+    client_state = rtmp.ClientState()
+    client_state.chunk_size = client_state.demuxer.chunk_size = chunk_size
+    client_state.reader = asyncio.StreamReader(limit=len(data) + 1)
+    client_state.writer = NullWriter()
+    client_state.reader.feed_data(data)
+    client_state.reader.feed_eof()
+    server.client_states[client_state.id] = client_state
+    get_chunk_data = server.get_buffered_chunk_data if ingest == 'buffered' else server.get_chunk_data
+
+    start = time.perf_counter()
+    try:
+        while True:
+            await get_chunk_data(client_state.id)
+    except rtmp.DisconnectClientException:
+        pass
+    return time.perf_counter() - start
+
+def bench_ingest(args):
+    data, chunks = build_stream(args.messages, args.size, args.chunk_size)
+    print(f"ingest: {args.messages} messages x {args.size} bytes, chunk size {args.chunk_size}, {chunks} chunks, {len(data)} bytes")
+    results = {}
+    for ingest in ('stream', 'buffered'):
+        elapsed = min(asyncio.run(run_ingest(ingest, data, args.chunk_size)) for _ in range(args.repeat))
+        results[ingest] = chunks / elapsed
+        print(f"  {ingest:>8}: {chunks / elapsed:12.0f} chunks/s {len(data) / elapsed / 1e6:8.1f} MB/s")
+    print(f"  speedup: {results['buffered'] / results['stream']:.1f}x")
+
+def add_client(server, app='live'):
+    client_state = rtmp.ClientState()
+    client_state.app = app
+    client_state.writer = NullWriter()
+    server.client_states[client_state.id] = client_state
+    return client_state
+
+def run_fanout(viewers, messages, payload, encode_once):
+    server = rtmp.RTMPServer()
+    publisher = add_client(server)
+    stream = streams.LiveStream(publisher.id, 'live', 'stream', 'live', 1)
+    server.registry.publish(stream)
+    for _ in range(viewers):
+        player = add_client(server)
+        player.playStreamId = 1
+        player.sendQueue = streams.SendQueue(player.writer, max_messages=messages + 1, max_bytes=1 << 62)
+        server.registry.addPlayer(player.id, stream)
+
+    start = time.perf_counter()
+    for i in range(messages):
+        if encode_once:
+            server.relayToPlayers(stream, rtmp.RTMP_TYPE_VIDEO, i * 33, payload)
+        else:
+            for player_id in stream.subscribers:
+                player = server.client_states[player_id]
+                player.writer.writelines(chunk.encodeMessage(rtmp.RTMP_CHANNEL_VIDEO, i * 33, rtmp.RTMP_TYPE_VIDEO, 1, payload, player.out_chunk_size))
+    return time.perf_counter() - start
+
+def bench_fanout(args):
+    payload = b'\x27\x01' + bytes(args.size - 2)
+    print(f"fanout: {args.messages} video messages x {args.size} bytes")
+    print(f"  {'viewers':>7} {'per-viewer us/msg':>18} {'encode-once us/msg':>19}")
+    for viewers in args.viewers:
+        naive = min(run_fanout(viewers, args.messages, payload, False) for _ in range(args.repeat))
+        once = min(run_fanout(viewers, args.messages, payload, True) for _ in range(args.repeat))
+        print(f"  {viewers:>7} {naive / args.messages * 1e6:18.1f} {once / args.messages * 1e6:19.1f}")
+
+def rss(pid):
+    # Resident set size of a process in bytes (Linux)
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def run_server(port):
+    logging.getLogger('RTMPServer').disabled = True
+    server = rtmp.RTMPServer(host='127.0.0.1', port=port)
+    asyncio.run(server.start_server())
+
+def start_server_process(connections):
+    # Server in its own process, so neither its CPU nor its memory mixes with the clients'.
+    # Both sides hold one fd per connection.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if connections + 64 > hard:
+        raise SystemExit(f"need {connections + 64} file descriptors, the limit is {hard}")
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    server = multiprocessing.get_context('fork').Process(target=run_server, args=(port,), daemon=True)
+    server.start()
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return server, port
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+
+async def client_handshake(port, c0c1):
+    # Connect and handshake as a client, returns (writer, seconds from connect to S2)
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(c0c1)
+    s0s1 = await reader.readexactly(1 + handshake.RTMP_SIG_SIZE)
+    writer.write(s0s1[1:])
+    await reader.readexactly(handshake.RTMP_SIG_SIZE)
+    return writer, time.perf_counter() - start
+
+async def open_idle(port, count, batch):
+    # Handshaken connections that then send nothing, batch at a time to stay within the listen backlog
+    writers = []
+    for offset in range(0, count, batch):
+        done = await asyncio.gather(*(client_handshake(port, handshake.generateC0C1()) for _ in range(min(batch, count - offset))))
+        writers += [writer for writer, elapsed in done]
+    return writers
+
+def bench_idle(args):
+    server, port = start_server_process(args.connections)
+
+    async def measure():
+        await asyncio.sleep(0.5)
+        before = rss(server.pid)
+        start = time.perf_counter()
+        writers = await open_idle(port, args.connections, args.batch)
+        elapsed = time.perf_counter() - start
+        await asyncio.sleep(1)
+        after = rss(server.pid)
+        for writer in writers:
+            writer.close()
+        return before, after, elapsed
+
+    try:
+        before, after, elapsed = asyncio.run(measure())
+    finally:
+        server.terminate()
+        server.join()
+    print(f"idle: {args.connections} handshaken connections in {elapsed:.1f} s")
+    print(f"  server RSS before: {before / 1e6:8.1f} MB")
+    print(f"  server RSS after:  {after / 1e6:8.1f} MB")
+    print(f"  per connection:    {(after - before) / args.connections / 1024:8.1f} KiB")
+
+def bench_handshake(args):
+    # Server side cost of one handshake, then a storm of concurrent connects against a server process
+    print("handshake: server CPU per handshake")
+    for name, messageFormat in (('simple', handshake.MESSAGE_FORMAT_0), ('digest', handshake.MESSAGE_FORMAT_1)):
+        c1 = handshake.generateC0C1(messageFormat)[1:]
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            handshake.generateS0S1S2(c1)
+        print(f"  {name:>8}: {(time.perf_counter() - start) / args.repeat * 1e6:8.1f} us")
+
+    server, port = start_server_process(args.connections)
+    messageFormat = handshake.MESSAGE_FORMAT_1 if args.digest else handshake.MESSAGE_FORMAT_0
+    c0c1s = [handshake.generateC0C1(messageFormat) for _ in range(args.connections)]
+
+    async def storm():
+        limit = asyncio.Semaphore(args.concurrency)
+        async def one(c0c1):
+            async with limit:
+                return await client_handshake(port, c0c1)
+        start = time.perf_counter()
+        done = await asyncio.gather(*(one(c0c1) for c0c1 in c0c1s))
+        elapsed = time.perf_counter() - start
+        for writer, latency in done:
+            writer.close()
+        return elapsed, sorted(latency for writer, latency in done)
+
+    try:
+        elapsed, latencies = asyncio.run(storm())
+    finally:
+        server.terminate()
+        server.join()
+    print(f"  storm: {args.connections} {'digest' if args.digest else 'simple'} handshakes, {args.concurrency} at a time")
+    print(f"  {len(latencies) / elapsed:8.0f} handshakes/s")
+    print(f"  p50 {latencies[len(latencies) // 2] * 1e3:8.1f} ms, p99 {latencies[int(len(latencies) * 0.99)] * 1e3:8.1f} ms, max {latencies[-1] * 1e3:8.1f} ms")
+
+SOAK_KEYFRAME = b'\x17\x01' + bytes(1024 * 1024)
+SOAK_INTER = b'\x27\x01' + bytes(1024 * 1024)
+
+def soak_second(second, fps, rng, chunk_size):
+    # One second of a screen share: 30 fps video with a large keyframe every 2 s, sizes varying frame to frame
+    buffers = []
+    for frame in range(fps):
+        timestamp = (second * fps + frame) * 1000 // fps
+        if (second * fps + frame) % (2 * fps) == 0:
+            payload = memoryview(SOAK_KEYFRAME)[:rng.randint(200000, 600000)]
+        else:
+            payload = memoryview(SOAK_INTER)[:rng.randint(5000, 80000)]
+        buffers += chunk.encodeMessage(rtmp.RTMP_CHANNEL_VIDEO, timestamp, rtmp.RTMP_TYPE_VIDEO, 1, payload, chunk_size)
+        buffers += chunk.encodeMessage(rtmp.RTMP_CHANNEL_AUDIO, timestamp, rtmp.RTMP_TYPE_AUDIO, 1, b'\xaf\x01' + bytes(370), chunk_size)
+    return b''.join(buffers)
+
+def run_soak(seconds, fps, pool_bytes, chunk_size):
+    # Runs in a fresh process so the RSS figures belong to this ingest alone
+    async def ingest():
+        server = rtmp.RTMPServer(buffer_pool_bytes=pool_bytes)
+        publisher = add_client(server)
+        publisher.chunk_size = publisher.demuxer.chunk_size = chunk_size
+        publisher.demuxer.pool = server.bufferPool
+        server.registry.publish(streams.LiveStream(publisher.id, 'live', 'stream', 'live', 1, memory=server.memory))
+        # An analysis consumer that keeps a window of recent frames whose length wanders between 1 and 90
+        subscription = server.subscribe('/live/stream', kinds=('video',), max_frames=1 << 20)
+        window = collections.deque()
+        rng = random.Random(1)
+        pooled = faults = 0
+        elapsed = 0
+
+        rss_warm = 0
+        for second in range(seconds):
+            data = soak_second(second, fps, rng, chunk_size)
+            # only the ingest is timed and counted, not making up the data
+            start, started_faults = time.perf_counter(), resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+            for offset in range(0, len(data), rtmp.READ_AHEAD_SIZE):
+                for rtmp_packet in publisher.demuxer.feed(data[offset:offset + rtmp.READ_AHEAD_SIZE]):
+                    pooled += bufferpool.POOL_MIN_SIZE <= rtmp_packet.length <= bufferpool.POOL_MAX_SIZE
+                    await server.handle_rtmp_packet(publisher.id, rtmp_packet)
+                while subscription.frames:
+                    window.append(await subscription.__anext__())
+                keep = rng.randint(1, 90)
+                while len(window) > keep:
+                    window.popleft()
+            elapsed += time.perf_counter() - start
+            faults += resource.getrusage(resource.RUSAGE_SELF).ru_minflt - started_faults
+            del data
+            if second % 10 == 9 and server.bufferPool is not None:
+                server.bufferPool.sweep()
+            if second == min(seconds - 1, 10):
+                rss_warm = rss('self')
+        allocations = server.bufferPool.allocated if server.bufferPool is not None else pooled
+        return {'elapsed': elapsed, 'messages': pooled, 'allocations': allocations, 'faults': faults, 'rss_warm': rss_warm,
+                'rss_end': rss('self'), 'rss_peak': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+    logging.getLogger('RTMPServer').disabled = True
+    return asyncio.run(ingest())
+
+def bench_soak(args):
+    print(f"soak: {args.seconds} s of {args.fps} fps video with a 200-600 kB keyframe every 2 s, ingested as fast as possible")
+    print(f"  {'':>8} {'large msgs':>10} {'allocations':>11} {'page faults':>11} {'RSS@10s MB':>10} {'RSS end MB':>10} {'peak MB':>8} {'time s':>7}")
+    context = multiprocessing.get_context('fork')
+    for name, pool_bytes in (('no pool', 0), ('pool', args.pool_bytes)):
+        with context.Pool(1) as worker:
+            result = worker.apply(run_soak, (args.seconds, args.fps, pool_bytes, args.chunk_size))
+        print(f"  {name:>8} {result['messages']:>10} {result['allocations']:>11} {result['faults']:>11} {result['rss_warm'] / 1e6:10.1f} "
+              f"{result['rss_end'] / 1e6:10.1f} {result['rss_peak'] / 1e6:8.1f} {result['elapsed']:7.1f}")
+
+def publish_session(messages, size, chunk_size, gop=0):
+    # Everything a publisher sends, back to back: handshake, set chunk size, connect, publish, then video
+    # frames, a keyframe every `gop` frames if gop is set
+    out = bytearray(handshake.generateC0C1())
+    out += bytes(handshake.RTMP_SIG_SIZE)  # C2, the server does not look at it
+    for buffer in chunk.encodeMessage(2, 0, common.Message.CHUNK_SIZE, 0, struct.pack('>I', chunk_size), 128):
+        out += buffer
+    commands = (
+        (0, common.Command(name='connect', id=1, cmdData=amf.Object(app='live', tcUrl='rtmp://localhost/live'))),
+        (1, common.Command(name='publish', id=0, args=['stream', 'live'])))
+    for stream_id, command in commands:
+        for buffer in chunk.encodeMessage(3, 0, common.Message.RPC, stream_id, command.toMessage().data, chunk_size):
+            out += buffer
+    out += video_frames(0, messages, size, chunk_size, gop)
+    return bytes(out)
+
+def video_frames(first, count, size, chunk_size, gop=0):
+    # Video frames first .. first + count - 1 of a publish session, 33 ms apart on message stream 1
+    out = bytearray()
+    inter = b'\x27\x01' + bytes(size - 2)
+    keyframe = b'\x17\x01' + bytes(size - 2)
+    for i in range(first, first + count):
+        payload = keyframe if gop and i % gop == 0 else inter
+        for buffer in chunk.encodeMessage(rtmp.RTMP_CHANNEL_VIDEO, i * 33, rtmp.RTMP_TYPE_VIDEO, 1, payload, chunk_size):
+            out += buffer
+    return bytes(out)
+
+async def run_transport(transport, data, messages):
+    # Seconds from the first byte written until the server handed the last frame to its video callback
+    received = 0
+    done = asyncio.Event()
+    def video(client_state, payload):
+        nonlocal received
+        received += 1
+        if received == messages:
+            done.set()
+
+    path = os.path.join(tempfile.gettempdir(), f'rtmp-bench-{os.getpid()}.sock')
+    server = rtmp.RTMPServer(host='127.0.0.1', port=0, video=video, unix_path=path if transport == 'unix' else None)
+    serving = None
+    if transport != 'loopback':
+        serving = asyncio.ensure_future(server.start_server())
+        while server.server is None or (transport == 'unix' and server.unixServer is None):
+            await asyncio.sleep(0.01)
+
+    start = time.perf_counter()
+    if transport == 'tcp':
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.server.sockets[0].getsockname()[1])
+    elif transport == 'unix':
+        reader, writer = await asyncio.open_unix_connection(path)
+    else:
+        reader, writer = await loopback.connect(server, sink=True)
+    writer.write(data)
+    await writer.drain()
+    await done.wait()
+    elapsed = time.perf_counter() - start
+
+    writer.close()
+    while server.client_states:
+        await asyncio.sleep(0.01)
+    if serving is not None:
+        server.stopped.set()
+        await serving
+    return elapsed
+
+def bench_transport(args):
+    data = publish_session(args.messages, args.size, args.chunk_size)
+    print(f"transport: publish {args.messages} video messages x {args.size} bytes, chunk size {args.chunk_size}, {len(data) / 1e6:.1f} MB")
+    print(f"  {'':>8} {'MB/s':>8} {'msgs/s':>8}")
+    for transport in ('tcp', 'unix', 'loopback'):
+        elapsed = min(asyncio.run(run_transport(transport, data, args.messages)) for _ in range(args.repeat))
+        print(f"  {transport:>8} {len(data) / elapsed / 1e6:8.1f} {args.messages / elapsed:8.0f}")
+
+# Seconds the restream check waits for pushes to attach and frames to arrive
+RESTREAM_TIMEOUT = 30
+
+async def start_destination(video, port=0, rate=None):
+    # A local push destination handing its video messages to video(), reading at most rate bytes/s if set
+    server = rtmp.RTMPServer(host='127.0.0.1', port=port, video=video, ingest_limits={'live': rate} if rate else None)
+    serving = asyncio.ensure_future(server.start_server())
+    while server.server is None:
+        await asyncio.sleep(0.01)
+    return server, serving
+
+async def stop_destination(server, serving, kill=False):
+    # Stop a destination once its connections are gone, or closing them if kill is set
+    if kill:
+        for client_state in list(server.client_states.values()):
+            client_state.writer.close()
+    while server.client_states:
+        await asyncio.sleep(0.01)
+    server.stopped.set()
+    await serving
+
+async def wait_until(condition, timeout=RESTREAM_TIMEOUT):
+    # False if condition() did not become true within timeout seconds
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+def pushes(source, path='/live/stream'):
+    # Push connections attached to the source's stream
+    stream = source.registry.get(path)
+    return len(stream.subscribers) if stream is not None else 0
+
+async def run_restream(rates, messages, size, chunk_size, gop, publish_rate):
+    # Publish at publish_rate bytes/s to a server pushing to one destination server per entry of rates (ingest
+    # bytes/s limit or None), all in this process. Returns per destination (frames received, seconds until the
+    # last one, frames dropped)
+    received = [0] * len(rates)
+    finished = [None] * len(rates)
+    start = None
+    def counter(index):
+        def video(client_state, payload):
+            received[index] += 1
+            finished[index] = time.perf_counter() - start
+        return video
+
+    destinations = [await start_destination(counter(index), rate=rate) for index, rate in enumerate(rates)]
+    ports = [server.server.sockets[0].getsockname()[1] for server, serving in destinations]
+    source = rtmp.RTMPServer(push=[('127.0.0.1', port) for port in ports])
+
+    session = publish_session(messages, size, chunk_size, gop)
+    setup = len(publish_session(0, size, chunk_size))
+    reader, writer = await loopback.connect(source, sink=True)
+    writer.write(session[:setup])
+    # media only once every destination is attached, so each of them can get every frame
+    await wait_until(lambda: pushes(source) == len(rates))
+    stream = source.registry.get('/live/stream')
+    queues = {source.client_states[client_id].client_ip[1]: source.client_states[client_id].sendQueue for client_id in stream.subscribers}
+
+    start = time.perf_counter()
+    sent = setup
+    while sent < len(session):
+        due = setup + int((time.perf_counter() - start) * publish_rate)
+        if due > sent:
+            writer.write(session[sent:due])
+            sent = due
+        await asyncio.sleep(0.01)
+    # done once every push queue is empty and nothing arrived for a moment
+    while True:
+        before = list(received)
+        await asyncio.sleep(0.2)
+        if received == before and all(queue.backlog == 0 for queue in queues.values()):
+            break
+    dropped = [queues[port].droppedFrames for port in ports]
+
+    writer.close()
+    await wait_until(lambda: not source.client_states)
+    for server, serving in destinations:
+        await stop_destination(server, serving)
+    return list(zip(received, finished, dropped))
+
+async def check_restream(messages, size, chunk_size, gop):
+    # Push one stream to two destinations, kill the second halfway and start it again on its port. With the
+    # publisher held back by the source's backpressure nothing may be dropped: the first destination must get
+    # every frame, the second every frame before the kill, and after its restart the cached GOP it is primed
+    # with plus every frame from then on. Returns what went wrong, empty if nothing did.
+    received = [0, 0, 0]    # first destination, second, second after its restart
+    def counter(index):
+        def video(client_state, payload):
+            received[index] += 1
+        return video
+
+    first = await start_destination(counter(0))
+    second = await start_destination(counter(1))
+    ports = [server.server.sockets[0].getsockname()[1] for server, serving in (first, second)]
+    source = rtmp.RTMPServer(push=[('127.0.0.1', port) for port in ports], push_retry_delay=0.1,
+                             pause_bytes=streams.SEND_QUEUE_BYTES // 4)
+    reader, writer = await loopback.connect(source, sink=True)
+    failures = []
+    try:
+        writer.write(publish_session(0, size, chunk_size))
+        if not await wait_until(lambda: pushes(source) == 2):
+            return ["the pushes did not attach"]
+
+        half = messages // 2
+        writer.write(video_frames(0, half, size, chunk_size, gop))
+        await writer.drain()
+        if not await wait_until(lambda: received[:2] == [half, half]):
+            failures.append(f"before the kill the destinations got {received[0]} and {received[1]} of {half} frames")
+
+        await stop_destination(*second, kill=True)
+        if not await wait_until(lambda: pushes(source) == 1):
+            return failures + ["the push to the killed destination was not detached"]
+        second = await start_destination(counter(2), port=ports[1])
+        if not await wait_until(lambda: pushes(source) == 2):
+            return failures + ["the push did not reconnect to the restarted destination"]
+        primed = len(source.registry.get('/live/stream').gop.messages)
+
+        writer.write(video_frames(half, messages - half, size, chunk_size, gop))
+        await writer.drain()
+        expected = primed + messages - half
+        if not await wait_until(lambda: received[0] == messages and received[2] == expected):
+            failures.append(f"the first destination got {received[0]} of {messages} frames, "
+                            f"the restarted one {received[2]} of {expected}")
+        return failures
+    finally:
+        writer.close()
+        await wait_until(lambda: not source.client_states)
+        for server, serving in (first, second):
+            await stop_destination(server, serving, kill=True)
+
+def bench_restream(args):
+    failures = asyncio.run(check_restream(args.messages, args.size, args.chunk_size, args.gop))
+    if failures:
+        sys.exit("restream check failed: " + "; ".join(failures))
+    print(f"restream check: {args.messages} frames pushed to two servers, one killed and restarted halfway, none missed")
+    if args.check:
+        return
+
+    print(f"restream: publish {args.messages} video messages x {args.size} bytes at {args.publish_rate / 1e6:g} MB/s, "
+          f"a keyframe every {args.gop}, pushed to local servers")
+    print(f"  {'destinations':<28} {'received':>17} {'last frame s':>15} {'dropped':>15}")
+    runs = (
+        ('1', [None]),
+        ('2', [None, None]),
+        (f'2, one reading {args.slow_rate / 1e6:g} MB/s', [None, args.slow_rate]),
+    )
+    for name, rates in runs:
+        results = asyncio.run(run_restream(rates, args.messages, args.size, args.chunk_size, args.gop, args.publish_rate))
+        print(f"  {name:<28} {' / '.join(str(r[0]) for r in results):>17} {' / '.join(f'{r[1]:.2f}' for r in results):>15} "
+              f"{' / '.join(str(r[2]) for r in results):>15}")
+
+def main():
+    parser = argparse.ArgumentParser(description='RTMP server benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    ingest = commands.add_parser('ingest', help='chunk demuxing throughput, stream vs buffered ingest')
+    ingest.add_argument('--messages', type=int, default=2000)
+    ingest.add_argument('--size', type=int, default=16384)
+    ingest.add_argument('--chunk-size', type=int, default=128)
+    ingest.add_argument('--repeat', type=int, default=3)
+    ingest.set_defaults(func=bench_ingest)
+
+    fanout = commands.add_parser('fanout', help='relaying one stream to many players, chunking per viewer vs once')
+    fanout.add_argument('--messages', type=int, default=300)
+    fanout.add_argument('--size', type=int, default=65536)
+    fanout.add_argument('--viewers', type=int, nargs='+', default=[1, 10, 50, 100, 200])
+    fanout.add_argument('--repeat', type=int, default=3)
+    fanout.set_defaults(func=bench_fanout)
+
+    idle = commands.add_parser('idle', help='server memory (RSS) per idle handshaken connection')
+    idle.add_argument('--connections', type=int, default=10000)
+    idle.add_argument('--batch', type=int, default=100)
+    idle.set_defaults(func=bench_idle)
+
+    storm = commands.add_parser('handshake', help='handshake CPU cost, handshakes/s and latency under a connect storm')
+    storm.add_argument('--connections', type=int, default=5000)
+    storm.add_argument('--concurrency', type=int, default=500)
+    storm.add_argument('--simple', dest='digest', action='store_false', help='plain C1 instead of a Flash Player digest C1')
+    storm.add_argument('--repeat', type=int, default=1000)
+    storm.set_defaults(func=bench_handshake)
+
+    soak = commands.add_parser('soak', help='long 30 fps ingest, reassembly buffer allocations and RSS with and without the buffer pool')
+    soak.add_argument('--seconds', type=int, default=600)
+    soak.add_argument('--fps', type=int, default=30)
+    soak.add_argument('--chunk-size', type=int, default=4096)
+    soak.add_argument('--pool-bytes', type=int, default=bufferpool.POOL_IDLE_BYTES)
+    soak.set_defaults(func=bench_soak)
+
+    transport = commands.add_parser('transport', help='publish throughput over TCP, a Unix socket and the in-process loopback')
+    transport.add_argument('--messages', type=int, default=5000)
+    transport.add_argument('--size', type=int, default=16384)
+    transport.add_argument('--chunk-size', type=int, default=4096)
+    transport.add_argument('--repeat', type=int, default=3)
+    transport.set_defaults(func=bench_transport)
+
+    restream = commands.add_parser('restream', help='pushing one published stream to several servers, with a slow one')
+    restream.add_argument('--messages', type=int, default=1500)
+    restream.add_argument('--size', type=int, default=16384)
+    restream.add_argument('--chunk-size', type=int, default=4096)
+    restream.add_argument('--gop', type=int, default=30)
+    restream.add_argument('--publish-rate', type=float, default=8e6, help='bytes/s the publisher sends')
+    restream.add_argument('--check', action='store_true', help='only check that no destination misses a frame, exit 1 if one does')
+    restream.add_argument('--slow-rate', type=float, default=2e6, help='ingest bytes/s of the slow destination')
+    restream.set_defaults(func=bench_restream)
+
+    args = parser.parse_args()
+    logging.getLogger('RTMPServer').disabled = True
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
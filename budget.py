@@ -0,0 +1,50 @@
+# Default server wide limit of accounted memory, in bytes
+SERVER_MEMORY_LIMIT = 1024 * 1024 * 1024
+
+# Default limit of partially received messages on one connection, in bytes
+CONNECTION_REASSEMBLY_LIMIT = 16 * 1024 * 1024
+
+# What the accounted memory is used for
+REASSEMBLY, GOP_CACHE, SEND_QUEUE = 'reassembly', 'gop_cache', 'send_queue'
+
+class BudgetExceeded(Exception):
+    pass
+
+class MemoryBudget(object):
+    ''' Byte accounting of a server's reassembly buffers, GOP caches and send queues.
+
+    reserve() refuses bytes that would take the total past limit, after giving
+    reclaim(nbytes) a chance to free some (the server empties GOP caches). The
+    caller decides what a refusal means: a GOP cache stays empty until its next
+    keyframe, a send queue skips to the next keyframe, a connection whose
+    message cannot be reassembled is closed. GOP caches and send queues are
+    held to limit - headroom, so stalled players cannot starve ingest of the
+    buffers it needs to keep publishers connected. A limit of 0 only counts.
+    '''
+
+    def __init__(self, limit=SERVER_MEMORY_LIMIT, reclaim=None):
+        self.limit = limit
+        self.headroom = limit // 4      # kept for reassembly only
+        self.reclaim = reclaim
+        self.used = dict.fromkeys((REASSEMBLY, GOP_CACHE, SEND_QUEUE), 0)
+        self.total = 0
+        self.refused = 0
+
+    def reserve(self, category, nbytes, force=False, reclaim=True):
+        limit = self.limit if category == REASSEMBLY else self.limit - self.headroom
+        if self.limit and not force and self.total + nbytes > limit:
+            if reclaim and self.reclaim is not None:
+                self.reclaim(self.total + nbytes - limit)
+            if self.total + nbytes > limit:
+                self.refused += 1
+                return False
+        self.used[category] += nbytes
+        self.total += nbytes
+        return True
+
+    def release(self, category, nbytes):
+        self.used[category] -= nbytes
+        self.total -= nbytes
+
+    def stats(self):
+        return dict(self.used, limit=self.limit, total=self.total, refused=self.refused)
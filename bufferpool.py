@@ -0,0 +1,109 @@
+import sys
+
+# Smallest buffer worth pooling, below this the allocator's own free lists do fine
+POOL_MIN_SIZE = 4096
+
+# Largest pooled buffer, bigger messages get a buffer of their own
+POOL_MAX_SIZE = 16 * 1024 * 1024
+
+# Default bytes of unused buffers a pool keeps for reuse
+POOL_IDLE_BYTES = 64 * 1024 * 1024
+
+# Size classes per doubling: 4 gives classes 4096, 5120, 6144, 7168, 8192, 10240, ...
+CLASS_STEPS = 4
+
+def sizeClass(nbytes):
+    # Smallest class holding nbytes; at most 1/CLASS_STEPS of a buffer goes unused
+    if nbytes <= POOL_MIN_SIZE:
+        return POOL_MIN_SIZE
+    step = 1 << (nbytes.bit_length() - CLASS_STEPS.bit_length())
+    return -(-nbytes // step) * step
+
+class BufferPool(object):
+    ''' Size-classed pool of message reassembly buffers.
+
+    A completed message leaves the demuxer as a memoryview of its buffer and
+    may be kept by callbacks, subscriptions, GOP caches and send queues for a
+    while. Every one of those views holds a reference to the buffer, so a
+    buffer handed out is lent until its reference count says only the pool
+    holds it; acquire() looks for such buffers in the requested class before
+    allocating, and sweep() does so for every class. At most max_idle bytes of
+    free buffers are kept.
+    '''
+
+    def __init__(self, max_idle=POOL_IDLE_BYTES):
+        self.max_idle = max_idle
+        self.free = {}          # size class -> buffers nobody uses
+        self.lent = {}          # size class -> buffers handed out, possibly still referenced
+        self.idle = 0           # bytes in self.free
+        self.allocated = 0      # buffers created
+        self.reused = 0         # acquire() calls served from the pool
+        self.discarded = 0      # buffers let go because max_idle was reached
+
+    def acquire(self, nbytes):
+        ''' A buffer of at least nbytes, or None if nbytes is not pooled.'''
+        if nbytes < POOL_MIN_SIZE or nbytes > POOL_MAX_SIZE:
+            return None
+        size = sizeClass(nbytes)
+        free = self.free.get(size)
+        if not free:
+            self._collect(size)
+            free = self.free.get(size)
+        if free:
+            buffer = free.pop()
+            self.idle -= size
+            self.reused += 1
+        else:
+            buffer = bytearray(size)
+            self.allocated += 1
+        self.lent.setdefault(size, []).append(buffer)
+        return buffer
+
+    def giveBack(self, buffer):
+        # A buffer from acquire() that was never handed to a consumer (abandoned message)
+        size = len(buffer)
+        lent = self.lent.get(size)
+        if lent is None:
+            return
+        for index in range(len(lent) - 1, -1, -1):
+            if lent[index] is buffer:
+                del lent[index]
+                self._keep(size, buffer)
+                return
+
+    def sweep(self):
+        # Let go of lent buffers nobody uses any more in classes that are no longer asked for
+        for size in list(self.lent):
+            self._collect(size)
+            if not self.lent[size]:
+                del self.lent[size]
+
+    def _collect(self, size):
+        # Move the lent buffers of a class no consumer references any more to its free list
+        lent = self.lent.get(size)
+        if not lent:
+            return
+        still = []
+        for buffer in lent:
+            # references: the lent list, this loop and getrefcount's argument
+            if sys.getrefcount(buffer) > 3:
+                still.append(buffer)
+            else:
+                self._keep(size, buffer)
+        self.lent[size] = still
+
+    def _keep(self, size, buffer):
+        if self.idle + size > self.max_idle:
+            self.discarded += 1
+            return
+        self.free.setdefault(size, []).append(buffer)
+        self.idle += size
+
+    def stats(self):
+        return {
+            'allocated': self.allocated,
+            'reused': self.reused,
+            'discarded': self.discarded,
+            'idle_bytes': self.idle,
+            'lent_buffers': sum(len(lent) for lent in self.lent.values()),
+        }
@@ -0,0 +1,357 @@
+import struct
+import budget
+
+# Largest message type id we accept (Aggregate message, 0x16)
+MAX_MESSAGE_TYPE = 22
+
+# Size of the message header for each chunk fmt (0, 1, 2, 3)
+MESSAGE_HEADER_SIZE = (11, 7, 3, 0)
+
+# Chunk streams a peer may open on one connection. Encoders use a handful, the
+# protocol allows 65599, each of which would keep its reassembly state.
+MAX_CHUNK_STREAMS = 64
+
+class ChunkStream(object):
+    ''' Reassembly state of one incoming chunk stream.
+
+    The payload buffer is allocated, or taken from a BufferPool, when a message
+    starts, filled by offset as chunks arrive, and handed off as a memoryview of
+    its first payload_length bytes once complete. The next message gets another
+    buffer.
+
+    timestamp is the absolute 32-bit timestamp of the message, accumulated from
+    the deltas of fmt 1, 2 and 3 headers by stamp().
+    '''
+    __slots__ = ('fmt', 'cid', 'timestamp', 'delta', 'extended', 'payload_length',
+                 'msg_type_id', 'msg_stream_id', 'payload', 'reserved', 'received', 'chunks', 'mark')
+
+    def __init__(self, cid, fmt):
+        self.fmt = fmt
+        self.cid = cid
+        self.timestamp = 0
+        self.delta = 0          # timestamp field of the last fmt 0/1/2 header, fmt 3 messages repeat it
+        self.extended = False   # that field was 0xffffff, chunks carry a 4 byte extended timestamp
+        self.payload_length = 0
+        self.msg_type_id = 0
+        self.msg_stream_id = 0
+        self.payload = None     # buffer of at least payload_length bytes while a message is in flight
+        self.reserved = 0       # bytes of memory budget held for it
+        self.received = 0       # bytes of the current message received so far
+        self.chunks = 0         # chunks written, lets a timer tell a stalled message apart
+        self.mark = 0           # value of chunks when the stall timer last looked
+
+    @property
+    def remaining(self):
+        return self.payload_length - self.received
+
+    def stamp(self, fmt, field=None):
+        ''' Apply the timestamp field of a chunk header to the message timestamp.
+
+        field is the 24-bit timestamp, or the extended timestamp in its place,
+        and None for fmt 3. fmt 0 sets the timestamp, fmt 1 and 2 add a delta,
+        and a fmt 3 chunk starting a new message adds the last field again
+        (after fmt 0 that is its timestamp, as the spec and ffmpeg have it).
+        Timestamps wrap around at 32 bits.
+        '''
+        if fmt == 3:
+            if self.payload is not None:
+                return  # continuation chunk, same message
+            field = self.delta
+        if fmt == 0:
+            self.timestamp = field
+        else:
+            self.timestamp = (self.timestamp + field) & 0xffffffff
+        self.delta = field
+
+    def begin(self, buffer=None):
+        # Start a new message in buffer (allocated if None), dropping any partial one
+        self.payload = buffer if buffer is not None else bytearray(self.payload_length)
+        self.received = 0
+
+    def reset(self):
+        # Abandon the message in flight (abort, timeout)
+        self.payload = None
+        self.received = 0
+
+    def write(self, data):
+        if self.payload is None:
+            self.payload = bytearray(self.payload_length)
+        count = len(data)
+        self.payload[self.received:self.received + count] = data
+        self.received += count
+        self.chunks += 1
+
+    def take(self):
+        # Hand the completed payload off and get ready for the next message
+        payload = memoryview(self.payload)[:self.payload_length] if self.payload is not None else memoryview(bytearray())
+        self.payload = None
+        self.received = 0
+        return payload
+
+def createPacket(cid, fmt):
+    return ChunkStream(cid, fmt)
+
+class RTMPPacket(object):
+    ''' A completed message, as handed to the server's handlers.'''
+    __slots__ = ('fmt', 'cid', 'timestamp', 'length', 'type', 'stream_id', 'payload')
+
+    def __init__(self, fmt, cid, timestamp, length, type, stream_id, payload):
+        self.fmt = fmt
+        self.cid = cid
+        self.timestamp = timestamp
+        self.length = length
+        self.type = type            # message type id
+        self.stream_id = stream_id
+        self.payload = payload
+
+    def __repr__(self):
+        return f"<RTMPPacket type={self.type} cid={self.cid} stream_id={self.stream_id} timestamp={self.timestamp} length={self.length}>"
+
+class ChunkDemuxer(object):
+    ''' Sans-IO RTMP chunk stream parser.
+
+    Raw bytes are handed to feed(), which yields every completed message as the
+    RTMPPacket the server handlers consume. Chunk headers are
+    decoded straight from a memoryview of the received data and payload bytes
+    are copied once, into the preallocated buffer of their chunk stream. Only an
+    incomplete chunk header is ever carried over between two calls.
+    '''
+
+    def __init__(self, chunk_size=128, packets=None, memory=None, max_buffered=0, pool=None):
+        self.chunk_size = chunk_size
+        self.packets = packets if packets is not None else {}
+        self.memory = memory            # budget.MemoryBudget the payload buffers are reserved from
+        self.pool = pool                # bufferpool.BufferPool the payload buffers come from, if any
+        self.max_buffered = max_buffered    # cap of buffered partial messages, 0 for none
+        self.buffered = 0               # bytes allocated for messages in flight
+        self.chunks = 0         # number of chunks parsed so far
+        self._pending = b''     # incomplete chunk header from the previous feed
+        self._packet = None     # chunk stream whose payload is being read
+        self._remaining = 0     # payload bytes left in the current chunk
+
+    def feed(self, data):
+        ''' Consume data and yield completed RTMPPackets.
+
+        The generator is lazy, so a Set Chunk Size message handled by the caller
+        takes effect for the very next chunk in the same buffer.
+        '''
+        if self._pending:
+            data = self._pending + data
+            self._pending = b''
+        view = memoryview(data)
+        pos, end = 0, len(view)
+        try:
+            while pos < end:
+                if self._packet is None:
+                    next_pos = self._parse_header(view, pos, end)
+                    if next_pos < 0:
+                        break
+                    pos = next_pos
+                    if self._packet is None:
+                        continue
+
+                packet = self._packet
+                count = min(self._remaining, end - pos)
+                packet.write(view[pos:pos + count])
+                pos += count
+                self._remaining -= count
+                if self._remaining:
+                    break
+
+                self._packet = None
+                self.chunks += 1
+                if packet.received >= packet.payload_length:
+                    yield RTMPPacket(packet.fmt, packet.cid, packet.timestamp, packet.payload_length,
+                                     packet.msg_type_id, packet.msg_stream_id, self.take(packet))
+        finally:
+            if pos < end:
+                self._pending = bytes(view[pos:])
+            view.release()
+
+    def _parse_header(self, view, pos, end):
+        # Returns the position after the chunk header, or -1 if the header is
+        # not complete yet (feed() then keeps it for the next call).
+        fmt = view[pos] >> 6
+        cid = view[pos] & 0b00111111
+        pos += 1
+        # Chunk Basic Header field may be 1, 2, or 3 bytes, depending on the chunk stream ID.
+        if cid == 0:
+            if end - pos < 1:
+                return -1
+            cid = 64 + view[pos]
+            pos += 1
+        elif cid == 1:
+            if end - pos < 2:
+                return -1
+            cid = 64 + view[pos] + (view[pos + 1] << 8)
+            pos += 2
+
+        packet = self.packets.get(cid)
+        if packet is None:
+            packet = self.open(cid, fmt)
+
+        size = MESSAGE_HEADER_SIZE[fmt]
+        if end - pos < size:
+            return -1
+
+        if fmt <= 2:
+            field = (view[pos] << 16) | (view[pos + 1] << 8) | view[pos + 2]
+            extended = field == 0xffffff
+        else:
+            field, extended = None, packet.extended
+        # Messages with type=3 should never have ext timestamp field according to standard. However that's not always the case in real life:
+        # after a header with an extended timestamp, fmt 3 chunks repeat it
+        if extended:
+            if end - pos < size + 4:
+                return -1
+            if fmt <= 2:
+                field = int.from_bytes(view[pos + size:pos + size + 4], 'big')
+        packet.extended = extended
+
+        if fmt <= 1:
+            # A new message length, any partial message on this chunk stream is abandoned
+            self.drop(packet)
+            packet.payload_length = (view[pos + 3] << 16) | (view[pos + 4] << 8) | view[pos + 5]
+            packet.msg_type_id = view[pos + 6]
+        if fmt == 0:
+            packet.msg_stream_id = int.from_bytes(view[pos + 7:pos + 11], 'little')
+        packet.stamp(fmt, field)
+        pos += size + (4 if extended else 0)
+
+        if packet.msg_type_id > MAX_MESSAGE_TYPE:
+            raise ValueError(f"Invalid Packet Type: {packet.msg_type_id}")
+
+        remaining = packet.remaining
+        if remaining > 0:
+            if packet.payload is None:
+                self.allocate(packet)
+            self._packet = packet
+            self._remaining = min(self.chunk_size, remaining)
+        else:
+            # Zero length message, there is no payload to read. Drop it and move on.
+            self.drop(packet)
+        return pos
+
+    def open(self, cid, fmt):
+        # Start reassembly state for a new chunk stream, up to MAX_CHUNK_STREAMS of them
+        if len(self.packets) >= MAX_CHUNK_STREAMS:
+            raise budget.BudgetExceeded(f"more than {MAX_CHUNK_STREAMS} chunk streams on one connection")
+        packet = self.packets[cid] = createPacket(cid, fmt)
+        return packet
+
+    def allocate(self, packet):
+        # Reserve and allocate the payload buffer of the message starting on packet
+        nbytes = packet.payload_length
+        if self.max_buffered and self.buffered + nbytes > self.max_buffered:
+            raise budget.BudgetExceeded(f"{self.buffered + nbytes} bytes of partial messages on one connection")
+        if self.memory is not None and not self.memory.reserve(budget.REASSEMBLY, nbytes):
+            raise budget.BudgetExceeded("Server memory budget exhausted")
+        self.buffered += nbytes
+        packet.reserved = nbytes
+        packet.begin(self.pool.acquire(nbytes) if self.pool is not None else None)
+
+    def drop(self, packet):
+        # Abandon the message in flight on packet (new header, abort, timeout)
+        if packet.payload is not None:
+            self._release(packet.reserved)
+            if self.pool is not None:
+                # nobody has seen this buffer, it can be reused right away
+                self.pool.giveBack(packet.payload)
+        packet.reserved = 0
+        packet.reset()
+
+    def take(self, packet):
+        # Hand a completed payload off, from here on it is no longer reassembly memory. A pooled
+        # buffer goes back to the pool once the last view of the payload is gone.
+        if packet.payload is not None:
+            self._release(packet.reserved)
+        packet.reserved = 0
+        return packet.take()
+
+    def clear(self):
+        # Connection closed, release every partial message
+        for packet in self.packets.values():
+            self.drop(packet)
+        self.packets.clear()
+
+    def _release(self, nbytes):
+        self.buffered -= nbytes
+        if self.memory is not None:
+            self.memory.release(budget.REASSEMBLY, nbytes)
+
+def basicHeader(fmt, cid):
+    # Chunk Basic Header, 1 byte for cs id 2-63, 2 bytes for 64-319 and 3 bytes up to 65599
+    if cid < 64:
+        return bytes([fmt << 6 | cid])
+    elif cid < 320:
+        return bytes([fmt << 6, cid - 64])
+    return bytes([fmt << 6 | 1, (cid - 64) & 0xff, (cid - 64) >> 8])
+
+def messageHeader(fmt, cid, timestamp, length, type_id, stream_id):
+    # Basic header plus the fmt 0/1/2 message header and extended timestamp if needed
+    data = basicHeader(fmt, cid)
+    extended = timestamp >= 0xffffff
+    data += (0xffffff if extended else timestamp).to_bytes(3, 'big')
+    if fmt <= 1:
+        data += length.to_bytes(3, 'big') + bytes([type_id])
+    if fmt == 0:
+        data += struct.pack('<I', stream_id)
+    if extended:
+        data += struct.pack('>I', timestamp)
+    return data
+
+def chunkMessage(header, separator, payload, chunk_size):
+    ''' Split a message into chunks without copying the payload.
+
+    Returns a list of buffers for writer.writelines(): the first chunk header,
+    then payload slices (memoryviews) interleaved with the fmt 3 separator.
+    '''
+    view = memoryview(payload)
+    out = [header, view[:chunk_size]]
+    for offset in range(chunk_size, len(view), chunk_size):
+        out.append(separator)
+        out.append(view[offset:offset + chunk_size])
+    return out
+
+def encodeMessage(cid, timestamp, type_id, stream_id, payload, chunk_size):
+    ''' Chunk a whole message starting with a fmt 0 header.
+
+    The result does not depend on what was sent before on the chunk stream, so
+    the same buffers can be written to any number of connections.
+    '''
+    header = messageHeader(0, cid, timestamp, len(payload), type_id, stream_id)
+    separator = basicHeader(3, cid)
+    if timestamp >= 0xffffff:
+        separator += header[-4:]
+    return chunkMessage(header, separator, payload, chunk_size)
+
+class OutChunkStream(object):
+    ''' Header state of one outgoing chunk stream.
+
+    Remembers the last message header written so the next message can use the
+    shortest fmt, and keeps the fmt 3 separator byte(s) computed once.
+    '''
+    __slots__ = ('cid', 'separator', 'streamId', 'type', 'size', 'time')
+
+    def __init__(self, cid):
+        self.cid = cid
+        self.separator = basicHeader(3, cid)
+        self.streamId = None
+        self.type = None
+        self.size = None
+        self.time = 0
+
+    def header(self, time, size, type, streamId, full=False):
+        ''' Return (header, separator) for the first chunk of the next message.'''
+        if full or self.streamId != streamId or self.time == 0 or time <= self.time:
+            fmt, timestamp = 0, time
+        elif self.size != size or self.type != type:
+            fmt, timestamp = 1, time - self.time
+        else:
+            fmt, timestamp = 2, time - self.time
+        self.streamId, self.type, self.size, self.time = streamId, type, size, time
+        header = messageHeader(fmt, self.cid, timestamp, size, type, streamId)
+        if timestamp >= 0xffffff:
+            # continuation chunks repeat the extended timestamp
+            return header, self.separator + header[-4:]
+        return header, self.separator
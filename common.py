@@ -67,6 +67,7 @@ class Header(object):
     # Chunk type 2 = TIME
     # Chunk type 3 = SEPARATOR
     FULL, MESSAGE, TIME, SEPARATOR, MASK = 0x00, 0x40, 0x80, 0xC0, 0xC0
+    __slots__ = ('channel', 'time', 'size', 'type', 'streamId', 'hdrdata')
 
     def __init__(self, channel=0, time=0, size=None, type=None, streamId=0):
 
@@ -125,6 +126,7 @@ class Message(object):
     type_name = dict(
         enumerate(
             'unknown chunk-size abort ack user-control win-ack-size set-peer-bw unknown audio video unknown unknown unknown unknown unknown data3 sharedobj3 rpc3 data sharedobj rpc unknown aggregate'.split()))
+    __slots__ = ('header', 'data')
 
     def __init__(self, hdr=None, data=''):
         self.header, self.data = hdr or Header(), data
@@ -167,6 +169,7 @@ class Message(object):
 
 class Command(object):
     ''' Class for command / data messages'''
+    __slots__ = ('type', 'name', 'id', 'time', 'cmdData', 'args')
 
     def __init__(
             self,
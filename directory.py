@@ -0,0 +1,124 @@
+import asyncio
+import json
+import logging
+
+class StreamDirectory(object):
+    ''' Directory of published streams, key -> owner.
+
+    The owner is a small JSON-able dict describing who publishes the stream
+    (worker index, pid, client id). This in-process version is what a single
+    RTMPServer uses; SharedStreamDirectory offers the same calls across worker
+    processes.
+    '''
+
+    def __init__(self):
+        self.entries = {}
+
+    async def claim(self, key, owner):
+        # Register owner as the publisher of key, False if someone else already is
+        current = self.entries.setdefault(key, owner)
+        return current == owner
+
+    async def release(self, key, owner):
+        if self.entries.get(key) == owner:
+            del self.entries[key]
+
+    async def lookup(self, key):
+        return self.entries.get(key)
+
+    async def close(self):
+        pass
+
+class DirectoryServer(object):
+    ''' Serves one StreamDirectory to worker processes over a Unix socket.
+
+    Requests and replies are JSON lines. Everything a worker claimed is
+    released when its connection goes away, so a crashed worker cannot keep a
+    stream name blocked.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.directory = StreamDirectory()
+        self.server = None
+        self.connections = {}       # writer -> handler task of each connected worker
+        self.logger = logging.getLogger('StreamDirectory')
+
+    async def start(self, sock=None):
+        # sock: an already listening Unix socket, e.g. bound before forking the workers
+        if sock is not None:
+            self.server = await asyncio.start_unix_server(self.handle_worker, sock=sock)
+        else:
+            self.server = await asyncio.start_unix_server(self.handle_worker, self.path)
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            for writer in self.connections:
+                writer.close()
+            await asyncio.gather(*self.connections.values(), return_exceptions=True)
+            await self.server.wait_closed()
+
+    async def handle_worker(self, reader, writer):
+        claimed = set()
+        self.connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = json.loads(line)
+                op, key = request['op'], request['key']
+                if op == 'claim':
+                    result = await self.directory.claim(key, request['owner'])
+                    if result:
+                        claimed.add(key)
+                elif op == 'release':
+                    result = await self.directory.release(key, request['owner'])
+                    claimed.discard(key)
+                else:
+                    result = await self.directory.lookup(key)
+                writer.write(json.dumps({'result': result}).encode() + b'\n')
+                await writer.drain()
+        except (ConnectionError, ValueError, KeyError) as e:
+            self.logger.error("Directory connection failed: %s", str(e))
+        finally:
+            for key in claimed:
+                self.directory.entries.pop(key, None)
+            self.connections.pop(writer, None)
+            writer.close()
+
+class SharedStreamDirectory(object):
+    ''' StreamDirectory client talking to a DirectoryServer over its Unix socket.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.reader = None
+        self.writer = None
+        self._lock = asyncio.Lock()
+
+    async def _call(self, **request):
+        async with self._lock:
+            if self.writer is None:
+                self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+            self.writer.write(json.dumps(request).encode() + b'\n')
+            await self.writer.drain()
+            line = await self.reader.readline()
+            if not line:
+                self.writer = None
+                raise ConnectionError('stream directory went away')
+            return json.loads(line)['result']
+
+    async def claim(self, key, owner):
+        return await self._call(op='claim', key=key, owner=owner)
+
+    async def release(self, key, owner):
+        await self._call(op='release', key=key, owner=owner)
+
+    async def lookup(self, key):
+        return await self._call(op='lookup', key=key)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
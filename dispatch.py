@@ -0,0 +1,90 @@
+import asyncio
+import collections
+import concurrent.futures
+import logging
+
+# Default number of messages a stream may have waiting for its callback
+CALLBACK_QUEUE_SIZE = 256
+
+class CallbackDispatcher(object):
+    ''' Runs the video/audio callbacks on an executor instead of the event loop.
+
+    Every stream (publisher) gets a lane: its calls run one after another in
+    arrival order, while lanes of different streams run in parallel on the
+    executor's workers. A lane holds at most max_pending calls; beyond that
+    new calls are dropped and counted, so a slow callback cannot grow memory
+    without bound. If drained is set, it is called with the lane key whenever
+    a call finishes and leaves lowWater payload bytes or fewer on its lane.
+    '''
+
+    def __init__(self, executor, max_pending=CALLBACK_QUEUE_SIZE):
+        if executor == 'thread':
+            executor = concurrent.futures.ThreadPoolExecutor(thread_name_prefix='rtmp-callback')
+        elif executor == 'process':
+            executor = concurrent.futures.ProcessPoolExecutor()
+        self.executor = executor
+        # Arguments cross a process boundary by pickling, so they must not reference live objects
+        self.pickles = isinstance(executor, concurrent.futures.ProcessPoolExecutor)
+        self.max_pending = max_pending
+        self.lanes = {}         # lane key -> deque of (callback, args, nbytes) waiting, present while busy
+        self.dropped = 0
+        self.closed = False     # shut down, nothing runs any more
+        self.lowWater = 0
+        self.drained = None
+        self.logger = logging.getLogger('CallbackDispatcher')
+
+    def submit(self, lane, callback, *args):
+        if self.closed:
+            return
+        pending = self.lanes.get(lane)
+        if pending is None:
+            # Lane idle, start right away
+            self.lanes[lane] = collections.deque()
+            self._run(lane, callback, args)
+        elif len(pending) < self.max_pending:
+            nbytes = sum(len(arg) for arg in args if isinstance(arg, (bytes, bytearray, memoryview)))
+            pending.append((callback, args, nbytes))
+        else:
+            self.dropped += 1
+            self.logger.debug("Callback lane %s is full, dropped a call", lane)
+
+    def _run(self, lane, callback, args):
+        if self.closed:
+            return
+        future = asyncio.get_running_loop().run_in_executor(self.executor, callback, *args)
+        future.add_done_callback(lambda future: self._done(lane, future))
+
+    def _done(self, lane, future):
+        if not future.cancelled() and future.exception() is not None:
+            self.logger.error("Callback failed: %s", str(future.exception()))
+        if self.closed:
+            return  # the executor is gone, the lanes with it
+        pending = self.lanes[lane]
+        if pending:
+            callback, args, nbytes = pending.popleft()
+            self._run(lane, callback, args)
+        else:
+            del self.lanes[lane]
+        if self.drained is not None and self.backlog(lane) <= self.lowWater:
+            self.drained(lane)
+
+    def backlog(self, lane):
+        # Payload bytes waiting on a lane
+        pending = self.lanes.get(lane)
+        return sum(entry[2] for entry in pending) if pending else 0
+
+    def discard(self, lane):
+        # Drop the calls waiting on a lane, the running one finishes; returns the payload bytes dropped
+        pending = self.lanes.get(lane)
+        if not pending:
+            return 0
+        nbytes = self.backlog(lane)
+        self.dropped += len(pending)
+        pending.clear()
+        return nbytes
+
+    def shutdown(self):
+        # Calls still queued are dropped; done callbacks of the running ones find the dispatcher closed
+        self.closed = True
+        self.lanes.clear()
+        self.executor.shutdown(wait=False, cancel_futures=True)
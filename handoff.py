@@ -0,0 +1,61 @@
+import asyncio
+import os
+import socket
+
+# Most listening sockets handed over at once
+MAX_SOCKETS = 8
+
+# Leads the message the listening sockets come with, the rest is the old server's drain socket path
+MAGIC = b'RTMP'
+
+def takeover(path, timeout=5):
+    ''' Ask the server serving handoffs on path for its listening sockets.
+
+    Returns (connection, sockets, drain_path), or None if no server is there.
+    drain_path is the Unix socket the old server keeps serving its streams on
+    while it drains, or None. The caller starts accepting on the sockets, then
+    sends b'ready' on the connection so the old server knows it can stop
+    accepting. This blocks, run it in an executor from a running loop.
+    '''
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(timeout)
+    try:
+        conn.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        conn.close()
+        return None
+    message, fds, flags, address = socket.recv_fds(conn, 1024, MAX_SOCKETS)
+    if not fds:
+        conn.close()
+        return None
+    drain_path = os.fsdecode(message[len(MAGIC):]) if message.startswith(MAGIC) else ''
+    return conn, [socket.socket(fileno=fd) for fd in fds], drain_path or None
+
+async def serve(path, sockets, drain_path=None):
+    ''' Wait for the next process to call takeover(path) and pass it our listening sockets.
+
+    drain_path tells the new process where to find the streams still
+    published here. Returns True once the new process reports it is
+    accepting, False if it went away before that (we then keep serving and
+    can be asked again).
+    '''
+    loop = asyncio.get_running_loop()
+    if os.path.exists(path):
+        os.unlink(path)  # left over by a process that did not hand over
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen()
+    listener.setblocking(False)
+    try:
+        conn, address = await loop.sock_accept(listener)
+    finally:
+        # Free the path before the new process, which binds it next, gets the sockets
+        listener.close()
+        os.unlink(path)
+    with conn:
+        try:
+            socket.send_fds(conn, [MAGIC + os.fsencode(drain_path or '')], [sock.fileno() for sock in sockets])
+            conn.setblocking(False)
+            return await loop.sock_recv(conn, 16) == b'ready'
+        except OSError:
+            return False
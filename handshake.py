@@ -1,7 +1,7 @@
 
-import random
 import hashlib
 import hmac
+import os
 
 MESSAGE_FORMAT_0 = 0
 MESSAGE_FORMAT_1 = 1
@@ -24,9 +24,25 @@ GenuineFPConst = 'Genuine Adobe Flash Player 001'
 GenuineFPConstCrud = bytes(GenuineFPConst, 'utf8') + RandomCrud
 
 
+# HMAC-SHA256 objects keyed once with the constants, each use works on a copy
+FPKey = hmac.new(bytes(GenuineFPConst, 'utf8'), digestmod=hashlib.sha256)
+FMSKey = hmac.new(bytes(GenuineFMSConst, 'utf8'), digestmod=hashlib.sha256)
+FMSCrudKey = hmac.new(GenuineFMSConstCrud, digestmod=hashlib.sha256)
+
 def calcHmac(data, key):
     return hmac.new(key, data, hashlib.sha256).digest()
 
+def keyedHmac(keyed, *parts):
+    # HMAC of the parts one after another with a pre-keyed object, without joining them
+    h = keyed.copy()
+    for part in parts:
+        h.update(part)
+    return h.digest()
+
+def digestAt(keyed, sig, offset):
+    # HMAC of a 1536 byte signature leaving out the 32 byte digest at offset
+    return keyedHmac(keyed, sig[:offset], sig[offset + SHA256DL:])
+
 def GetClientGenuineConstDigestOffset(buf):
     offset = buf[0] + buf[1] + buf[2] + buf[3]
     offset = (offset % 728) + 12
@@ -38,44 +54,38 @@ def GetServerGenuineConstDigestOffset(buf):
     return offset
 
 def detectClientMessageFormat(clientsig):
-    sdl = GetServerGenuineConstDigestOffset(clientsig[772:776])
-    msg = clientsig[:sdl] + clientsig[sdl + SHA256DL:]
-    computedSignature = calcHmac(msg, bytes(GenuineFPConst, 'utf8'))
-    providedSignature = clientsig[sdl:sdl + SHA256DL]
-    if computedSignature == providedSignature:
+    sig = memoryview(clientsig)
+    sdl = GetServerGenuineConstDigestOffset(sig[772:776])
+    if digestAt(FPKey, sig, sdl) == sig[sdl:sdl + SHA256DL]:
         return MESSAGE_FORMAT_2
-    sdl = GetClientGenuineConstDigestOffset(clientsig[8:12])
-    msg = clientsig[:sdl] + clientsig[sdl + SHA256DL:]
-    computedSignature = calcHmac(msg, bytes(GenuineFPConst, 'utf8'))
-    providedSignature = clientsig[sdl:sdl + SHA256DL]
-    if computedSignature == providedSignature:
+    sdl = GetClientGenuineConstDigestOffset(sig[8:12])
+    if digestAt(FPKey, sig, sdl) == sig[sdl:sdl + SHA256DL]:
         return MESSAGE_FORMAT_1
     return MESSAGE_FORMAT_0
 
 def generateS1(messageFormat):
-    randomBytes = bytes([random.randint(0, 255) for _ in range(RTMP_SIG_SIZE - 8)])
-    handshakeBytes = bytes([0, 0, 0, 0, 1, 2, 3, 4]) + randomBytes
+    handshakeBytes = bytearray(bytes([0, 0, 0, 0, 1, 2, 3, 4]) + os.urandom(RTMP_SIG_SIZE - 8))
 
     if messageFormat == 1:
         serverDigestOffset = GetClientGenuineConstDigestOffset(handshakeBytes[8:12])
     else:
         serverDigestOffset = GetServerGenuineConstDigestOffset(handshakeBytes[772:776])
 
-    msg = handshakeBytes[:serverDigestOffset] + handshakeBytes[serverDigestOffset + SHA256DL:]
-    hashValue = calcHmac(msg, bytes(GenuineFMSConst, 'utf8'))
-    handshakeBytes = handshakeBytes[:serverDigestOffset] + hashValue + handshakeBytes[serverDigestOffset + SHA256DL:]
-    return handshakeBytes
+    with memoryview(handshakeBytes) as view:
+        hashValue = digestAt(FMSKey, view, serverDigestOffset)
+    handshakeBytes[serverDigestOffset:serverDigestOffset + SHA256DL] = hashValue
+    return bytes(handshakeBytes)
 
 def generateS2(messageFormat, clientsig):
-    randomBytes = bytes([random.randint(0, 255) for _ in range(RTMP_SIG_SIZE - 32)])
+    randomBytes = os.urandom(RTMP_SIG_SIZE - 32)
 
     if messageFormat == 1:
         challengeKeyOffset = GetClientGenuineConstDigestOffset(clientsig[8:12])
     else:
         challengeKeyOffset = GetServerGenuineConstDigestOffset(clientsig[772:776])
 
-    challengeKey = clientsig[challengeKeyOffset:challengeKeyOffset + 32]
-    hashValue = calcHmac(challengeKey, bytes(GenuineFMSConstCrud))
+    challengeKey = memoryview(clientsig)[challengeKeyOffset:challengeKeyOffset + 32]
+    hashValue = keyedHmac(FMSCrudKey, challengeKey)
     signature = calcHmac(randomBytes, hashValue)
     s2Bytes = randomBytes + signature
     return s2Bytes
@@ -84,9 +94,21 @@ def generateS0S1S2(clientsig):
     clientType = bytes([3])
     messageFormat = detectClientMessageFormat(clientsig)
     if messageFormat == MESSAGE_FORMAT_0:
-        allBytes = clientType + clientsig + clientsig
+        allBytes = b''.join((clientType, clientsig, clientsig))
     else:
         s1Bytes = generateS1(messageFormat)
         s2Bytes = generateS2(messageFormat, clientsig)
-        allBytes = clientType + s1Bytes + s2Bytes
-    return allBytes
\ No newline at end of file
+        allBytes = b''.join((clientType, s1Bytes, s2Bytes))
+    return allBytes
+
+def generateC0C1(messageFormat=MESSAGE_FORMAT_0):
+    # Client side C0+C1, as an edge connecting to its origin. Format 1 carries the Flash Player digest.
+    clientType = bytes([3])
+    if messageFormat == MESSAGE_FORMAT_0:
+        return clientType + bytes(8) + os.urandom(RTMP_SIG_SIZE - 8)
+    c1 = bytearray(bytes([0, 0, 0, 0, 9, 0, 124, 2]) + os.urandom(RTMP_SIG_SIZE - 8))
+    offset = GetClientGenuineConstDigestOffset(c1[8:12])
+    with memoryview(c1) as view:
+        digest = digestAt(FPKey, view, offset)
+    c1[offset:offset + SHA256DL] = digest
+    return clientType + bytes(c1)
@@ -0,0 +1,96 @@
+import asyncio
+import itertools
+
+# StreamReader limit of a loopback reader: past twice this many unread bytes the writer's drain() waits,
+# like a socket buffer filling up, until the reader is down to this many
+LOOPBACK_BUFFER = 4 * 1024 * 1024
+
+_connections = itertools.count(1)
+
+class LoopbackWriter(object):
+    ''' StreamWriter stand-in that writes into the other side's StreamReader.
+
+    Written data is copied into the peer reader right away, so the caller may
+    reuse its buffers as soon as write() returns. With no peer reader (a sink)
+    everything written is counted and thrown away. Closing either side closes
+    the connection: both readers see EOF and further writes raise
+    ConnectionResetError.
+
+    Flow control is the StreamReader's own: the writer is the peer reader's
+    transport, so the reader pauses it once more than twice its limit is
+    unread and resumes it once it has read its way down to the limit.
+    drain() waits while paused.
+    '''
+
+    def __init__(self, peer, peername):
+        self.peer = peer            # StreamReader of the other side, None for a sink
+        self.peername = peername
+        self.partner = None         # writer of the other side
+        self.handler = None         # task of the server side handling the connection
+        self.closed = False
+        self.bytes = 0              # bytes written
+        self._writable = asyncio.Event()
+        self._writable.set()
+        if peer is not None:
+            peer.set_transport(self)
+
+    def write(self, data):
+        if self.closed:
+            raise ConnectionResetError('loopback connection closed')
+        self.bytes += len(data)
+        if self.peer is not None:
+            self.peer.feed_data(data)
+
+    def writelines(self, data):
+        for buffer in data:
+            self.write(buffer)
+
+    async def drain(self):
+        if self.closed:
+            raise ConnectionResetError('loopback connection closed')
+        await self._writable.wait()
+
+    def pause_reading(self):
+        # Called by the peer reader, it has more than twice its limit unread
+        self._writable.clear()
+
+    def resume_reading(self):
+        # Called by the peer reader once it is down to its limit
+        self._writable.set()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._writable.set()
+        if self.peer is not None:
+            self.peer.feed_eof()
+        if self.partner is not None:
+            self.partner.close()
+
+    async def wait_closed(self):
+        pass
+
+    def is_closing(self):
+        return self.closed
+
+    def get_extra_info(self, name, default=None):
+        return self.peername if name == 'peername' else default
+
+async def connect(server, sink=False, limit=LOOPBACK_BUFFER):
+    ''' Open an in-process connection to an RTMPServer, no socket involved.
+
+    The server side runs server.handle_client() as for an accepted socket;
+    the caller gets the client side (reader, writer) and speaks raw RTMP over
+    it, handshake included. writer.handler is the server side's task. With
+    sink=True the server's replies are discarded and reader is None, for
+    benchmarks that only push data in.
+    '''
+    number = next(_connections)
+    server_reader = asyncio.StreamReader(limit=limit)
+    client_reader = None if sink else asyncio.StreamReader(limit=limit)
+    client_writer = LoopbackWriter(server_reader, ('loopback', 0))
+    server_writer = LoopbackWriter(client_reader, ('loopback', number))
+    client_writer.partner, server_writer.partner = server_writer, client_writer
+    client_writer.handler = asyncio.ensure_future(server.handle_client(server_reader, server_writer))
+    return client_reader, client_writer
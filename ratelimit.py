@@ -0,0 +1,68 @@
+import time
+
+# Seconds covered by a RateCounter
+RATE_WINDOW = 5
+
+class RateCounter(object):
+    ''' Rolling bytes/s and messages/s over the last `window` whole seconds.
+
+    add() is O(1): counts go to the slot of the current second, which is
+    reset when the ring comes around to it again.
+    '''
+    __slots__ = ('window', 'seconds', 'bytes', 'messages', 'totalBytes', 'totalMessages')
+
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+        self.seconds = [-1] * window    # second each slot currently counts
+        self.bytes = [0] * window
+        self.messages = [0] * window
+        self.totalBytes = 0
+        self.totalMessages = 0
+
+    def add(self, nbytes, messages=0, now=None):
+        second = int(time.monotonic() if now is None else now)
+        slot = second % self.window
+        if self.seconds[slot] != second:
+            self.seconds[slot] = second
+            self.bytes[slot] = 0
+            self.messages[slot] = 0
+        self.bytes[slot] += nbytes
+        self.messages[slot] += messages
+        self.totalBytes += nbytes
+        self.totalMessages += messages
+
+    def rates(self, now=None):
+        ''' (bytes per second, messages per second) over the last complete seconds.'''
+        second = int(time.monotonic() if now is None else now)
+        nbytes = messages = 0
+        for slot in range(self.window):
+            if second - self.window <= self.seconds[slot] < second:
+                nbytes += self.bytes[slot]
+                messages += self.messages[slot]
+        return nbytes / self.window, messages / self.window
+
+class TokenBucket(object):
+    ''' Token bucket of `rate` bytes per second holding at most `burst` bytes.
+
+    consume() always takes the bytes, running into debt if needed, and returns
+    how long the caller should wait before moving on, so one large message is
+    never stuck waiting for a bucket smaller than itself.
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.throttled = 0.0    # seconds of delay handed out
+
+    def consume(self, nbytes):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= nbytes
+        if self.tokens >= 0:
+            return 0
+        delay = -self.tokens / self.rate
+        self.throttled += delay
+        return delay
@@ -0,0 +1,130 @@
+import asyncio
+import amf
+import common
+import handshake
+
+# Seconds an edge gives its origin to start playing a stream
+PULL_TIMEOUT = 10
+
+# Seconds between attempts to (re)connect a push destination while its stream is published
+PUSH_RETRY_DELAY = 5
+
+class UpstreamError(Exception):
+    pass
+
+async def clientHandshake(reader, writer):
+    # Client side of the simple handshake: C0+C1, read S0+S1, echo S1 as C2, read S2
+    writer.write(handshake.generateC0C1())
+    s0s1 = await reader.readexactly(1 + handshake.RTMP_SIG_SIZE)
+    if s0s1[0] != 3:
+        raise UpstreamError(f"unsupported RTMP version {s0s1[0]}")
+    writer.write(s0s1[1:])
+    await reader.readexactly(handshake.RTMP_SIG_SIZE)
+
+class Upstream(object):
+    ''' An edge server's connection to its origin, pulling one stream path.
+
+    The edge talks the client side of connect/createStream/play. Replies come
+    in through the server's invoke handling and are matched to their request
+    by transaction id in reply(). ready resolves with the local LiveStream once
+    the origin starts playing, or fails with UpstreamError. With port None,
+    host is the path of a Unix socket, as for pulling from a sibling worker.
+    '''
+    # onStatus code that resolves playing
+    START = 'NetStream.Play.Start'
+
+    def __init__(self, path, host, port):
+        self.path = path
+        self.host = host
+        self.port = port
+        self.app, _, self.name = path[1:].partition('/')
+        self.client_id = None
+        self.transactions = {}      # transaction id -> future of its _result
+        self.nextTransaction = 1
+        loop = asyncio.get_running_loop()
+        self.playing = loop.create_future()
+        self.ready = loop.create_future()
+
+    @property
+    def address(self):
+        return self.host if self.port is None else f"{self.host}:{self.port}"
+
+    async def open(self):
+        # (reader, writer) of a new connection to the origin
+        if self.port is None:
+            return await asyncio.open_unix_connection(self.host)
+        return await asyncio.open_connection(self.host, self.port)
+
+    def command(self, name, cmdData=None, args=()):
+        # A command message and the future its _result/_error resolves
+        tid, self.nextTransaction = self.nextTransaction, self.nextTransaction + 1
+        future = self.transactions[tid] = asyncio.get_running_loop().create_future()
+        return common.Command(name=name, id=tid, cmdData=cmdData, args=list(args)).toMessage(), future
+
+    def connect(self):
+        return self.command('connect', amf.Object(
+            app=self.app,
+            flashVer='FMLE/3.0 (compatible; RTMP edge)',
+            tcUrl=f"rtmp://{'localhost' if self.port is None else self.address}/{self.app}",
+            fpad=False,
+            capabilities=15,
+            audioCodecs=0x0fff,
+            videoCodecs=0x00ff,
+            videoFunction=1,
+            objectEncoding=0))
+
+    def createStream(self):
+        return self.command('createStream')
+
+    def play(self, stream_id):
+        # play carries no transaction, the origin answers with onStatus on the stream
+        message = common.Command(name='play', id=0, args=[self.name]).toMessage()
+        message.streamId = stream_id
+        return message
+
+    def reply(self, invoke):
+        ''' Handle a _result, _error or onStatus from the origin.
+
+        Returns False once the origin stopped playing to us, the connection
+        is of no use after that.
+        '''
+        if invoke['cmd'] == 'onStatus':
+            info = invoke['args'][0] if invoke['args'] else None
+            level, code = getattr(info, 'level', None), getattr(info, 'code', None)
+            if level == 'error' or code in ('NetStream.Play.Stop', 'NetStream.Play.UnpublishNotify'):
+                self.fail(f"{code}: {getattr(info, 'description', '')}")
+                return False
+            if code == self.START and not self.playing.done():
+                self.playing.set_result(None)
+            return True
+        future = self.transactions.pop(invoke['id'], None)
+        if future is not None and not future.done():
+            if invoke['cmd'] == '_result':
+                future.set_result(invoke)
+            else:
+                future.set_exception(UpstreamError(f"{invoke['cmd']} from origin"))
+        return True
+
+    def fail(self, reason):
+        # The connection is gone, or never came up: fail whatever still waits on it
+        error = UpstreamError(reason)
+        for future in (*self.transactions.values(), self.playing, self.ready):
+            if not future.done():
+                future.set_exception(error)
+                future.exception()  # retrieved, not every one of them has a waiter
+        self.transactions.clear()
+
+class Push(Upstream):
+    ''' A connection publishing a local stream to a push destination.
+
+    The same connect/createStream exchange as Upstream, then publish instead
+    of play; playing resolves on NetStream.Publish.Start. The stream keeps
+    its /app/name at the destination.
+    '''
+    START = 'NetStream.Publish.Start'
+
+    def publish(self, stream_id):
+        # publish carries no transaction either, the destination answers with onStatus
+        message = common.Command(name='publish', id=0, args=[self.name, 'live']).toMessage()
+        message.streamId = stream_id
+        return message
@@ -0,0 +1,70 @@
+import functools
+import struct
+import amf
+import common
+
+# Distinct onStatus bodies kept encoded; descriptions name the stream, so this is per stream path
+STATUS_CACHE_SIZE = 1024
+
+# Placeholder numbers a Template is encoded with, found again in the bytes to learn where to patch
+TRANSACTION_ID = -1.0e300
+STREAM_ID = -2.0e300
+
+DOUBLE = struct.Struct('>d')
+
+class Template(object):
+    ''' A command encoded once, with number fields patched per use.
+
+    The command goes through the AMF0 writer a single time with placeholder
+    numbers; build() copies the bytes and overwrites the 8-byte doubles at
+    the offsets the placeholders were found at.
+    '''
+    __slots__ = ('payload', 'offsets')
+
+    def __init__(self, command, *placeholders):
+        self.payload = command.toMessage().data
+        # a number is its AMF0 marker (0x00) followed by the double
+        self.offsets = tuple(self.payload.index(b'\x00' + DOUBLE.pack(placeholder)) + 1 for placeholder in placeholders)
+
+    def build(self, *values):
+        payload = bytearray(self.payload)
+        for offset, value in zip(self.offsets, values):
+            DOUBLE.pack_into(payload, offset, value)
+        return bytes(payload)
+
+@functools.lru_cache(maxsize=8)
+def connectResult(objectEncoding):
+    # _result of connect, one template per objectEncoding (0 for AMF0, 3 for AMF3)
+    return Template(common.Command(
+        name='_result',
+        id=TRANSACTION_ID,
+        args=[amf.Object(
+            level='status',
+            code='NetConnection.Connect.Success',
+            description='Connection succeeded.',
+            fmsVer='MasterStream/8,2',
+            capabilities=31,
+            objectEncoding=objectEncoding)]), TRANSACTION_ID)
+
+CREATE_STREAM_RESULT = Template(common.Command(name='_result', id=TRANSACTION_ID, args=[STREAM_ID]), TRANSACTION_ID, STREAM_ID)
+
+@functools.lru_cache(maxsize=STATUS_CACHE_SIZE)
+def status(level, code, description):
+    # onStatus carries transaction id 0 and goes out unchanged, the stream id and time are in the chunk header
+    return common.Command(
+        name='onStatus',
+        id=0,
+        args=[amf.Object(
+            level=level,
+            code=code,
+            description=description,
+            details=None)]).toMessage().data
+
+def metaData(dataObj):
+    # onMetaData as players get it, encoded once per metadata update of a stream
+    output = amf.AMFBytesIO()
+    amfWriter = amf.AMF0(output)
+    amfWriter.write('onMetaData')
+    amfWriter.write(dataObj)
+    output.seek(0)
+    return output.read()
@@ -2,12 +2,28 @@ import asyncio
 import logging
 import amf
 import av
+import budget
+import bufferpool
 import common
+import chunk
+import copy
+import directory
+import dispatch
+import functools
 import struct
 from typing import Optional
 import time
+import types
+import handoff
 import handshake
+import os
+import ratelimit
+import relay
+import responses
+import streams
+import timerwheel
 import uuid
+import weakref
 
 # Config
 LogLevel = logging.INFO
@@ -44,8 +60,31 @@ RTMP_CHANNEL_DATA = 6
 # Protocol channel ID
 PROTOCOL_CHANNEL_ID = 2
 
+# Chunk streams reserved for media and metadata relayed to players, never handed out by writeMessage
+MEDIA_CHANNELS = (RTMP_CHANNEL_AUDIO, RTMP_CHANNEL_VIDEO, RTMP_CHANNEL_DATA)
+
 MAX_CHUNK_SIZE = 10485760
 
+# Bytes requested from the socket per read in buffered ingest mode
+READ_AHEAD_SIZE = 65536
+
+# Timeouts in seconds, all driven by the server's timer wheel
+HANDSHAKE_TIMEOUT = 5
+IDLE_TIMEOUT = 120
+REASSEMBLY_TIMEOUT = 120
+
+# Seconds between two looks for pooled reassembly buffers no consumer holds any more
+POOL_SWEEP_INTERVAL = 10
+
+# Pending connections the kernel queues for us, enough for every client reconnecting at once (capped by somaxconn)
+LISTEN_BACKLOG = 4096
+
+# How long a server that handed its socket over waits for its connections to finish, in seconds
+DRAIN_TIMEOUT = 3600
+
+# Seconds a paused publisher waits on a player that does not catch up before dropping it
+PLAYER_STALL_TIMEOUT = 10
+
 # Constants for Packet Types
 PacketTypeSequenceStart = 0  # Represents the start of a video/audio sequence
 PacketTypeCodedFrames = 1  # Represents a video/audio frame
@@ -59,19 +98,29 @@ FourCC_AV1 = b'av01'  # AV1 video codec
 FourCC_VP9 = b'vp09'  # VP9 video codec
 FourCC_HEVC = b'hvc1'  # HEVC video codec
 
-# Dictionary to store live users
-LiveUsers = {}
-# Dictionary to store player users
-PlayerUsers = {}
-
 # Custom exception for disconnecting clients
 class DisconnectClientException(Exception):
     pass
 
 # Class representing the state of a connected client
 class ClientState:
+    # Slotted: a server holds one per connection, idle ones included
+    __slots__ = (
+        'id', 'clientID', 'client_ip',
+        'chunk_size', 'out_chunk_size', 'window_acknowledgement_size', 'peer_bandwidth',
+        'flashVer', 'connectType', 'tcUrl', 'swfUrl', 'app', 'objectEncoding',
+        'reader', 'writer',
+        'lastWriteHeaders', 'protocolWriteHeader', 'nextChannelId', 'streams', '_time0', 'stream_mode',
+        'streamPath', 'publishStreamId', 'publishStreamPath', 'playStreamId', 'playStreamPath', 'playFilter',
+        'sendQueue', 'CacheState', 'IncomingPackets', 'demuxer', 'Players',
+        'metaData', 'metaDataPayload', 'audioSampleRate', 'audioChannels', 'videoWidth', 'videoHeight', 'videoFps', 'Bitrate',
+        'isFirstAudioReceived', 'isReceiveVideo', 'aacSequenceHeader', 'avcSequenceHeader',
+        'audioCodec', 'audioCodecName', 'audioProfileName', 'videoCodec', 'videoCodecName', 'videoProfileName', 'videoCount', 'videoLevel',
+        'inAckSize', 'inLastAck', 'lastActivity', 'paused', 'inRate', 'outRate', 'upstream', 'timeline', 'dts', 'pts')
+
     def __init__(self):
         self.id = str(uuid.uuid4())
+        self.clientID = self.id
         self.client_ip = '0.0.0.0'
 
         # RTMP properties
@@ -92,6 +141,7 @@ class ClientState:
         self.writer: Optional[asyncio.StreamWriter] = None
         
         self.lastWriteHeaders = dict()
+        self.protocolWriteHeader = chunk.OutChunkStream(PROTOCOL_CHANNEL_ID)
         self.nextChannelId = PROTOCOL_CHANNEL_ID + 1
         self.streams = 0
         self._time0 = time.time()
@@ -100,8 +150,13 @@ class ClientState:
         self.streamPath = ''
         self.publishStreamId = 0
         self.publishStreamPath = ''
+        self.playStreamId = 0
+        self.playStreamPath = ''
+        self.playFilter = None  # streams.FrameFilter of a keyframes-only player
+        self.sendQueue = None
         self.CacheState = 0
         self.IncomingPackets = {}
+        self.demuxer = chunk.ChunkDemuxer(self.chunk_size, self.IncomingPackets)
         self.Players = {}
 
         # Meta Data
@@ -130,19 +185,111 @@ class ClientState:
         self.inAckSize = 0
         self.inLastAck = 0
 
-def empty_callback(payload):
+        self.lastActivity = 0  # timer wheel tick of the last read or write
+        self.paused = False    # publisher not read from until its consumers catch up
+        self.inRate = ratelimit.RateCounter()   # bytes/messages received
+        self.outRate = ratelimit.RateCounter()  # bytes/messages sent
+        self.upstream = None   # relay.Upstream when this is an edge's connection to its origin
+        self.timeline = None   # streams.Timeline of what this connection publishes
+        self.dts = 0           # decode/presentation timestamps (ms) of the audio/video message being handled,
+        self.pts = 0           # for the callbacks
+
+    def snapshot(self):
+        # Picklable copy of the plain attributes, for callbacks running in another process
+        values = {name: getattr(self, name) for name in self.__slots__}
+        return types.SimpleNamespace(**{name: value for name, value in values.items() if isinstance(value, (str, int, float, type(None)))})
+
+def empty_callback(*args):
     pass
 
 # RTMP server class
 class RTMPServer:
-    def __init__(self, host='0.0.0.0', port=1935, video=empty_callback, audio=empty_callback):
+    def __init__(self, host='0.0.0.0', port=1935, video=empty_callback, audio=empty_callback, ingest='buffered', gop_cache_size=streams.GOP_CACHE_SIZE,
+                 send_queue_bytes=streams.SEND_QUEUE_BYTES, send_queue_messages=streams.SEND_QUEUE_MESSAGES,
+                 stream_directory=None, worker=0, reuse_port=False, callback_executor=None, pause_bytes=0, resume_bytes=None,
+                 stall_timeout=PLAYER_STALL_TIMEOUT,
+                 memory_limit=budget.SERVER_MEMORY_LIMIT, reassembly_limit=budget.CONNECTION_REASSEMBLY_LIMIT,
+                 ingest_limits=None, egress_limits=None, handoff_path=None, drain_timeout=DRAIN_TIMEOUT,
+                 origin=None, buffer_pool_bytes=bufferpool.POOL_IDLE_BYTES, unix_path=None, push=None,
+                 push_retry_delay=relay.PUSH_RETRY_DELAY):
         # Socket
         # Server socket properties
         self.host = host
         self.port = port
+        # Also accept on this Unix domain socket, for encoders and relays on the same host
+        self.unix_path = unix_path
+        self.unixServer = None
         self.client_states = {}
+        # Synchronous callbacks run inline on the event loop, subscribe() is the non-blocking way to get frames
         self.video_callback = video
         self.audio_callback = audio
+        # None runs them inline, 'thread', 'process' or an Executor runs them off the loop, in order per stream.
+        # Off the loop the video callback gets a copy of client_state as of its message (a snapshot of the
+        # plain attributes across processes), so client_state.dts and .pts are those of the frame.
+        self.dispatcher = dispatch.CallbackDispatcher(callback_executor) if callback_executor is not None else None
+        # Streams published to this process by path, who owns a path across workers is in self.directory
+        self.registry = streams.StreamRegistry()
+        # stream path -> subscriptions handed out by subscribe(), dropped once closed or their consumer lets go
+        self.subscriptions = {}
+        # 'buffered' parses chunks out of large socket reads, 'stream' awaits every header field
+        self.ingest = ingest
+        # Memory cap of each stream's GOP cache, 0 disables it
+        self.gop_cache_size = gop_cache_size
+        # Limits of each player's send queue before frames are dropped
+        self.send_queue_bytes = send_queue_bytes
+        self.send_queue_messages = send_queue_messages
+        # Stop reading a publisher while more than pause_bytes of its stream wait in send queues, subscriptions
+        # and callback lanes, resume below resume_bytes. 0 disables it; keep it below send_queue_bytes, past
+        # which a player's queue drops frames anyway. If the stream is still above resume_bytes after
+        # stall_timeout seconds of pause, the callback calls waiting are dropped and the consumers most
+        # behind are let go, players disconnected and subscriptions closed, instead of holding it up.
+        self.pause_bytes = pause_bytes
+        self.resume_bytes = resume_bytes if resume_bytes is not None else pause_bytes // 2
+        self.stall_timeout = stall_timeout
+        self.drainWaiters = {}      # stream path -> Event a paused publisher waits on
+        if self.dispatcher is not None and pause_bytes:
+            self.dispatcher.lowWater = self.resume_bytes
+            self.dispatcher.drained = self.laneDrained
+        # Reassembly buffers, GOP caches and send queues are accounted against memory_limit; GOP caches are
+        # evicted first, then queues skip frames and connections that cannot get a payload buffer are closed.
+        # A connection may hold at most reassembly_limit bytes of partial messages.
+        self.memory = budget.MemoryBudget(memory_limit, self.reclaimMemory)
+        self.reassembly_limit = reassembly_limit
+        # Large message payloads are reassembled in pooled, size-classed buffers that are reused once every
+        # consumer let go of them; up to buffer_pool_bytes of unused buffers are kept, 0 disables the pool.
+        self.bufferPool = bufferpool.BufferPool(buffer_pool_bytes) if buffer_pool_bytes else None
+        # Optional bytes/s limits per application, {app: rate}. All publishers of an app share one ingest
+        # token bucket and all its players one egress bucket, so one runaway stream cannot hog the loop.
+        self.ingestBuckets = {app: ratelimit.TokenBucket(rate) for app, rate in (ingest_limits or {}).items()}
+        self.egressBuckets = {app: ratelimit.TokenBucket(rate) for app, rate in (egress_limits or {}).items()}
+        # Unix socket path for zero-downtime restarts: a new server started with the same path takes over
+        # the listening socket, this one stops accepting and drains for at most drain_timeout seconds
+        self.handoff_path = handoff_path
+        self.drain_timeout = drain_timeout
+        # While the process we took over from drains, it serves the streams still published there on
+        # this Unix socket, and players of a stream not published here pull it from there
+        self.predecessor = None
+        self.drainServer = None
+        self.drainPath = None
+        self.server = None
+        self.stopped = asyncio.Event()
+        # One timer wheel owns handshake deadlines, idle timeouts and partial message expiry
+        self.timers = timerwheel.TimerWheel()
+        # Publish-name ownership, shared between processes when running several workers
+        self.directory = stream_directory if stream_directory is not None else directory.StreamDirectory()
+        self.worker = worker
+        # Let several worker processes bind the same port (SO_REUSEPORT)
+        self.reuse_port = reuse_port
+        # Edge mode: (host, port) of an origin server. A stream played here that nobody publishes locally
+        # is pulled from the origin over one upstream connection per path and fanned out to local players.
+        self.origin = origin
+        self.upstreams = {}     # stream path -> relay.Upstream
+        # Restreaming: [(host, port), ...] every stream published here is pushed to, under the same /app/name.
+        # A push connection is a player of the stream as far as relaying goes: it shares the chunked bytes
+        # with the players and has a send queue of its own, so a slow destination only holds up itself.
+        # A destination that is down or goes away is retried after push_retry_delay seconds.
+        self.push = list(push or ())
+        self.push_retry_delay = push_retry_delay
         
         self.logger = logging.getLogger('RTMPServer')
         self.logger.setLevel(LogLevel)
@@ -153,57 +300,78 @@ class RTMPServer:
         self.client_states[client_state.id] = client_state
         self.client_states[client_state.id].clientID = client_state.id
 
+        client_state.demuxer.memory = self.memory
+        client_state.demuxer.pool = self.bufferPool
+        client_state.demuxer.max_buffered = self.reassembly_limit
+
         self.client_states[client_state.id].reader = reader
         self.client_states[client_state.id].writer = writer
 
-        self.client_states[client_state.id].client_ip  = writer.get_extra_info('peername')
+        # Unix socket peers have no name, log the path they came in on
+        self.client_states[client_state.id].client_ip  = writer.get_extra_info('peername') or self.unix_path
         self.logger.info("New client connected: %s", self.client_states[client_state.id].client_ip)
 
         # Perform RTMP handshake
+        handshake_timer = self.timers.call_later(HANDSHAKE_TIMEOUT, self.handshakeTimeout, client_state.id)
         try:
-            await asyncio.wait_for(self.perform_handshake(client_state.id), timeout=5)
-        except asyncio.TimeoutError:
-            self.logger.error("Handshake timeout. Closing connection: %s", self.client_states[client_state.id].client_ip)
+            await self.perform_handshake(client_state.id)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.logger.debug("Handshake failed: %s", self.client_states[client_state.id].client_ip)
             await self.disconnect(client_state.id)
             return
+        handshake_timer.cancel()
+
+        await self.process_messages(client_state.id)
+        await self.disconnect(client_state.id)
 
-        # Process RTMP messages
+    async def process_messages(self, client_id):
+        # Read and handle RTMP messages until the connection ends
+        client_state = self.client_states[client_id]
+        client_state.lastActivity = self.timers.ticks
+        self.timers.call_later(IDLE_TIMEOUT, self.idleTimeout, client_id)
+        self.timers.call_later(REASSEMBLY_TIMEOUT, self.clearPayloadIfTimeout, client_id)
+
+        get_chunk_data = self.get_buffered_chunk_data if self.ingest == 'buffered' else self.get_chunk_data
         while True:
             try:
-                await self.get_chunk_data(client_state.id)
+                await get_chunk_data(client_id)
                 
             except asyncio.TimeoutError:
-                self.logger.debug("Connection timeout. Closing connection: %s", self.client_states[client_state.id].client_ip)
+                self.logger.debug("Connection timeout. Closing connection: %s", client_state.client_ip)
                 break
             
             except DisconnectClientException:
-                self.logger.debug("Disconnecting client: %s", self.client_states[client_state.id].client_ip)
+                self.logger.debug("Disconnecting client: %s", client_state.client_ip)
                 break
             
             except ConnectionAbortedError as e:
-                self.logger.debug("Connection aborted by client: %s", self.client_states[client_state.id].client_ip)
+                self.logger.debug("Connection aborted by client: %s", client_state.client_ip)
                 break
         
             except Exception as e:
                 self.logger.error("An error occurred: %s", str(e))
                 break
-
-        await self.disconnect(client_state.id)
         
     async def disconnect(self, client_id):
         # Close the client connection
         client_state = self.client_states[client_id]
-        if client_state.stream_mode == 'live':
+        client_ip = client_state.client_ip
+        stream = self.registry.unpublish(client_id)
+        if stream is not None:
+            await self.directory.release(stream.path, self.streamOwner(client_id))
             # Finish Stream for players!
-            print("NEED DISCONNECT Players!")
+            await self.finishPlayers(stream)
+            stream.gop.clear()
 
-        client_ip = client_state.client_ip
-        for app in LiveUsers:
-            if LiveUsers[app]['client_id'] == client_id:
-                del LiveUsers[app]
-                break
+        played = self.registry.removePlayer(client_id)
+        if played is not None:
+            self.releaseUpstream(played)
+        if client_state.sendQueue is not None:
+            client_state.sendQueue.close()
+            self.logger.info("Player %s sent %d messages, dropped %d frames (%d bytes)", client_ip,
+                             client_state.sendQueue.sentMessages, client_state.sendQueue.droppedFrames, client_state.sendQueue.droppedBytes)
 
-        client_state['IncomingPackets'].clear()
+        client_state.demuxer.clear()
 
         del self.client_states[client_id]
         try:
@@ -219,6 +387,8 @@ class RTMPServer:
         # Read a chunk of data from the client
         client_state = self.client_states[client_id]
         try:
+            if self.pause_bytes:
+                await self.waitForDownstream(client_id)
             chunk_data = await client_state.reader.readexactly(1)
             if not chunk_data:
                 raise DisconnectClientException()
@@ -231,24 +401,25 @@ class RTMPServer:
                 cid = 64 + chunk_data[1] # Chunk stream IDs 64-319 can be encoded in the 2-byte form of the header
             elif cid == 1: #ChunkBasicHeader: 3
                 chunk_data += await client_state.reader.readexactly(2) # Need read 2 more packets
-                cid = (64 + chunk_data[1] + chunk_data[2]) << 8 # Chunk stream IDs 64-65599 can be encoded in the 3-byte version of this field
+                cid = 64 + chunk_data[1] + (chunk_data[2] << 8) # Chunk stream IDs 64-65599 can be encoded in the 3-byte version of this field
 
             chunk_full = bytearray(chunk_data)
             fmt = (chunk_data[0] & 0b11000000) >> 6
 
             if not cid in client_state.IncomingPackets:
-                client_state.IncomingPackets[cid] = self.createPacket(cid, fmt)
+                client_state.demuxer.open(cid, fmt)
             
-            # I'm afraid I suffer from memory leaks. :D
-            client_state.IncomingPackets[cid]['last_received_time'] = time.time()
-            self.clearPayloadIfTimeout(client_id, 120)
+            packet = client_state.IncomingPackets[cid]
+            client_state.lastActivity = self.timers.ticks
 
             header_data = bytearray()
-             # Get Message Timestamp for FMT 0, 1, 2
+            timestamp = None
+             # Get Message Timestamp (or delta) for FMT 0, 1, 2
             if fmt <= RTMP_CHUNK_TYPE_2:
                 timestamp_bytes = await client_state.reader.readexactly(3)
                 header_data += timestamp_bytes
-                client_state.IncomingPackets[cid]['timestamp'] = int.from_bytes(timestamp_bytes, byteorder='big')
+                timestamp = int.from_bytes(timestamp_bytes, byteorder='big')
+                packet.extended = timestamp == 0xffffff
                 del timestamp_bytes
 
             # Get Message Length and Message Type for FMT 0, 1
@@ -257,9 +428,9 @@ class RTMPServer:
                 header_data += length_bytes
                 type_bytes = await client_state.reader.readexactly(1)
                 header_data += type_bytes
-                client_state.IncomingPackets[cid]['payload_length'] = int.from_bytes(length_bytes, byteorder='big')
-                client_state.IncomingPackets[cid]['msg_type_id'] = int.from_bytes(type_bytes, byteorder='big')
-                client_state.IncomingPackets[cid]['payload'] = bytearray()
+                packet.payload_length = int.from_bytes(length_bytes, byteorder='big')
+                packet.msg_type_id = int.from_bytes(type_bytes, byteorder='big')
+                client_state.demuxer.drop(packet)
                 del length_bytes
                 del type_bytes
             
@@ -267,47 +438,46 @@ class RTMPServer:
             if fmt == RTMP_CHUNK_TYPE_0: 
                 streamID_bytes = await client_state.reader.readexactly(4)
                 header_data += streamID_bytes
-                client_state.IncomingPackets[cid]['msg_stream_id'] = int.from_bytes(streamID_bytes, byteorder='big')
+                packet.msg_stream_id = int.from_bytes(streamID_bytes, byteorder='little') # the one little-endian field of the header
                 del streamID_bytes
             
             chunk_full += header_data
             
-            # Set Main Packet Headers and payload_length for FMT 0, 1
-            if fmt <= RTMP_CHUNK_TYPE_1: 
-                # client_state.IncomingPackets[cid]['basic_header'] = chunk_data
-                # client_state.IncomingPackets[cid]['header'] = header_data
-                payload_length = client_state.IncomingPackets[cid]['payload_length']
-
-            # Calculate Payload Remaining length for FMT 2,3 
-            if fmt > RTMP_CHUNK_TYPE_1:
-                payload_length = client_state.IncomingPackets[cid]['payload_length'] - len(client_state.IncomingPackets[cid]['payload'])
+            # Payload Remaining length, the whole message for FMT 0, 1
+            payload_length = packet.remaining
 
             # Check message type id
-            if RTMP_TYPE_METADATA < client_state.IncomingPackets[cid]['msg_type_id']:
-                self.logger.error("Invalid Packet Type: %s", str(client_state.IncomingPackets[cid]['msg_type_id']))
+            if RTMP_TYPE_METADATA < packet.msg_type_id:
+                self.logger.error("Invalid Packet Type: %s", str(packet.msg_type_id))
                 raise DisconnectClientException()
             
             # Messages with type=3 should never have ext timestamp field according to standard. However that's not always the case in real life
-            if client_state.IncomingPackets[cid]['timestamp'] == 0xffffff:  # Max Value check (16777215), Need to read extended timestamp
+            if packet.extended:  # Max Value (16777215) in the last header, Need to read extended timestamp
                 extended_timestamp_bytes = await client_state.reader.readexactly(4)
                 chunk_full += extended_timestamp_bytes
-                client_state.IncomingPackets[cid]['extended_timestamp'] = int.from_bytes(extended_timestamp_bytes, byteorder='big')
+                if fmt <= RTMP_CHUNK_TYPE_2:
+                    timestamp = int.from_bytes(extended_timestamp_bytes, byteorder='big')
                 del extended_timestamp_bytes
+            packet.stamp(fmt, timestamp)
 
             client_state.inAckSize += len(chunk_full)
 
-            self.logger.debug(f"FMT: {fmt}, CID: {cid}, Message Length: {payload_length}, Timestamp: {client_state.IncomingPackets[cid]['timestamp']}")
+            self.logger.debug(f"FMT: {fmt}, CID: {cid}, Message Length: {payload_length}, Timestamp: {packet.timestamp}")
 
             if payload_length > 0:
                 payload_length = min(client_state.chunk_size, payload_length)
                 payload = await client_state.reader.readexactly(payload_length)
                 client_state.inAckSize += len(payload)
-                client_state.IncomingPackets[cid]['payload'] += payload
+                if packet.payload is None:
+                    client_state.demuxer.allocate(packet)
+                packet.write(payload)
+                client_state.inRate.add(len(chunk_full) + len(payload), int(packet.received >= packet.payload_length))
+                await self.throttleIngest(client_state, len(chunk_full) + len(payload))
                 del payload
             else:
                 # I'm not sure. In some cases, I may need to disconnect the client, while in other cases, I won't. I will ignore the issue and proceed to the next packet, but I will clear the payload. If invalid data continues, it may result in a disconnection when processing subsequent packets.
-                self.logger.error(f"Invalid Length (ZERO!), FMT: {fmt}, CID: {cid}, Message Length: {payload_length}, Timestamp: {client_state.IncomingPackets[cid]['timestamp']}")
-                client_state.IncomingPackets[cid]['payload'] = bytearray()
+                self.logger.error(f"Invalid Length (ZERO!), FMT: {fmt}, CID: {cid}, Message Length: {payload_length}, Timestamp: {packet.timestamp}")
+                client_state.demuxer.drop(packet)
                 return
                 
             if client_state.inAckSize >= 0xF0000000:
@@ -320,20 +490,9 @@ class RTMPServer:
             del payload_length
             del header_data
 
-            if len(client_state.IncomingPackets[cid]['payload']) >= client_state.IncomingPackets[cid]['payload_length']:
-                rtmp_packet = {
-                    "header": {
-                        "fmt": client_state.IncomingPackets[cid]["fmt"],
-                        "cid": client_state.IncomingPackets[cid]["cid"],
-                        "timestamp": client_state.IncomingPackets[cid]["timestamp"],
-                        "length": client_state.IncomingPackets[cid]["payload_length"],
-                        "type": client_state.IncomingPackets[cid]["msg_type_id"],
-                        "stream_id": client_state.IncomingPackets[cid]["msg_stream_id"]
-                    },
-                    "clock": 0,
-                    "payload": client_state.IncomingPackets[cid]['payload']
-                }
-                client_state.IncomingPackets[cid]['payload'] = bytearray()
+            if packet.received >= packet.payload_length:
+                rtmp_packet = chunk.RTMPPacket(packet.fmt, packet.cid, packet.timestamp, packet.payload_length,
+                                               packet.msg_type_id, packet.msg_stream_id, client_state.demuxer.take(packet))
                 await self.handle_rtmp_packet(client_id, rtmp_packet)
                 del rtmp_packet
 
@@ -346,30 +505,80 @@ class RTMPServer:
             self.logger.error("An error occurred: %s", str(e))
             raise DisconnectClientException()
 
-    # This function is designed to safely stop memory leaks if they exist. It ensures that memory is properly managed and prevents any potential leaks from causing issues.
-    def clearPayloadIfTimeout(self, client_id, packet_timeout=30):
+    async def get_buffered_chunk_data(self, client_id):
+        # Read as much as is available and demux every complete chunk in it
         client_state = self.client_states[client_id]
-        current_time = time.time()
+        try:
+            if self.pause_bytes:
+                await self.waitForDownstream(client_id)
+            data = await client_state.reader.read(READ_AHEAD_SIZE)
+            if not data:
+                raise DisconnectClientException()
+
+            client_state.inAckSize += len(data)
+            client_state.lastActivity = self.timers.ticks
+
+            messages = 0
+            for rtmp_packet in client_state.demuxer.feed(data):
+                messages += 1
+                await self.handle_rtmp_packet(client_id, rtmp_packet)
+            client_state.inRate.add(len(data), messages)
+
+            if client_state.inAckSize >= 0xF0000000:
+                client_state.inAckSize = 0
+                client_state.inLastAck = 0
+
+            # Send ACK If needed!
+            if(client_state.window_acknowledgement_size > 0 and client_state.inAckSize - client_state.inLastAck >= client_state.window_acknowledgement_size):
+                client_state.inLastAck = client_state.inAckSize
+                await self.send_ack(client_id, client_state.inAckSize)
+
+            await self.throttleIngest(client_state, len(data))
+
+        except DisconnectClientException:
+            raise
+        except budget.BudgetExceeded as e:
+            self.logger.warning("Closing connection %s: %s", client_state.client_ip, str(e))
+            raise DisconnectClientException()
+        except Exception as e:
+            self.logger.error("An error occurred: %s", str(e))
+            raise DisconnectClientException()
+
+    # This function is designed to safely stop memory leaks if they exist. It ensures that memory is properly managed and prevents any potential leaks from causing issues.
+    # It runs from the timer wheel every REASSEMBLY_TIMEOUT seconds and drops partial messages that received no chunk since the previous run.
+    def clearPayloadIfTimeout(self, client_id):
+        client_state = self.client_states.get(client_id)
+        if client_state is None:
+            return
         for cid, packet in client_state.IncomingPackets.items():
-            if 'last_received_time' in packet and current_time - packet['last_received_time'] >= packet_timeout:
-                packet['payload'] = bytearray()  # Clear the payload
+            if packet.payload is not None and packet.chunks == packet.mark:
+                self.logger.debug("Dropping stalled partial message, CID: %d", cid)
+                client_state.demuxer.drop(packet)  # Clear the payload
+            packet.mark = packet.chunks
+        self.timers.call_later(REASSEMBLY_TIMEOUT, self.clearPayloadIfTimeout, client_id)
+
+    def handshakeTimeout(self, client_id):
+        client_state = self.client_states.get(client_id)
+        if client_state is None:
+            return
+        self.logger.error("Handshake timeout. Closing connection: %s", client_state.client_ip)
+        client_state.writer.close()
+
+    def idleTimeout(self, client_id):
+        client_state = self.client_states.get(client_id)
+        if client_state is None:
+            return
+        idle = (self.timers.ticks - client_state.lastActivity) * self.timers.tick
+        if client_state.paused:
+            idle = 0   # we are the ones not reading
+        if idle >= IDLE_TIMEOUT:
+            self.logger.info("Connection timeout. Closing connection: %s", client_state.client_ip)
+            client_state.writer.close()
+        else:
+            self.timers.call_later(IDLE_TIMEOUT - idle, self.idleTimeout, client_id)
 
     def createPacket(self, cid, fmt):
-        out = {}
-        out['fmt'] = fmt
-        out['cid'] = cid
-        # out['basic_header'] = bytearray()
-        # out['header'] = bytearray()
-
-        out['timestamp'] = 0
-        out['extended_timestamp'] = 0
-        out['payload_length'] = 0
-        out['msg_type_id'] = 0
-        out['msg_stream_id'] = 0
-        out['payload'] = bytearray()
-        out['last_received_time'] = time.time()
-
-        return out
+        return chunk.createPacket(cid, fmt)
 
     async def perform_handshake(self, client_id):
         # Perform the RTMP handshake with the client
@@ -379,24 +588,12 @@ class RTMPServer:
         if c0_data != bytes([0x03]) and c0_data != bytes([0x06]):
             client_state.writer.close()
             await client_state.writer.wait_closed()
-            self.logger.info("Invalid Handshake, Client disconnected: %s", self.client_ip)
-
-        c1_data = await client_state.reader.readexactly(1536)
-        clientType = bytes([3])
-        messageFormat = handshake.detectClientMessageFormat(c1_data)
-        if messageFormat == handshake.MESSAGE_FORMAT_0:
-            await self.send(client_id, clientType)
-            s1_data = c1_data
-            s2_data = c1_data
-            await self.send(client_id, c1_data)
-            await client_state.reader.readexactly(len(s1_data))
-            await self.send(client_id, s2_data)
-        else:
-            s1_data = handshake.generateS1(messageFormat)
-            s2_data = handshake.generateS2(messageFormat, c1_data)
-            data = clientType + s1_data + s2_data
-            client_state.writer.write(data)
-            s1_data = await client_state.reader.readexactly(len(s1_data))
+            self.logger.info("Invalid Handshake, Client disconnected: %s", client_state.client_ip)
+
+        c1_data = await client_state.reader.readexactly(handshake.RTMP_SIG_SIZE)
+        # S2 only depends on C1, so S0, S1 and S2 go out in one write and the handshake takes a single round trip
+        await self.send(client_id, handshake.generateS0S1S2(c1_data))
+        await client_state.reader.readexactly(handshake.RTMP_SIG_SIZE)  # C2
 
         self.logger.debug("Handshake done!")
 
@@ -405,8 +602,8 @@ class RTMPServer:
         # client_state = self.client_states[client_id]
 
         # Extract information from rtmp_packet and process as needed
-        msg_type_id = rtmp_packet["header"]["type"]
-        payload = rtmp_packet["payload"]
+        msg_type_id = rtmp_packet.type
+        payload = rtmp_packet.payload
         # self.logger.debug("Received RTMP packet:")
         # self.logger.debug("  RTMP Packet Type: %s", msg_type_id)
     
@@ -430,13 +627,48 @@ class RTMPServer:
         elif msg_type_id == RTMP_TYPE_INVOKE:
             invoke_message = self.parse_amf0_invoke_message(rtmp_packet)
             await self.handle_invoke_message(client_id, invoke_message)
+        elif msg_type_id == RTMP_TYPE_METADATA:
+            await self.handle_aggregate_message(client_id, rtmp_packet)
         else:
             self.logger.debug("Unsupported RTMP packet type: %s", msg_type_id)
 
+    async def handle_aggregate_message(self, client_id, rtmp_packet):
+        # An Aggregate message carries FLV tags back to back: 11 byte tag header, body, 4 byte back pointer.
+        # Every body goes to its handler as a memoryview slice of the aggregate payload, nothing is copied.
+        view = memoryview(rtmp_packet.payload)
+        offset, end = 0, len(view)
+        first = None
+        while end - offset >= 11:
+            tag = av.parse_tag_header(view[offset:offset + 11])
+            start = offset + 11
+            stop = start + tag['dataSize']
+            if stop > end:
+                self.logger.warning("Truncated aggregate message, dropping %d bytes", end - offset)
+                break
+            offset = stop + 4
+
+            # Tag timestamps are relative to the first tag, which is the aggregate message's timestamp
+            timestamp = (tag['timestampExtended'] << 24) | tag['timestamp']
+            if first is None:
+                first = timestamp
+            if stop == start:
+                continue
+            sub_packet = chunk.RTMPPacket(rtmp_packet.fmt, rtmp_packet.cid, (rtmp_packet.timestamp + timestamp - first) & 0xffffffff,
+                                          tag['dataSize'], tag['type'], rtmp_packet.stream_id, view[start:stop])
+            if tag['type'] == RTMP_TYPE_AUDIO:
+                await self.handle_audio_data(client_id, sub_packet)
+            elif tag['type'] == RTMP_TYPE_VIDEO:
+                await self.handle_video_data(client_id, sub_packet)
+            elif tag['type'] == RTMP_TYPE_DATA:
+                await self.handle_amf_data(client_id, sub_packet)
+            else:
+                self.logger.debug("Unsupported tag type in aggregate message: %s", tag['type'])
+
     async def handle_video_data(self, client_id, rtmp_packet):
         # Handle video data in an RTMP packet
         client_state = self.client_states[client_id]
-        payload = rtmp_packet['payload']
+        stream = self.publishedStream(client_id)
+        payload = rtmp_packet.payload
         isExHeader = (payload[0] >> 4 & 0b1000) != 0
         frame_type = payload[0] >> 4 & 0b0111
         codec_id = payload[0] & 0x0f
@@ -479,6 +711,8 @@ class RTMPServer:
         if codec_id in [7, 12, 13]:
             if frame_type == 1 and payload[1] == 0:
                 client_state.avcSequenceHeader = bytearray(payload)
+                if stream is not None:
+                    stream.gop.avcSequenceHeader = client_state.avcSequenceHeader
                 info = av.readAVCSpecificConfig(client_state.avcSequenceHeader)
                 client_state.videoWidth = info['width']
                 client_state.videoHeight = info['height']
@@ -493,12 +727,26 @@ class RTMPServer:
             client_state.videoCodecName = common.VIDEO_CODEC_NAME[codec_id]
             self.logger.info("Codec Name: %s", client_state.videoCodecName)
 
+        sequence_header = codec_id in [7, 12, 13] and payload[1] == 0
+        keyframe = frame_type == 1 and not sequence_header
+        # AVC, HEVC and AV1 frames carry the composition time offset, PTS - DTS, as a signed 24-bit number
+        cts = int.from_bytes(payload[2:5], 'big', signed=True) if codec_id in [7, 12, 13] and payload[1] == 1 and len(payload) >= 5 else 0
+        frame = self.stampFrame(client_state, 'video', rtmp_packet.timestamp, payload, keyframe, sequence_header, cts)
+
         # print("VIDEO payload: ")#,payload)
-        self.video_callback(client_state,payload)
+        self.runCallback(client_state, self.video_callback, client_state, frame.payload)
+        if stream is not None:
+            timestamp = rtmp_packet.timestamp
+            if not sequence_header:
+                # sequence headers are kept apart from the GOP
+                stream.gop.add(frame)
+            self.publishFrame(stream, frame)
+            self.relayToPlayers(stream, RTMP_TYPE_VIDEO, timestamp, payload, keyframe=frame_type == 1, sequence_header=sequence_header)
         
     async def handle_audio_data(self, client_id, rtmp_packet):
         client_state = self.client_states[client_id]
-        payload = rtmp_packet['payload']
+        stream = self.publishedStream(client_id)
+        payload = rtmp_packet.payload
         sound_format = (payload[0] >> 4) & 0x0f
         sound_type = payload[0] & 0x01
         sound_size = (payload[0] >> 1) & 0x01
@@ -527,6 +775,8 @@ class RTMPServer:
             # cache AAC sequence header
             client_state.isFirstAudioReceived = True
             client_state.aacSequenceHeader = payload
+            if stream is not None:
+                stream.gop.aacSequenceHeader = payload
 
             if sound_format == 10:
                 info = av.read_aac_specific_config(client_state.aacSequenceHeader)
@@ -537,8 +787,470 @@ class RTMPServer:
                 client_state.audioSampleRate = 48000
                 client_state.audioChannels = payload[11]
         
+        sequence_header = (sound_format == 10 or sound_format == 13) and payload[1] == 0
+        frame = self.stampFrame(client_state, 'audio', rtmp_packet.timestamp, payload, sequence_header=sequence_header)
+
         # print("VIDEO payload: ")#,payload)
-        self.audio_callback(payload)
+        self.runCallback(client_state, self.audio_callback, frame.payload)
+        if stream is not None:
+            timestamp = rtmp_packet.timestamp
+            if not sequence_header:
+                stream.gop.add(frame)
+            self.publishFrame(stream, frame)
+            self.relayToPlayers(stream, RTMP_TYPE_AUDIO, timestamp, payload, sequence_header=sequence_header)
+
+    def stampFrame(self, client_state, type, timestamp, payload, keyframe=False, sequence_header=False, cts=0):
+        # The Frame of a publisher's audio/video message, timed on the publisher's timeline
+        if client_state.timeline is None:
+            client_state.timeline = streams.Timeline()
+        now = time.monotonic()
+        dts = client_state.timeline.dts(timestamp, now)
+        client_state.dts, client_state.pts = dts, dts + cts
+        return streams.Frame(type, timestamp, payload, keyframe, sequence_header, dts, dts + cts, now, client_state.timeline.lag)
+
+    def runCallback(self, client_state, callback, *args):
+        # Call a video/audio callback inline or queue it on the stream's dispatcher lane
+        if self.dispatcher is None:
+            callback(*args)
+            return
+        if callback is empty_callback:
+            return
+        if self.dispatcher.pickles:
+            args = [arg.snapshot() if arg is client_state else bytes(arg) if isinstance(arg, memoryview) else arg for arg in args]
+        else:
+            # the call runs later, by when the next messages have moved client_state on: it gets a copy
+            # as of this message, dts and pts included
+            args = [copy.copy(arg) if arg is client_state else arg for arg in args]
+        self.dispatcher.submit(client_state.id, callback, *args)
+
+    def downstreamBytes(self, stream):
+        # Bytes of a stream waiting in its players' send queues, its subscriptions and its callback lane
+        total = 0
+        for player_id in stream.subscribers:
+            queue = self.client_states[player_id].sendQueue
+            if queue is not None:
+                total += queue.backlog
+        for subscription in self.pathSubscriptions(stream.path):
+            if not subscription.closed:
+                total += subscription.bytes
+        if self.dispatcher is not None:
+            total += self.dispatcher.backlog(stream.client_id)
+        return total
+
+    async def waitForDownstream(self, client_id):
+        # Backpressure: hold off reading from a publisher whose consumers are behind. The unread
+        # data fills the StreamReader, which pauses the transport, then the TCP window. Acks only
+        # cover what was read, so the encoder also runs into its acknowledgement window.
+        stream = self.publishedStream(client_id)
+        if stream is None or self.downstreamBytes(stream) <= self.pause_bytes:
+            return
+        client_state = self.client_states[client_id]
+        client_state.paused = True
+        stream.pauses += 1
+        self.logger.debug("Pausing publisher %s, %d bytes queued downstream", client_state.client_ip, self.downstreamBytes(stream))
+        # Consumers set the event as their backlog gets to resume_bytes or below, see watchDrain()
+        drained = self.drainWaiters[stream.path] = asyncio.Event()
+        stalled = time.monotonic() + self.stall_timeout
+        try:
+            while self.publishedStream(client_id) is stream:
+                drained.clear()
+                if self.downstreamBytes(stream) <= self.resume_bytes:
+                    break
+                if time.monotonic() >= stalled:
+                    self.dropStalledConsumers(stream)
+                    stalled = time.monotonic() + self.stall_timeout
+                    continue
+                try:
+                    await asyncio.wait_for(drained.wait(), stalled - time.monotonic())
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if self.drainWaiters.get(stream.path) is drained:
+                del self.drainWaiters[stream.path]
+            client_state.paused = False
+            client_state.lastActivity = self.timers.ticks
+
+    def downstreamDrained(self, path):
+        # A consumer of path got its backlog down, wake the publisher if it is paused
+        drained = self.drainWaiters.get(path)
+        if drained is not None:
+            drained.set()
+
+    def laneDrained(self, lane):
+        # Callback lanes are keyed by publisher
+        stream = self.registry.publishedBy(lane)
+        if stream is not None:
+            self.downstreamDrained(stream.path)
+
+    def watchDrain(self, consumer, path):
+        # Have a send queue or subscription tell a paused publisher of path when its backlog gets low
+        if self.pause_bytes:
+            consumer.lowWater = self.resume_bytes
+            consumer.drained = functools.partial(self.downstreamDrained, path)
+
+    def dropStalledConsumers(self, stream):
+        # A paused publisher waited stall_timeout: callback calls still waiting are dropped, then the
+        # consumers with the largest backlog go until the rest fits in resume_bytes, so neither one
+        # stuck consumer nor many slow ones each under resume_bytes hold the stream up
+        if self.dispatcher is not None:
+            nbytes = self.dispatcher.discard(stream.client_id)
+            if nbytes:
+                self.logger.warning("Dropped %d bytes of callback calls waiting for %s", nbytes, stream.path)
+        consumers = []
+        for player_id in stream.subscribers:
+            queue = self.client_states[player_id].sendQueue
+            if queue is not None and queue.backlog:
+                consumers.append((queue.backlog, player_id))
+        for subscription in self.pathSubscriptions(stream.path):
+            if not subscription.closed and subscription.bytes:
+                consumers.append((subscription.bytes, subscription))
+        consumers.sort(key=lambda consumer: consumer[0], reverse=True)
+        total = sum(backlog for backlog, consumer in consumers)
+        for backlog, consumer in consumers:
+            if total <= self.resume_bytes:
+                break
+            total -= backlog
+            if isinstance(consumer, streams.Subscription):
+                self.logger.warning("Closing stalled subscription of %s, %d bytes queued", stream.path, backlog)
+                consumer.close(drop=True)
+            else:
+                self.dropPlayer(consumer, stream)
+        self.releaseUpstream(stream)
+
+    def dropPlayer(self, player_id, stream):
+        # Disconnect a player that does not keep up, not waited for
+        player = self.client_states[player_id]
+        self.logger.warning("Dropping stalled player %s of %s, %d bytes queued", player.client_ip, stream.path, player.sendQueue.backlog)
+        self.registry.removePlayer(player_id)
+        player.sendQueue.close()
+        # a closed transport would still wait to flush to a peer that does not read
+        transport = getattr(player.writer, 'transport', None)
+        if transport is not None:
+            transport.abort()
+        else:
+            player.writer.close()
+
+    async def throttleIngest(self, client_state, nbytes):
+        # Hold off the next read while the app is over its ingest rate
+        bucket = self.ingestBuckets.get(client_state.app) if self.ingestBuckets else None
+        if bucket is not None:
+            delay = bucket.consume(nbytes)
+            if delay:
+                await asyncio.sleep(delay)
+                client_state.lastActivity = self.timers.ticks
+
+    def trafficStats(self):
+        ''' Rolling receive/send rates of every connection, publishers' media time and ingest lag, and how long each app was throttled.'''
+        connections = {}
+        for client_id, client_state in self.client_states.items():
+            in_bytes, in_messages = client_state.inRate.rates()
+            out_bytes, out_messages = client_state.outRate.rates()
+            connections[client_id] = {
+                'client_ip': client_state.client_ip,
+                'app': client_state.app,
+                'in_bytes_per_s': in_bytes,
+                'in_messages_per_s': in_messages,
+                'out_bytes_per_s': out_bytes,
+                'out_messages_per_s': out_messages,
+            }
+            if client_state.timeline is not None:
+                connections[client_id].update(client_state.timeline.stats())
+        throttled = {
+            'ingest': {app: bucket.throttled for app, bucket in self.ingestBuckets.items()},
+            'egress': {app: bucket.throttled for app, bucket in self.egressBuckets.items()},
+        }
+        return {'connections': connections, 'throttled_seconds': throttled}
+
+    def reclaimMemory(self, nbytes):
+        # The memory budget ran out: GOP caches are the one thing we can drop without hurting a connection
+        freed = 0
+        for stream in sorted(self.registry.streams.values(), key=lambda stream: stream.gop.size, reverse=True):
+            if freed >= nbytes or stream.gop.size == 0:
+                break
+            freed += stream.gop.size
+            stream.gop.clear()
+        if freed:
+            self.logger.warning("Memory budget exhausted, evicted %d bytes of GOP cache", freed)
+
+    def memoryUsage(self):
+        ''' Accounted memory of the server and of every connection in bytes, plus the buffer pool counters.'''
+        connections = {}
+        for client_id, client_state in self.client_states.items():
+            stream = self.registry.publishedBy(client_id)
+            connections[client_id] = {
+                'client_ip': client_state.client_ip,
+                budget.REASSEMBLY: client_state.demuxer.buffered,
+                budget.GOP_CACHE: stream.gop.size if stream is not None else 0,
+                budget.SEND_QUEUE: client_state.sendQueue.backlog if client_state.sendQueue is not None else 0,
+            }
+        usage = dict(self.memory.stats(), connections=connections)
+        if self.bufferPool is not None:
+            usage['buffer_pool'] = self.bufferPool.stats()
+        return usage
+
+    def sweepBuffers(self):
+        # Pool classes nobody asks for any more would otherwise keep their released buffers forever
+        self.bufferPool.sweep()
+        self.timers.call_later(POOL_SWEEP_INTERVAL, self.sweepBuffers)
+
+    def streamOwner(self, client_id):
+        # Directory entry of a stream published by client_id on this worker, with the Unix socket
+        # other workers pull it from
+        return {'worker': self.worker, 'pid': os.getpid(), 'client': client_id, 'unix': self.unix_path}
+
+    def publishedStream(self, client_id):
+        # The live stream client_id publishes, if any
+        return self.registry.publishedBy(client_id)
+
+    def subscribe(self, stream_path, kinds=('video', 'audio'), keyframes_only=False, max_fps=None, max_frames=streams.SUBSCRIPTION_FRAMES, deadline=None):
+        ''' Frames published on stream_path ('/app/stream'), for use with async for.
+
+        The subscription may be created before anything is published; if the
+        stream is live already it starts from the sequence headers and the GOP
+        cache. kinds selects 'video' and/or 'audio', keyframes_only skips inter
+        frames and max_fps samples video down by timestamp. The consumer gets
+        its own bounded buffer, so it never holds up ingest. Frames come with
+        their DTS and PTS; with a deadline in seconds, frames that are older
+        than that by the time the consumer gets to them are skipped. On an
+        edge a stream nobody publishes here is pulled from the origin.
+        '''
+        subscription = streams.Subscription(stream_path, kinds, keyframes_only, max_fps, max_frames, deadline)
+        self.watchDrain(subscription, stream_path)
+        subscription.closing = self.unsubscribe
+        self.subscriptions.setdefault(stream_path, weakref.WeakSet()).add(subscription)
+        stream = self.registry.get(stream_path)
+        if stream is None and self.predecessor is not None:
+            asyncio.ensure_future(self.pullFromPredecessor(stream_path))
+        elif stream is None and self.origin is not None:
+            asyncio.ensure_future(self.pullStream(stream_path))
+        if stream is not None:
+            gop = stream.gop
+            if gop.avcSequenceHeader is not None:
+                subscription.offer(streams.Frame('video', 0, gop.avcSequenceHeader, sequence_header=True))
+            if gop.aacSequenceHeader is not None:
+                subscription.offer(streams.Frame('audio', 0, gop.aacSequenceHeader, sequence_header=True))
+            for frame in gop.messages:
+                subscription.offer(frame)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        # A subscription was closed, forget its path with the last one
+        subscriptions = self.subscriptions.get(subscription.path)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.subscriptions[subscription.path]
+
+    def pathSubscriptions(self, path):
+        # Subscriptions of path; a path whose subscriptions were all collected without close() is forgotten
+        subscriptions = self.subscriptions.get(path)
+        if subscriptions is None:
+            return ()
+        if not subscriptions:
+            del self.subscriptions[path]
+        return subscriptions
+
+    def publishFrame(self, stream, frame):
+        # Hand a publisher audio/video Frame to the subscriptions of its stream path, they all share it
+        for subscription in self.pathSubscriptions(stream.path):
+            subscription.offer(frame)
+
+    def relayToPlayers(self, stream, msg_type_id, timestamp, payload, keyframe=False, sequence_header=False):
+        # Forward a publisher audio/video message to every player of its stream
+        if not stream.subscribers:
+            return
+
+        # Chunk the message once per (chunk size, chunk stream, message stream id) and share the bytes
+        cid = RTMP_CHANNEL_AUDIO if msg_type_id == RTMP_TYPE_AUDIO else RTMP_CHANNEL_VIDEO
+        if sequence_header:
+            kind = streams.CONTROL     # a decoder cannot do without them, never dropped
+        elif msg_type_id == RTMP_TYPE_AUDIO:
+            kind = streams.AUDIO_FRAME
+        else:
+            kind = streams.KEY_FRAME if keyframe else streams.INTER_FRAME
+        nbytes = len(payload)
+        client_states = self.client_states
+        ticks = self.timers.ticks
+        filtered = not sequence_header
+        # cid is the same for every player, so the chunk size and message stream id make the key
+        encoded = {}
+        for player_id in stream.subscribers:
+            player = client_states[player_id]
+            if filtered and player.playFilter is not None:
+                # keyframes-only players get no audio and no inter frames
+                if msg_type_id == RTMP_TYPE_AUDIO or not player.playFilter.accept(timestamp, keyframe):
+                    continue
+            key = (player.out_chunk_size, player.playStreamId)
+            buffers = encoded.get(key)
+            if buffers is None:
+                buffers = encoded[key] = chunk.encodeMessage(cid, timestamp, msg_type_id, player.playStreamId, payload, player.out_chunk_size)
+            player.sendQueue.put(kind, buffers, nbytes)
+            player.lastActivity = ticks
+
+    def queueMedia(self, client_id, kind, msg_type_id, timestamp, payload):
+        # Queue one audio/video message for a player on the media chunk streams
+        client_state = self.client_states[client_id]
+        cid = RTMP_CHANNEL_AUDIO if msg_type_id == RTMP_TYPE_AUDIO else RTMP_CHANNEL_VIDEO
+        buffers = chunk.encodeMessage(cid, timestamp, msg_type_id, client_state.playStreamId, payload, client_state.out_chunk_size)
+        client_state.sendQueue.put(kind, buffers, len(payload))
+
+    async def finishPlayers(self, stream):
+        # The publisher is gone, tell every player the stream ended
+        for player_id in list(stream.subscribers):
+            player = self.client_states.get(player_id)
+            if player is None:
+                continue
+            if player.sendQueue is not None:
+                # whatever is still queued belongs to a stream that no longer exists
+                player.sendQueue.close()
+                player.sendQueue = None
+            if isinstance(player.upstream, relay.Push):
+                # the destination unpublishes when the connection goes
+                player.writer.close()
+                continue
+            try:
+                await self.send_stream_eof(player_id, player.playStreamId)
+                await self.sendStatusMessage(player_id, player.playStreamId, "status", "NetStream.Play.UnpublishNotify", f"{stream.stream_path} is now unpublished.")
+            except Exception as e:
+                self.logger.debug("Error on notifying player: %s", str(e))
+        stream.subscribers.clear()
+
+    async def pullStream(self, stream_path, source=None):
+        # Edge mode: get stream_path from the origin, one upstream connection however many players ask for it.
+        # source is (host, port) of another origin, or (Unix socket path, None) of the worker publishing it
+        upstream = self.upstreams.get(stream_path)
+        if upstream is None:
+            upstream = self.upstreams[stream_path] = relay.Upstream(stream_path, *(source or self.origin))
+            asyncio.ensure_future(self.runUpstream(upstream))
+        try:
+            return await asyncio.shield(upstream.ready)
+        except relay.UpstreamError as e:
+            self.logger.warning("Cannot pull %s from %s: %s", stream_path, upstream.address, str(e))
+            return None
+
+    async def pullFromPredecessor(self, stream_path):
+        # A stream still published on the process we took over from is pulled from it like from a sibling
+        # worker. Its drain socket goes away once it has drained, then we stop asking.
+        if not os.path.exists(self.predecessor):
+            self.predecessor = None
+            return None
+        return await self.pullStream(stream_path, (self.predecessor, None))
+
+    async def runUpstream(self, upstream):
+        # Connect to the origin and run the connection like any other, its media is published locally
+        client_state = ClientState()
+        client_state.app = upstream.app
+        client_state.client_ip = (upstream.host, upstream.port)
+        client_state.upstream = upstream
+        client_state.demuxer.memory = self.memory
+        client_state.demuxer.pool = self.bufferPool
+        client_state.demuxer.max_buffered = self.reassembly_limit
+        upstream.client_id = client_state.id
+        try:
+            client_state.reader, client_state.writer = await asyncio.wait_for(upstream.open(), relay.PULL_TIMEOUT)
+            await asyncio.wait_for(relay.clientHandshake(client_state.reader, client_state.writer), HANDSHAKE_TIMEOUT)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, relay.UpstreamError) as e:
+            upstream.fail(f"cannot connect: {e!r}")
+            del self.upstreams[upstream.path]
+            if client_state.writer is not None:
+                client_state.writer.close()
+            return
+        self.client_states[client_state.id] = client_state
+        self.logger.info("Pulling %s from %s", upstream.path, upstream.address)
+
+        setup = asyncio.ensure_future(self.playUpstream(client_state.id))
+        await self.process_messages(client_state.id)
+        setup.cancel()
+        upstream.fail("origin closed the connection")
+        del self.upstreams[upstream.path]
+        await self.disconnect(client_state.id)
+
+    async def playUpstream(self, client_id):
+        # connect, createStream and play as a client would, then publish what the origin sends
+        client_state = self.client_states[client_id]
+        upstream = client_state.upstream
+        try:
+            await self.set_chunk_size(client_id, client_state.out_chunk_size)
+            message, result = upstream.connect()
+            await self.writeMessage(client_id, message)
+            await asyncio.wait_for(result, relay.PULL_TIMEOUT)
+            message, result = upstream.createStream()
+            await self.writeMessage(client_id, message)
+            stream_id = int((await asyncio.wait_for(result, relay.PULL_TIMEOUT))['args'][0])
+
+            # Published before playing: media follows Play.Start right away and must find its stream
+            stream = streams.LiveStream(client_id, upstream.app, upstream.name, 'live', stream_id, self.gop_cache_size, self.memory)
+            if not self.registry.publish(stream):
+                raise relay.UpstreamError("published locally meanwhile")
+            for subscription in self.pathSubscriptions(upstream.path):
+                subscription.restart()
+            await self.writeMessage(client_id, upstream.play(stream_id))
+            await asyncio.wait_for(upstream.playing, relay.PULL_TIMEOUT)
+        except (relay.UpstreamError, asyncio.TimeoutError) as e:
+            upstream.fail(str(e) or "origin did not answer")
+            client_state.writer.close()
+            return
+        upstream.ready.set_result(stream)
+
+    async def runPush(self, stream, host, port):
+        # Keep stream pushed to host:port for as long as it is published, reconnecting after failures
+        while self.registry.get(stream.path) is stream:
+            push = relay.Push(stream.path, host, port)
+            client_state = ClientState()
+            client_state.app = push.app
+            client_state.client_ip = (host, port)
+            client_state.upstream = push
+            client_state.demuxer.memory = self.memory
+            client_state.demuxer.pool = self.bufferPool
+            client_state.demuxer.max_buffered = self.reassembly_limit
+            push.client_id = client_state.id
+            try:
+                client_state.reader, client_state.writer = await asyncio.wait_for(asyncio.open_connection(host, port), relay.PULL_TIMEOUT)
+                await asyncio.wait_for(relay.clientHandshake(client_state.reader, client_state.writer), HANDSHAKE_TIMEOUT)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, relay.UpstreamError) as e:
+                self.logger.warning("Cannot push %s to %s:%d: %r", stream.path, host, port, e)
+                if client_state.writer is not None:
+                    client_state.writer.close()
+            else:
+                self.client_states[client_state.id] = client_state
+                self.logger.info("Pushing %s to %s:%d", stream.path, host, port)
+                setup = asyncio.ensure_future(self.startPush(client_state.id, stream))
+                await self.process_messages(client_state.id)
+                setup.cancel()
+                push.fail("destination closed the connection")
+                await self.disconnect(client_state.id)
+            if self.registry.get(stream.path) is stream:
+                await asyncio.sleep(self.push_retry_delay)
+
+    async def startPush(self, client_id, stream):
+        # connect, createStream and publish as an encoder would, then relay the stream like to a player
+        client_state = self.client_states[client_id]
+        push = client_state.upstream
+        try:
+            await self.set_chunk_size(client_id, client_state.out_chunk_size)
+            message, result = push.connect()
+            await self.writeMessage(client_id, message)
+            await asyncio.wait_for(result, relay.PULL_TIMEOUT)
+            message, result = push.createStream()
+            await self.writeMessage(client_id, message)
+            client_state.playStreamId = int((await asyncio.wait_for(result, relay.PULL_TIMEOUT))['args'][0])
+            await self.writeMessage(client_id, push.publish(client_state.playStreamId))
+            await asyncio.wait_for(push.playing, relay.PULL_TIMEOUT)
+        except (relay.UpstreamError, asyncio.TimeoutError) as e:
+            self.logger.warning("Push of %s to %s:%d failed: %s", stream.path, push.host, push.port, str(e) or "destination did not answer")
+            push.fail(str(e) or "destination did not answer")
+            client_state.writer.close()
+            return
+        if not await self.attachPlayer(client_id, stream):
+            client_state.writer.close()
+
+    def releaseUpstream(self, stream):
+        # Close an edge's upstream connection once the last local player of its stream is gone
+        publisher = self.client_states.get(stream.client_id)
+        if publisher is None or publisher.upstream is None or stream.subscribers or self.pathSubscriptions(stream.path):
+            return
+        self.logger.info("No players left for %s, closing upstream", stream.path)
+        publisher.writer.close()
 
     def handle_chunk_size_message(self, client_id, payload):
         # Handle Chunk Size message
@@ -548,6 +1260,7 @@ class RTMPServer:
             raise DisconnectClientException()
         
         self.client_states[client_id].chunk_size = new_chunk_size
+        self.client_states[client_id].demuxer.chunk_size = new_chunk_size
         self.logger.debug("Updated chunk size: %d", self.client_states[client_id].chunk_size)
 
     def handle_window_acknowledgement_size(self, client_id, payload):
@@ -581,87 +1294,134 @@ class RTMPServer:
         elif invoke['cmd'] == 'play':
             self.logger.debug("Received play invoke")
             await self.handle_onPlay(client_id, invoke)
+        elif invoke['cmd'] in ('_result', '_error', 'onStatus') and self.client_states[client_id].upstream is not None:
+            # replies of the origin to an edge
+            if not self.client_states[client_id].upstream.reply(invoke):
+                raise DisconnectClientException()
         # Need to add and support other CMDs.
         else:
             self.logger.info("Unsupported invoke command %s!", invoke['cmd'])
     
     async def handle_onPlay(self, client_id, invoke):
         client_state = self.client_states[client_id]
-        if not client_state.app in LiveUsers:
-            self.logger.warning("Stream not exists to play!")
-            await self.sendStatusMessage(client_id, client_state.publishStreamId, "error", "NetStream.Play.BadName", "Stream not exists")
-            raise DisconnectClientException()
+        client_state.playStreamId = int(invoke['packet'].stream_id)
+        client_state.playStreamPath = streams.streamPath(client_state.app, invoke['args'][0] if invoke['args'] else '')
+        # stream?keyframes_only=1[&max_fps=N]: sequence headers and at most N keyframes per second, for thumbnails and analysis
+        client_state.playFilter = streams.playFilter(invoke['args'][0] if invoke['args'] else '')
+        stream = self.registry.get(client_state.playStreamPath)
+        if stream is None and self.predecessor is not None:
+            stream = await self.pullFromPredecessor(client_state.playStreamPath)
+        if stream is None:
+            owner = await self.directory.lookup(client_state.playStreamPath)
+            if owner is None and self.origin is not None:
+                stream = await self.pullStream(client_state.playStreamPath)
+                if stream is None:
+                    await self.sendStatusMessage(client_id, client_state.playStreamId, "error", "NetStream.Play.StreamNotFound", "Stream not found on origin")
+                    raise DisconnectClientException()
+            elif owner is not None:
+                # Published on another worker: pull it from there over that worker's Unix socket, then it
+                # is played here like a local stream, one connection however many players ask for it
+                if owner['pid'] != os.getpid() and owner.get('unix') is not None:
+                    stream = await self.pullStream(client_state.playStreamPath, (owner['unix'], None))
+                if stream is None:
+                    self.logger.warning("Cannot play %s from worker %d", client_state.playStreamPath, owner['worker'])
+                    await self.sendStatusMessage(client_id, client_state.playStreamId, "error", "NetStream.Play.StreamNotFound", f"Stream is published on worker {owner['worker']}")
+                    raise DisconnectClientException()
+            else:
+                self.logger.warning("Stream not exists to play!")
+                await self.sendStatusMessage(client_id, client_state.playStreamId, "error", "NetStream.Play.BadName", "Stream not exists")
+                raise DisconnectClientException()
         
-        publisher_id = LiveUsers[client_state.app]['client_id']
-        publisher_client_state = self.client_states[publisher_id]
+        self.logger.info("Play Request App: %s, Path: %s, playStreamPath: %s, StreamID: %d", client_state.app, stream.stream_path, client_state.playStreamPath, client_state.playStreamId)
+
+        await self.send_stream_begin(client_id, client_state.playStreamId)
+        await self.sendStatusMessage(client_id, client_state.playStreamId, "status", "NetStream.Play.Reset", f"Playing and resetting {stream.stream_path}.")
+        await self.sendStatusMessage(client_id, client_state.playStreamId, "status", "NetStream.Play.Start", f"Started playing {stream.stream_path}.")
+        await self.attachPlayer(client_id, stream, self.egressBuckets.get(client_state.app))
+
+    async def attachPlayer(self, client_id, stream, bucket=None):
+        # Send the stream's metadata, prime the send queue from the GOP cache and relay the live stream
+        # from here on, to a player or a push destination, on client_state.playStreamId
+        client_state = self.client_states[client_id]
+        publisher_client_state = self.client_states[stream.client_id]
         if publisher_client_state.metaDataPayload != None:
-            # Sending Publisher Meta Data to Player!
-            output = amf.AMFBytesIO()
-            amfWriter = amf.AMF0(output)
-            amfWriter.write('onMetaData')
-            amfWriter.write(publisher_client_state.metaData)
-            output.seek(0)
-            payload = output.read()
-            streamId = invoke['packet']['header']['stream_id']
-            packet_header = common.Header(RTMP_CHANNEL_DATA, 0, len(payload), RTMP_TYPE_DATA, streamId)
+            # Sending Publisher Meta Data to Player, encoded when the publisher sent it
+            payload = publisher_client_state.metaDataPayload
+            packet_header = common.Header(RTMP_CHANNEL_DATA, 0, len(payload), RTMP_TYPE_DATA, client_state.playStreamId)
             response = common.Message(packet_header, payload)
             await self.writeMessage(client_id, response)
+        if self.registry.get(stream.path) is not stream:
+            return False    # unpublished meanwhile
+
+        # Prime the player from the GOP cache so it can start decoding right away. Nothing
+        # awaits until it is subscribed, so no live message can slip in between.
+        client_state.sendQueue = streams.SendQueue(client_state.writer, self.send_queue_bytes, self.send_queue_messages, self.memory,
+                                                   client_state.outRate, bucket)
+        self.watchDrain(client_state.sendQueue, stream.path)
+        if stream.gop.aacSequenceHeader is not None:
+            self.queueMedia(client_id, streams.CONTROL, RTMP_TYPE_AUDIO, 0, stream.gop.aacSequenceHeader)
+        if stream.gop.avcSequenceHeader is not None:
+            self.queueMedia(client_id, streams.CONTROL, RTMP_TYPE_VIDEO, 0, stream.gop.avcSequenceHeader)
+        if client_state.playFilter is not None:
+            if stream.gop.messages and client_state.playFilter.accept(stream.gop.messages[0].timestamp, True):
+                # a GOP starts with its keyframe
+                frame = stream.gop.messages[0]
+                self.queueMedia(client_id, streams.KEY_FRAME, RTMP_TYPE_VIDEO, frame.timestamp, frame.payload)
+        else:
+            for frame in stream.gop.messages:
+                if frame.type == 'audio':
+                    self.queueMedia(client_id, streams.AUDIO_FRAME, RTMP_TYPE_AUDIO, frame.timestamp, frame.payload)
+                else:
+                    # the GOP's leading keyframe goes last if priming overflows
+                    kind = streams.KEY_FRAME if frame.keyframe else streams.INTER_FRAME
+                    self.queueMedia(client_id, kind, RTMP_TYPE_VIDEO, frame.timestamp, frame.payload)
+
+        self.registry.addPlayer(client_id, stream)
+        client_state.sendQueue.start()
+        return True
 
     async def handle_publish(self, client_id, invoke):
         client_state = self.client_states[client_id]
         client_state.stream_mode = 'live' if len(invoke['args']) < 2 else invoke['args'][1]  # live, record, append
         client_state.streamPath = invoke['args'][0]
-        client_state.publishStreamId = int(invoke['packet']['header']['stream_id'])
-        client_state.publishStreamPath = "/" + client_state.app + "/" + client_state.streamPath.split("?")[0]
+        client_state.publishStreamId = int(invoke['packet'].stream_id)
+        client_state.publishStreamPath = streams.streamPath(client_state.app, client_state.streamPath)
         if(client_state.streamPath == None or client_state.streamPath == ''):
             self.logger.warning("Stream key is empty!")
             await self.sendStatusMessage(client_id, client_state.publishStreamId, "error", "NetStream.publish.Unauthorized", "Authorization required.")
             raise DisconnectClientException()
         
         if client_state.stream_mode == 'live':
-            if LiveUsers.get(client_state.app) is not None:
+            if self.registry.publishedBy(client_id) is not None or self.registry.get(client_state.publishStreamPath) is not None or not await self.directory.claim(client_state.publishStreamPath, self.streamOwner(client_id)):
                 self.logger.warning("Stream already publishing!")
                 await self.sendStatusMessage(client_id, client_state.publishStreamId, "error", "NetStream.Publish.BadName", "Stream already publishing")
                 raise DisconnectClientException()
         
-            LiveUsers[client_state.app] = {
-                'client_id': client_id,
-                'stream_mode': client_state.stream_mode,
-                'stream_path': client_state.streamPath,
-                'publish_stream_id': client_state.publishStreamId,
-                'app': client_state.app,
-            }
+            self.registry.publish(streams.LiveStream(
+                client_id, client_state.app, client_state.streamPath,
+                client_state.stream_mode, client_state.publishStreamId, self.gop_cache_size, self.memory))
+            # timestamps start over with every publish
+            client_state.timeline = streams.Timeline()
+            for subscription in self.pathSubscriptions(client_state.publishStreamPath):
+                subscription.restart()
+            stream = self.registry.get(client_state.publishStreamPath)
+            for host, port in self.push:
+                asyncio.ensure_future(self.runPush(stream, host, port))
 
         self.logger.info("Publish Request Mode: %s, App: %s, Path: %s, publishStreamPath: %s, StreamID: %s", client_state.stream_mode, client_state.app, client_state.streamPath, client_state.publishStreamPath, str(client_state.publishStreamId))
         await self.sendStatusMessage(client_id, client_state.publishStreamId, "status", "NetStream.Publish.Start", f"{client_state.publishStreamPath} is now published.")
 
     async def sendStatusMessage(self, client_id, sid, level, code, description):
-        response = common.Command(
-        name='onStatus',
-        id=sid,
-        tm=self.relativeTime(client_id),
-        args=[
-            amf.Object(
-                level=level,
-                code=code,
-                description=description,
-                details=None)])
-        
-        message = response.toMessage()
+        payload = responses.status(level, code, description)
+        message = common.Message(common.Header(0, self.relativeTime(client_id), len(payload), RTMP_TYPE_INVOKE, sid), payload)
         self.logger.debug("Sending onStatus response!")
         await self.writeMessage(client_id, message)
         
     async def response_createStream(self, client_id, invoke):
         client_state = self.client_states[client_id]
         client_state.streams = client_state.streams + 1;
-        response = common.Command(
-            name='_result',
-            id=invoke['id'],
-            tm=self.relativeTime(client_id),
-            type=common.Message.RPC,
-            args=[client_state.streams])
-
-        message = response.toMessage()
+        payload = responses.CREATE_STREAM_RESULT.build(invoke['id'], client_state.streams)
+        message = common.Message(common.Header(0, self.relativeTime(client_id), len(payload), RTMP_TYPE_INVOKE), payload)
         self.logger.debug("Sending createStream response!")
         await self.writeMessage(client_id, message)
 
@@ -698,8 +1458,17 @@ class RTMPServer:
         # Perform asynchronous sending operation
         # self.logger.info("Sending data: %s", data)
         client_state.writer.write(data)
+        client_state.outRate.add(len(data), 1)
         await client_state.writer.drain()
+        client_state.lastActivity = self.timers.ticks
 
+    async def sendChunks(self, client_id, buffers):
+        client_state = self.client_states[client_id]
+        # Scatter-gather write of a chunked message, no concatenation on our side
+        client_state.writer.writelines(buffers)
+        client_state.outRate.add(sum(len(buffer) for buffer in buffers), 1)
+        await client_state.writer.drain()
+        client_state.lastActivity = self.timers.ticks
 
     async def send_window_ack(self, client_id, size):
         rtmp_buffer = bytes.fromhex("02000000000004050000000000000000")
@@ -715,6 +1484,18 @@ class RTMPServer:
         await self.send(client_id, rtmp_buffer)
         self.logger.debug("Send ACK: %s", size)
 
+    async def send_stream_begin(self, client_id, stream_id):
+        rtmp_buffer = bytearray.fromhex("020000000000060400000000000000000000")
+        rtmp_buffer[14:18] = stream_id.to_bytes(4, byteorder='big')
+        await self.send(client_id, rtmp_buffer)
+        self.logger.debug("Send Stream Begin: %s", stream_id)
+
+    async def send_stream_eof(self, client_id, stream_id):
+        rtmp_buffer = bytearray.fromhex("020000000000060400000000000100000000")
+        rtmp_buffer[14:18] = stream_id.to_bytes(4, byteorder='big')
+        await self.send(client_id, rtmp_buffer)
+        self.logger.debug("Send Stream EOF: %s", stream_id)
+
     async def set_peer_bandwidth(self, client_id, size, bandwidth_type):
         rtmp_buffer = bytes.fromhex("0200000000000506000000000000000000")
         rtmp_buffer = bytearray(rtmp_buffer)
@@ -741,76 +1522,44 @@ class RTMPServer:
         
     async def respond_connect(self, client_id, tid):
         client_state = self.client_states[client_id]
-        response = common.Command()
-        response.id, response.name, response.type = tid, '_result', common.Message.RPC
-
-        arg = amf.Object(
-            level='status',
-            code='NetConnection.Connect.Success',
-            description='Connection succeeded.',
-            fmsVer='MasterStream/8,2',
-            capabilities = 31,
-            objectEncoding = client_state.objectEncoding)
-        
-        response.setArg(arg)
-        message = response.toMessage()
+        payload = responses.connectResult(client_state.objectEncoding).build(tid)
+        message = common.Message(common.Header(0, 0, len(payload), RTMP_TYPE_INVOKE), payload)
         self.logger.debug("Sending connect response!")
         await self.writeMessage(client_id, message)
 
     async def writeMessage(self, client_id, message):
         client_state = self.client_states[client_id]
-        if message.streamId in client_state.lastWriteHeaders:
-            header = client_state.lastWriteHeaders[message.streamId]
-        else:
-            if client_state.nextChannelId <= PROTOCOL_CHANNEL_ID:
-                client_state.nextChannelId = PROTOCOL_CHANNEL_ID + 1
-            header, client_state.nextChannelId = common.Header(
-                client_state.nextChannelId), client_state.nextChannelId + 1
-            client_state.lastWriteHeaders[message.streamId] = header
         if message.type < message.AUDIO:
-            header = common.Header(PROTOCOL_CHANNEL_ID)
-        
-        # now figure out the header data bytes
-        if header.streamId != message.streamId or header.time == 0 or message.time <= header.time:
-            header.streamId, header.type, header.size, header.time, header.delta = message.streamId, message.type, message.size, message.time, message.time
-            control = common.Header.FULL
-        elif header.size != message.size or header.type != message.type:
-            header.type, header.size, header.time, header.delta = message.type, message.size, message.time, message.time - header.time
-            control = common.Header.MESSAGE
+            # protocol control messages always go out with a full header
+            header, separator = client_state.protocolWriteHeader.header(message.time, message.size, message.type, message.streamId, full=True)
         else:
-            header.time, header.delta = message.time, message.time - header.time
-            control = common.Header.TIME
-        
-        hdr = common.Header(
-            channel=header.channel,
-            time=header.delta if control in (
-                common.Header.MESSAGE,
-                common.Header.TIME) else header.time,
-            size=header.size,
-            type=header.type,
-            streamId=header.streamId)
-        assert message.size == len(message.data)
-        data = b''
-        while len(message.data) > 0:
-            data = data + hdr.toBytes(control)  # gather header bytes
-            count = min(client_state.out_chunk_size, len(message.data))
-            data = data + message.data[:count]
-            message.data = message.data[count:]
-            control = common.Header.SEPARATOR  # incomplete message continuation
+            out = client_state.lastWriteHeaders.get(message.streamId)
+            if out is None:
+                if client_state.nextChannelId <= PROTOCOL_CHANNEL_ID:
+                    client_state.nextChannelId = PROTOCOL_CHANNEL_ID + 1
+                while client_state.nextChannelId in MEDIA_CHANNELS:
+                    client_state.nextChannelId += 1
+                out, client_state.nextChannelId = chunk.OutChunkStream(
+                    client_state.nextChannelId), client_state.nextChannelId + 1
+                client_state.lastWriteHeaders[message.streamId] = out
+            # now figure out the header data bytes
+            header, separator = out.header(message.time, message.size, message.type, message.streamId)
+
+        buffers = chunk.chunkMessage(header, separator, message.data, client_state.out_chunk_size)
         try:
-            await self.send(client_id, data)
+            await self.sendChunks(client_id, buffers)
             self.logger.debug("Message sent!")
         except:
             self.logger.debug("Error on sending message!")
 
     async def handle_amf_data(self, client_id, rtmp_packet):
         client_state = self.client_states[client_id]
-        offset = 1 if rtmp_packet['header']['type'] == RTMP_TYPE_FLEX_MESSAGE else 0
-        payload = rtmp_packet['payload'][offset:rtmp_packet['header']['length']]
+        offset = 1 if rtmp_packet.type == RTMP_TYPE_FLEX_MESSAGE else 0
+        payload = rtmp_packet.payload[offset:rtmp_packet.length]
         amfReader = amf.AMF0(payload)
         inst = {}
-        inst['type'] = rtmp_packet['header']['type']
-        inst['time'] = rtmp_packet['header']['timestamp']
+        inst['type'] = rtmp_packet.type
+        inst['time'] = rtmp_packet.timestamp
         inst['packet'] = rtmp_packet
         inst['cmd'] = amfReader.read()  # first field is command name
         if inst['cmd'] == '@setDataFrame':
@@ -822,11 +1571,25 @@ class RTMPServer:
             inst['dataObj'] = amfReader.read()  # third is obj data
             if(inst['dataObj'] != None):
                     self.logger.debug("Command Data %s", inst['dataObj'])
+        elif inst['cmd'] == 'onMetaData':
+            # as sent to players, an edge gets it this way from its origin
+            inst['dataObj'] = amfReader.read()
+            payload = bytes(payload)
         else:
             self.logger.warning("Unsupported RTMP_TYPE_DATA cmd, CMD: %s", inst['cmd'])
+            return
         
-        client_state.metaDataPayload = payload
+        # players get onMetaData as is, encode it once here instead of for every one of them
+        client_state.metaDataPayload = payload if inst['cmd'] == 'onMetaData' else responses.metaData(inst['dataObj'])
         client_state.metaData = inst['dataObj']
+        stream = self.publishedStream(client_id)
+        if stream is not None:
+            # players and push destinations attached before the metadata came in, or before it changed
+            payload = client_state.metaDataPayload
+            for player_id in stream.subscribers:
+                player = self.client_states[player_id]
+                buffers = chunk.encodeMessage(RTMP_CHANNEL_DATA, 0, RTMP_TYPE_DATA, player.playStreamId, payload, player.out_chunk_size)
+                player.sendQueue.put(streams.CONTROL, buffers, len(payload))
         client_state.audioSampleRate = int(inst['dataObj']['audiosamplerate']);
         client_state.audioChannels = 2 if inst['dataObj']['stereo'] else 1
         client_state.videoWidth = int(inst['dataObj']['width']);
@@ -836,17 +1599,17 @@ class RTMPServer:
         #TODO: handle Meta Data!
 
     def parse_amf0_invoke_message(self, rtmp_packet):
-        offset = 1 if rtmp_packet['header']['type'] == RTMP_TYPE_FLEX_MESSAGE else 0
-        payload = rtmp_packet['payload'][offset:rtmp_packet['header']['length']]
+        offset = 1 if rtmp_packet.type == RTMP_TYPE_FLEX_MESSAGE else 0
+        payload = rtmp_packet.payload[offset:rtmp_packet.length]
         amfReader = amf.AMF0(payload)
         inst = {}
-        inst['type'] = rtmp_packet['header']['type']
-        inst['time'] = rtmp_packet['header']['timestamp']
+        inst['type'] = rtmp_packet.type
+        inst['time'] = rtmp_packet.timestamp
         inst['packet'] = rtmp_packet
         
         try:
             inst['cmd'] = amfReader.read()  # first field is command name
-            if rtmp_packet['header']['type'] == RTMP_TYPE_FLEX_MESSAGE or rtmp_packet['header']['type'] == RTMP_TYPE_INVOKE:
+            if rtmp_packet.type == RTMP_TYPE_FLEX_MESSAGE or rtmp_packet.type == RTMP_TYPE_INVOKE:
                 inst['id'] = amfReader.read()  # second field *may* be message id
                 inst['cmdData'] = amfReader.read()  # third is command data
                 if(inst['cmdData'] != None):
@@ -866,14 +1629,74 @@ class RTMPServer:
         return int(1000 * (time.time() - self.client_states[client_id]._time0))
 
     async def start_server(self):
-        server = await asyncio.start_server(
-            self.handle_client, self.host, self.port)
+        # Take the listening socket over from a running server if one serves handoffs on our path
+        inherited = None
+        if self.handoff_path is not None:
+            inherited = await asyncio.get_running_loop().run_in_executor(None, handoff.takeover, self.handoff_path)
+        if inherited is not None:
+            conn, sockets, self.predecessor = inherited
+            server = await asyncio.start_server(self.handle_client, sock=sockets[0], backlog=LISTEN_BACKLOG)
+        else:
+            server = await asyncio.start_server(
+                self.handle_client, self.host, self.port, reuse_port=self.reuse_port, backlog=LISTEN_BACKLOG)
+        self.server = server
+        self.timers.start()
+        if self.bufferPool is not None:
+            self.timers.call_later(POOL_SWEEP_INTERVAL, self.sweepBuffers)
+
+        if self.unix_path is not None:
+            if os.path.exists(self.unix_path):
+                os.unlink(self.unix_path)  # left over by a previous run, or a process we take over from
+            self.unixServer = await asyncio.start_unix_server(self.handle_client, self.unix_path, backlog=LISTEN_BACKLOG)
+            self.logger.info("RTMP server listening on %s", self.unix_path)
 
         addr = server.sockets[0].getsockname()
-        self.logger.info("RTMP server started on %s", addr)
+        if inherited is not None:
+            conn.sendall(b'ready')
+            conn.close()
+            self.logger.info("RTMP server took over %s from the previous process", addr)
+        else:
+            self.logger.info("RTMP server started on %s", addr)
+        if self.handoff_path is not None:
+            asyncio.ensure_future(self.serveHandoff())
 
-        async with server:
-            await server.serve_forever()
+        try:
+            async with server:
+                await self.stopped.wait()
+        finally:
+            if self.unixServer is not None:
+                self.unixServer.close()
+            if self.drainServer is not None:
+                self.drainServer.close()
+                os.unlink(self.drainPath)
+            if self.dispatcher is not None:
+                self.dispatcher.shutdown()
+
+    async def serveHandoff(self):
+        # Give the listening socket to the next process that asks, then drain and stop. While draining, our
+        # streams stay reachable for the next process on a Unix socket of our own.
+        self.drainPath = f'{self.handoff_path}.{uuid.uuid4().hex[:8]}'
+        self.drainServer = await asyncio.start_unix_server(self.handle_client, self.drainPath, backlog=LISTEN_BACKLOG)
+        while not await handoff.serve(self.handoff_path, self.server.sockets[:1], self.drainPath):
+            self.logger.warning("Handoff did not complete, still accepting")
+        self.server.close()
+        if self.unixServer is not None:
+            # the new process bound the Unix socket path anew, nobody can reach ours any more
+            self.unixServer.close()
+        self.logger.info("Listening socket handed over, draining %d connections", len(self.client_states))
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.drain_timeout
+        while self.client_states and loop.time() < deadline:
+            await asyncio.sleep(1)
+        if self.client_states:
+            self.logger.warning("Drain deadline passed, closing %d connections", len(self.client_states))
+            for client_state in list(self.client_states.values()):
+                client_state.writer.close()
+            deadline = loop.time() + 5
+            while self.client_states and loop.time() < deadline:
+                await asyncio.sleep(0.1)
+        self.stopped.set()
 
 # # Configure logging level and format
 # logging.basicConfig(level=LogLevel, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
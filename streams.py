@@ -0,0 +1,515 @@
+import asyncio
+import collections
+import time
+import budget
+import urllib.parse
+
+# Default memory cap of a stream's GOP cache in bytes
+GOP_CACHE_SIZE = 8 * 1024 * 1024
+
+# Default limits of a subscriber's send queue
+SEND_QUEUE_BYTES = 4 * 1024 * 1024
+SEND_QUEUE_MESSAGES = 1024
+
+# Default number of frames a subscription buffers for its consumer
+SUBSCRIPTION_FRAMES = 256
+
+# RTMP timestamps are 32-bit milliseconds, they wrap around after ~49.7 days
+TIMESTAMP_WRAP = 1 << 32
+
+# Kinds of queued messages, in the order they are given up when a queue overflows
+INTER_FRAME, AUDIO_FRAME, KEY_FRAME, CONTROL = 0, 1, 2, 3
+
+class GopCache(object):
+    ''' Sequence headers plus every audio/video message since the last keyframe.
+
+    Consumers that attach mid-stream are primed from here so they can start
+    decoding right away instead of waiting for the next IDR frame. If a GOP
+    grows past max_bytes the cache is emptied and stays empty until the next
+    keyframe; a max_bytes of 0 turns caching off. The same happens when the
+    server's memory budget refuses the bytes.
+    '''
+
+    def __init__(self, max_bytes=GOP_CACHE_SIZE, memory=None):
+        self.max_bytes = max_bytes
+        self.memory = memory
+        self.avcSequenceHeader = None
+        self.aacSequenceHeader = None
+        self.messages = []      # Frames since the last keyframe
+        self.size = 0
+
+    def add(self, frame):
+        if frame.keyframe:
+            self.clear()
+        elif not self.messages:
+            return  # a GOP always starts with its keyframe
+        payload = frame.payload
+        if self.size + len(payload) > self.max_bytes:
+            self.clear()
+            return
+        # The cache is what the server gives up first, so it never makes others give up memory
+        if self.memory is not None and not self.memory.reserve(budget.GOP_CACHE, len(payload), reclaim=False):
+            self.clear()
+            return
+        self.messages.append(frame)
+        self.size += len(payload)
+
+    def clear(self):
+        if self.memory is not None:
+            self.memory.release(budget.GOP_CACHE, self.size)
+        self.messages = []
+        self.size = 0
+
+class LiveStream(object):
+    ''' A stream being published and the players subscribed to it.'''
+
+    def __init__(self, client_id, app, stream_path, stream_mode, publish_stream_id, gop_cache_size=GOP_CACHE_SIZE, memory=None):
+        self.client_id = client_id              # publisher
+        self.app = app
+        self.stream_path = stream_path
+        self.path = streamPath(app, stream_path)    # registry key, /app/stream
+        self.stream_mode = stream_mode
+        self.publish_stream_id = publish_stream_id
+        self.subscribers = set()                # client ids of the players
+        self.gop = GopCache(gop_cache_size, memory)
+        self.pauses = 0                         # times the publisher was paused for slow consumers
+
+def streamPath(app, name):
+    # /app/stream, without the query string of the publish or play request
+    return "/" + app + "/" + name.split("?")[0]
+
+def playFilter(name):
+    # FrameFilter a player asks for in the query string of its play request, e.g. stream?keyframes_only=1&max_fps=0.2
+    query = urllib.parse.parse_qs(name.partition("?")[2])
+    if query.get('keyframes_only', ['0'])[-1].lower() not in ('1', 'true', 'yes'):
+        return None
+    try:
+        max_fps = float(query['max_fps'][-1]) if 'max_fps' in query else None
+    except ValueError:
+        max_fps = None
+    return FrameFilter(True, max_fps if max_fps and max_fps > 0 else None)
+
+class StreamRegistry(object):
+    ''' The live streams of a server, keyed by stream path.
+
+    Publisher and player client ids are indexed as well, so publishing,
+    playing and disconnecting never scan other streams.
+    '''
+
+    def __init__(self):
+        self.streams = {}       # path -> LiveStream
+        self.publishers = {}    # publisher client id -> LiveStream
+        self.players = {}       # player client id -> LiveStream
+
+    def __len__(self):
+        return len(self.streams)
+
+    def get(self, path):
+        return self.streams.get(path)
+
+    def publishedBy(self, client_id):
+        return self.publishers.get(client_id)
+
+    def playedBy(self, client_id):
+        return self.players.get(client_id)
+
+    def publish(self, stream):
+        # False if the path is taken already
+        if self.streams.setdefault(stream.path, stream) is not stream:
+            return False
+        self.publishers[stream.client_id] = stream
+        return True
+
+    def unpublish(self, client_id):
+        # Remove the stream client_id publishes and detach its players, returns the stream or None
+        stream = self.publishers.pop(client_id, None)
+        if stream is not None:
+            del self.streams[stream.path]
+            for player_id in stream.subscribers:
+                self.players.pop(player_id, None)
+        return stream
+
+    def addPlayer(self, client_id, stream):
+        stream.subscribers.add(client_id)
+        self.players[client_id] = stream
+
+    def removePlayer(self, client_id):
+        stream = self.players.pop(client_id, None)
+        if stream is not None:
+            stream.subscribers.discard(client_id)
+        return stream
+
+class Timeline(object):
+    ''' Media time of a published stream against the wall clock.
+
+    dts() unwraps the 32-bit message timestamps into decode timestamps that
+    keep counting past the wrap, and works out the ingest lag of the frame:
+    how much later than its media time it arrived, measured from the frame
+    that arrived earliest relative to its media time. A publisher sending in
+    real time stays near 0; network stalls and a slow encoder show up as lag.
+    '''
+    __slots__ = ('epoch', 'last', 'baseline', 'lag', 'maxLag', 'frames')
+
+    def __init__(self):
+        self.epoch = 0          # wraps so far, times TIMESTAMP_WRAP
+        self.last = None        # highest decode timestamp so far
+        self.baseline = None    # lowest (arrival - dts) seen, in ms
+        self.lag = 0            # ms, of the latest frame
+        self.maxLag = 0
+        self.frames = 0
+
+    def dts(self, timestamp, now=None):
+        now = time.monotonic() if now is None else now
+        dts = self.epoch + timestamp
+        if self.last is not None:
+            if dts - self.last < -TIMESTAMP_WRAP // 2:
+                self.epoch += TIMESTAMP_WRAP
+                dts += TIMESTAMP_WRAP
+            elif dts - self.last > TIMESTAMP_WRAP // 2 and self.epoch:
+                dts -= TIMESTAMP_WRAP   # late frame from before the wrap
+        if self.last is None or dts > self.last:
+            self.last = dts
+        offset = now * 1000 - dts
+        if self.baseline is None or offset < self.baseline:
+            self.baseline = offset
+        self.lag = offset - self.baseline
+        self.maxLag = max(self.maxLag, self.lag)
+        self.frames += 1
+        return dts
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'media_time_ms': self.last,
+            'ingest_lag_ms': self.lag,
+            'max_ingest_lag_ms': self.maxLag,
+        }
+
+class Frame(object):
+    ''' One audio or video message of a published stream, as handed to Subscription consumers.
+
+    timestamp is the RTMP message timestamp. dts is the same timestamp made
+    continuous across 32-bit wraparound, pts adds the composition time offset
+    of AVC/HEVC/AV1 video. received is when it came in (time.monotonic()) and
+    lag the stream's ingest lag at that point, so age() tells how late a
+    consumer is getting to it.
+    '''
+    __slots__ = ('type', 'timestamp', 'payload', 'keyframe', 'sequence_header', 'dts', 'pts', 'received', 'lag')
+
+    def __init__(self, type, timestamp, payload, keyframe=False, sequence_header=False, dts=None, pts=None, received=None, lag=0):
+        self.type = type                        # 'video' or 'audio'
+        self.timestamp = timestamp
+        # FLV tag body as received from the publisher. The GOP cache, every subscription and the players'
+        # send queues share the buffer, so consumers get a read-only view of it
+        self.payload = memoryview(payload).toreadonly()
+        self.keyframe = keyframe
+        self.sequence_header = sequence_header
+        self.dts = timestamp if dts is None else dts
+        self.pts = self.dts if pts is None else pts
+        self.received = time.monotonic() if received is None else received
+        self.lag = lag                          # ms
+
+    def age(self, now=None):
+        # ms between this frame's media time and now: its ingest lag plus the time it has been waiting since
+        now = time.monotonic() if now is None else now
+        return self.lag + (now - self.received) * 1000
+
+    def __repr__(self):
+        flags = ' keyframe' if self.keyframe else ''
+        flags += ' sequence header' if self.sequence_header else ''
+        return f"<Frame {self.type} dts={self.dts}ms pts={self.pts}ms {len(self.payload)} bytes{flags}>"
+
+class FrameFilter(object):
+    ''' The video frames a consumer asked for: keyframes only and/or at most max_fps.
+
+    Frames are sampled by timestamp, so the rate holds however fast they
+    arrive. Sequence headers are the caller's business, they always pass.
+    '''
+    __slots__ = ('keyframes_only', 'interval', 'nextVideoTime')
+
+    def __init__(self, keyframes_only=False, max_fps=None):
+        self.keyframes_only = keyframes_only
+        self.interval = 1000 / max_fps if max_fps else 0   # ms between sampled video frames
+        self.nextVideoTime = None
+
+    def accept(self, timestamp, keyframe):
+        if self.keyframes_only and not keyframe:
+            return False
+        if self.interval:
+            if self.nextVideoTime is not None and timestamp < self.nextVideoTime:
+                return False
+            if self.nextVideoTime is None or timestamp - self.nextVideoTime >= self.interval:
+                self.nextVideoTime = timestamp
+            self.nextVideoTime += self.interval
+        return True
+
+    def restart(self):
+        # Timestamps start over with a new publisher
+        self.nextVideoTime = None
+
+class Subscription(object):
+    ''' Async iterator over the frames of one stream path, see RTMPServer.subscribe().
+
+    Filtering by kind, keyframes_only and max_fps happens in offer(), before
+    anything is queued, so frames a consumer does not want cost nothing. The
+    buffer holds max_frames frames; when the consumer falls behind, the queued
+    frames are dropped and video resumes at the next keyframe. Sequence headers
+    are never dropped. A subscription outlives its publisher and picks up the
+    next stream published on the same path, until close() is called.
+
+    With a deadline (seconds), frames whose age() has passed it by the time
+    the consumer asks for them are skipped, video up to the next keyframe, so
+    a consumer that needs to stay live never works through a stale backlog.
+
+    If drained is set, it is called whenever the consumer takes a frame and
+    leaves lowWater bytes or fewer queued, for publisher backpressure. If
+    closing is set, close() calls it with the subscription.
+    '''
+
+    def __init__(self, path, kinds=('video', 'audio'), keyframes_only=False, max_fps=None, max_frames=SUBSCRIPTION_FRAMES, deadline=None):
+        self.path = path
+        self.kinds = frozenset(kinds)
+        self.filter = FrameFilter(keyframes_only, max_fps)
+        self.max_frames = max_frames
+        self.deadline = deadline * 1000 if deadline is not None else None   # ms
+        self.frames = collections.deque()
+        self.bytes = 0
+        self.waitingKeyframe = False
+        self.skippingStale = False      # a stale video frame was skipped, the rest of its GOP goes too
+        self.droppedFrames = 0
+        self.staleFrames = 0
+        self.closed = False
+        self.lowWater = 0
+        self.drained = None
+        self.closing = None
+        self._wakeup = asyncio.Event()
+
+    def offer(self, frame):
+        type, keyframe, sequence_header = frame.type, frame.keyframe, frame.sequence_header
+        if self.closed or type not in self.kinds:
+            return
+        if type == 'video' and not sequence_header:
+            if self.filter.keyframes_only and not keyframe:
+                return
+            if self.waitingKeyframe and not keyframe:
+                self.droppedFrames += 1
+                return
+            if not self.filter.accept(frame.dts, keyframe):
+                return
+
+        if len(self.frames) >= self.max_frames and not sequence_header:
+            self.overflow()
+            if type == 'video' and not keyframe:
+                self.droppedFrames += 1
+                return
+        if keyframe:
+            self.waitingKeyframe = False
+        self.frames.append(frame)
+        self.bytes += len(frame.payload)
+        self._wakeup.set()
+
+    def stale(self, frame, now):
+        # Whether to skip frame for being past the deadline
+        if self.deadline is None or frame.sequence_header:
+            return False
+        if frame.type == 'video':
+            if frame.keyframe:
+                self.skippingStale = False
+            elif self.skippingStale:
+                return True
+        if frame.age(now) <= self.deadline:
+            return False
+        if frame.type == 'video':
+            self.skippingStale = True
+        return True
+
+    def overflow(self):
+        # The consumer fell behind: keep the sequence headers, skip video to the next keyframe
+        kept = collections.deque(frame for frame in self.frames if frame.sequence_header)
+        self.droppedFrames += len(self.frames) - len(kept)
+        self.frames = kept
+        self.bytes = sum(len(frame.payload) for frame in kept)
+        self.waitingKeyframe = True
+
+    def restart(self):
+        # A new publisher took over the path, its timestamps start over
+        self.filter.restart()
+
+    def close(self, drop=False):
+        self.closed = True
+        self._wakeup.set()
+        if drop:
+            # the consumer stalled, what it has not taken yet is gone
+            self.droppedFrames += len(self.frames)
+            self.frames.clear()
+            self.bytes = 0
+        if self.closing is not None:
+            self.closing(self)
+        # what is left is read at the consumer's leisure, it no longer holds up the publisher
+        if self.drained is not None:
+            self.drained()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            while not self.frames:
+                if self.closed:
+                    raise StopAsyncIteration
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            frame = self.frames.popleft()
+            self.bytes -= len(frame.payload)
+            if self.drained is not None and self.bytes <= self.lowWater:
+                self.drained()
+            if not self.stale(frame, time.monotonic()):
+                return frame
+            self.staleFrames += 1
+
+class SendQueue(object):
+    ''' Bounded queue of chunked messages for one subscriber, drained by its own writer task.
+
+    A slow reader only ever fills its own queue. When the queue passes
+    max_bytes or max_messages, the queued inter frames are dropped and video is
+    skipped until the next keyframe, so the subscriber resumes on a clean GOP.
+    Audio and keyframes go next if that is not enough; CONTROL messages
+    (sequence headers, metadata) are never dropped. Running out of the
+    server's memory budget counts as overflowing.
+
+    If drained is set, it is called whenever a batch made it into the
+    transport, or the queue was closed, with lowWater bytes or fewer left.
+    '''
+
+    def __init__(self, writer, max_bytes=SEND_QUEUE_BYTES, max_messages=SEND_QUEUE_MESSAGES, memory=None, rate=None, bucket=None):
+        self.writer = writer
+        self.memory = memory
+        self.rate = rate        # ratelimit.RateCounter of the connection
+        self.bucket = bucket    # ratelimit.TokenBucket that paces the writes, if any
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.queue = collections.deque()   # (kind, nbytes, buffers)
+        self.bytes = 0
+        self.inflight = 0                  # bytes of the batch being drained into the transport
+        self.waitingKeyframe = False
+        self.sentMessages = 0
+        self.sentBytes = 0
+        self.droppedFrames = 0
+        self.droppedBytes = 0
+        self.lowWater = 0
+        self.drained = None
+        self.task = None
+        self._wakeup = asyncio.Event()
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self.queue.clear()
+        self._release(self.bytes + self.inflight)
+        self.bytes = 0
+        self.inflight = 0
+        if self.drained is not None:
+            self.drained()
+
+    @property
+    def backlog(self):
+        # Bytes queued or still on their way into the socket
+        return self.bytes + self.inflight
+
+    def put(self, kind, buffers, nbytes):
+        if kind == INTER_FRAME and self.waitingKeyframe:
+            self._dropped(nbytes)
+            return
+
+        queue = self.queue
+        if self.bytes + nbytes > self.max_bytes or len(queue) >= self.max_messages or (self.memory is not None and not self._reserve(kind, nbytes)):
+            self.overflow(nbytes)
+            queue = self.queue
+            if kind == INTER_FRAME or not self._reserve(kind, nbytes):
+                self._dropped(nbytes)
+                return
+        if kind == KEY_FRAME:
+            self.waitingKeyframe = False
+
+        if not queue:
+            # the writer task only waits once it found the queue empty
+            self._wakeup.set()
+        # buffers is the list shared by every player of the message, never copied per queue
+        queue.append((kind, nbytes, buffers))
+        self.bytes += nbytes
+
+    def overflow(self, nbytes):
+        # Make room for nbytes: inter frames first, then audio, then keyframes
+        self.waitingKeyframe = True
+        for kind in (INTER_FRAME, AUDIO_FRAME, KEY_FRAME):
+            kept = collections.deque()
+            for entry in self.queue:
+                if entry[0] == kind:
+                    self._dropped(entry[1])
+                    self._release(entry[1])
+                    self.bytes -= entry[1]
+                else:
+                    kept.append(entry)
+            self.queue = kept
+            if self.bytes + nbytes <= self.max_bytes and len(self.queue) < self.max_messages:
+                break
+
+    def stats(self):
+        return {
+            'queued_messages': len(self.queue),
+            'queued_bytes': self.bytes,
+            'sent_messages': self.sentMessages,
+            'sent_bytes': self.sentBytes,
+            'dropped_frames': self.droppedFrames,
+            'dropped_bytes': self.droppedBytes,
+        }
+
+    def _dropped(self, nbytes):
+        self.droppedFrames += 1
+        self.droppedBytes += nbytes
+
+    def _reserve(self, kind, nbytes):
+        # CONTROL messages are accounted but never refused
+        return self.memory is None or self.memory.reserve(budget.SEND_QUEUE, nbytes, force=kind == CONTROL)
+
+    def _release(self, nbytes):
+        if self.memory is not None:
+            self.memory.release(budget.SEND_QUEUE, nbytes)
+
+    async def run(self):
+        while True:
+            if not self.queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            # Take everything queued in one batch and let the transport coalesce it
+            batch, self.queue = self.queue, collections.deque()
+            self.inflight, self.bytes = self.bytes, 0
+            buffers = []
+            for entry in batch:
+                buffers.extend(entry[2])
+            try:
+                self.writer.writelines(buffers)
+                self.sentMessages += len(batch)
+                self.sentBytes += self.inflight
+                if self.rate is not None:
+                    self.rate.add(self.inflight, len(batch))
+                del batch, buffers
+                await self.writer.drain()
+            except ConnectionError:
+                # the connection handler notices the disconnect and cleans up, close() releases inflight
+                return
+            nbytes = self.inflight
+            self._release(nbytes)
+            self.inflight = 0
+            if self.drained is not None and self.bytes <= self.lowWater:
+                self.drained()
+            if self.bucket is not None:
+                delay = self.bucket.consume(nbytes)
+                if delay:
+                    # meanwhile the queue fills up and, past its limits, skips to the next keyframe
+                    await asyncio.sleep(delay)
@@ -0,0 +1,44 @@
+import asyncio
+import unittest
+import chunk
+import rtmp
+
+def tag(type, timestamp, body):
+    # FLV tag: 11 byte header, body, 4 byte back pointer (aggregate messages are type 22, RTMP_TYPE_METADATA here)
+    header = (bytes([type]) + len(body).to_bytes(3, 'big') + (timestamp & 0xffffff).to_bytes(3, 'big')
+              + bytes([timestamp >> 24]) + bytes(3))
+    return header + body + (11 + len(body)).to_bytes(4, 'big')
+
+def split(timestamp, payload):
+    # (type, timestamp, body) of every sub-message handed on by handle_aggregate_message
+    async def run():
+        server = rtmp.RTMPServer()
+        handled = []
+        async def record(client_id, packet):
+            handled.append((packet.type, packet.timestamp, bytes(packet.payload)))
+        server.handle_audio_data = server.handle_video_data = server.handle_amf_data = record
+        await server.handle_aggregate_message(None, chunk.RTMPPacket(0, 4, timestamp, len(payload), rtmp.RTMP_TYPE_METADATA, 1, payload))
+        return handled
+    return asyncio.run(run())
+
+class AggregateTest(unittest.TestCase):
+
+    def test_tags_rebased_on_message_timestamp(self):
+        payload = tag(9, 5000, b'\x17\x01v0') + tag(8, 5010, b'\xaf\x01a0') + tag(9, 5033, b'\x27\x01v1')
+        self.assertEqual(split(100, payload), [(9, 100, b'\x17\x01v0'), (8, 110, b'\xaf\x01a0'), (9, 133, b'\x27\x01v1')])
+
+    def test_extended_tag_timestamps(self):
+        payload = tag(9, 0x01fffff0, b'v0') + tag(9, 0x02000010, b'v1')
+        self.assertEqual(split(7, payload), [(9, 7, b'v0'), (9, 0x27, b'v1')])
+
+    def test_wraparound(self):
+        payload = tag(9, 0, b'v0') + tag(9, 0x20, b'v1')
+        self.assertEqual(split(0xfffffff0, payload), [(9, 0xfffffff0, b'v0'), (9, 0x10, b'v1')])
+
+    def test_empty_tags_and_truncated_tail(self):
+        payload = tag(9, 40, b'') + tag(9, 50, b'v1') + tag(9, 60, b'v2')[:-6]
+        # the empty first tag still sets the base timestamp
+        self.assertEqual(split(1000, payload), [(9, 1010, b'v1')])
+
+if __name__ == '__main__':
+    unittest.main()
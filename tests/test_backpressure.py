@@ -0,0 +1,119 @@
+import asyncio
+import threading
+import time
+import unittest
+import rtmp
+import streams
+
+class NullWriter(object):
+    def write(self, data):
+        pass
+
+    def writelines(self, data):
+        pass
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+FRAME = b'\x27\x01' + bytes(2998)
+
+def publish(server):
+    publisher = rtmp.ClientState()
+    server.client_states[publisher.id] = publisher
+    stream = streams.LiveStream(publisher.id, 'live', 'stream', 'live', 1, memory=server.memory)
+    server.registry.publish(stream)
+    return publisher, stream
+
+def player(server, stream):
+    # A player whose send queue is never drained
+    client_state = rtmp.ClientState()
+    client_state.writer = NullWriter()
+    client_state.playStreamId = 1
+    server.client_states[client_state.id] = client_state
+    client_state.sendQueue = streams.SendQueue(client_state.writer)
+    server.watchDrain(client_state.sendQueue, stream.path)
+    server.registry.addPlayer(client_state.id, stream)
+    return client_state
+
+class BackpressureTest(unittest.TestCase):
+
+    def run_async(self, coroutine):
+        return asyncio.run(coroutine)
+
+    def server(self, **kwargs):
+        return rtmp.RTMPServer(pause_bytes=10000, resume_bytes=5000, stall_timeout=0.2, **kwargs)
+
+    def test_stalled_subscription(self):
+        async def run():
+            server = self.server()
+            publisher, stream = publish(server)
+            subscription = server.subscribe('/live/stream')
+            for i in range(5):
+                server.publishFrame(stream, streams.Frame('video', i * 33, FRAME))
+            self.assertTrue(server.downstreamBytes(stream) > server.pause_bytes)
+            start = time.monotonic()
+            await asyncio.wait_for(server.waitForDownstream(publisher.id), 2)
+            return time.monotonic() - start, subscription
+        waited, subscription = self.run_async(run())
+        self.assertGreaterEqual(waited, 0.2)
+        self.assertTrue(subscription.closed)
+        self.assertEqual((len(subscription.frames), subscription.bytes, subscription.droppedFrames), (0, 0, 5))
+
+    def test_reading_subscription_resumes(self):
+        async def run():
+            server = self.server()
+            publisher, stream = publish(server)
+            subscription = server.subscribe('/live/stream')
+            for i in range(5):
+                server.publishFrame(stream, streams.Frame('video', i * 33, FRAME))
+            async def consume():
+                await asyncio.sleep(0.05)
+                async for frame in subscription:
+                    pass
+            consumer = asyncio.ensure_future(consume())
+            start = time.monotonic()
+            await asyncio.wait_for(server.waitForDownstream(publisher.id), 2)
+            waited = time.monotonic() - start
+            consumer.cancel()
+            return waited, subscription
+        waited, subscription = self.run_async(run())
+        self.assertLess(waited, 0.2)
+        self.assertFalse(subscription.closed)
+
+    def test_many_players_each_under_resume(self):
+        async def run():
+            server = self.server()
+            publisher, stream = publish(server)
+            players = [player(server, stream) for _ in range(4)]
+            # 4 x 3000 bytes queued, each player alone is under resume_bytes
+            server.relayToPlayers(stream, rtmp.RTMP_TYPE_VIDEO, 0, FRAME, keyframe=True)
+            await asyncio.wait_for(server.waitForDownstream(publisher.id), 2)
+            return server, stream, players
+        server, stream, players = self.run_async(run())
+        self.assertLessEqual(server.downstreamBytes(stream), server.resume_bytes)
+        self.assertEqual(len(stream.subscribers), 1)
+
+    def test_stuck_callback_lane(self):
+        release = threading.Event()
+        def callback(client_state, payload):
+            release.wait(5)
+        async def run():
+            server = self.server(callback_executor='thread')
+            publisher, stream = publish(server)
+            for i in range(5):
+                server.runCallback(publisher, callback, publisher, FRAME)
+            self.assertTrue(server.downstreamBytes(stream) > server.pause_bytes)
+            await asyncio.wait_for(server.waitForDownstream(publisher.id), 2)
+            return server, stream
+        try:
+            server, stream = self.run_async(run())
+        finally:
+            release.set()
+        self.assertEqual(server.dispatcher.backlog(stream.client_id), 0)
+        self.assertEqual(server.dispatcher.dropped, 4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import asyncio
+import threading
+import time
+import unittest
+import chunk
+import rtmp
+
+def videoMessage(timestamp, cts):
+    # An AVC inter frame with its composition time offset
+    payload = b'\x27\x01' + cts.to_bytes(3, 'big') + bytes(100)
+    return chunk.RTMPPacket(0, rtmp.RTMP_CHANNEL_VIDEO, timestamp, len(payload), rtmp.RTMP_TYPE_VIDEO, 1, memoryview(bytearray(payload)))
+
+class CallbackTest(unittest.TestCase):
+
+    def run_async(self, coroutine):
+        return asyncio.run(asyncio.wait_for(coroutine, 10))
+
+    def publish(self, executor):
+        seen = []
+        done = threading.Event()
+        def video(client_state, payload):
+            # slow enough that every message is handled before the first call runs
+            time.sleep(0.02)
+            seen.append((client_state.dts, client_state.pts, bytes(payload[2:5])))
+            if len(seen) == 5:
+                done.set()
+        async def run():
+            server = rtmp.RTMPServer(video=video, callback_executor=executor)
+            client_state = rtmp.ClientState()
+            server.client_states[client_state.id] = client_state
+            for i in range(5):
+                await server.handle_video_data(client_state.id, videoMessage(i * 33, 66))
+            while not done.is_set():
+                await asyncio.sleep(0.01)
+            if server.dispatcher is not None:
+                server.dispatcher.shutdown()
+            return client_state
+        client_state = self.run_async(run())
+        return seen, client_state
+
+    def test_thread_executor_sees_each_message(self):
+        seen, client_state = self.publish('thread')
+        self.assertEqual(seen, [(dts, dts + 66, b'\x00\x00\x42') for dts in (0, 33, 66, 99, 132)])
+        self.assertEqual((client_state.dts, client_state.pts), (132, 198))
+
+    def test_inline(self):
+        seen, client_state = self.publish(None)
+        self.assertEqual([dts for dts, pts, cts in seen], [0, 33, 66, 99, 132])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import asyncio
+import struct
+import unittest
+import budget
+import chunk
+import rtmp
+
+# Ways the same bytes are cut into reads: single bytes, splits inside headers, whole chunks, everything at once
+SPLITS = (1, 2, 3, 5, 7, 11, 64, 129, 1000, None)
+
+def chunkStream(fmt, cid, field, payload, type_id=9, stream_id=1, chunk_size=128):
+    ''' One message as an encoder writes it: a fmt 0/1/2/3 header, then fmt 3 continuation chunks.
+
+    field is the timestamp (fmt 0) or delta (fmt 1/2) of the header, None for
+    fmt 3. Past 0xfffffe it goes in an extended timestamp, which every
+    continuation chunk repeats.
+    '''
+    extended = field is not None and field >= 0xffffff
+    header = chunk.basicHeader(fmt, cid)
+    if fmt <= 2:
+        header += (0xffffff if extended else field).to_bytes(3, 'big')
+    if fmt <= 1:
+        header += len(payload).to_bytes(3, 'big') + bytes([type_id])
+    if fmt == 0:
+        header += struct.pack('<I', stream_id)
+    if extended:
+        header += struct.pack('>I', field)
+    out = header + payload[:chunk_size]
+    for offset in range(chunk_size, len(payload), chunk_size):
+        out += chunk.basicHeader(3, cid) + (struct.pack('>I', field) if extended else b'') + payload[offset:offset + chunk_size]
+    return out
+
+def payload(size, seed):
+    return bytes((seed + i) & 0xff for i in range(size))
+
+def demux(data, split, chunk_size=128):
+    # (cid, stream id, timestamp, type, payload) of every message in data, fed split bytes at a time
+    demuxer = chunk.ChunkDemuxer(chunk_size)
+    split = split or len(data)
+    packets = []
+    for offset in range(0, len(data), split):
+        packets.extend(demuxer.feed(data[offset:offset + split]))
+    return [(p.cid, p.stream_id, p.timestamp, p.type, bytes(p.payload)) for p in packets]
+
+def streamIngest(data, chunk_size=128):
+    # The same through the server's 'stream' ingest, which awaits every header field
+    async def run():
+        server = rtmp.RTMPServer(ingest='stream')
+        packets = []
+        async def handle(client_id, p):
+            packets.append((p.cid, p.stream_id, p.timestamp, p.type, bytes(p.payload)))
+        server.handle_rtmp_packet = handle
+        client_state = rtmp.ClientState()
+        client_state.chunk_size = client_state.demuxer.chunk_size = chunk_size
+        client_state.reader = asyncio.StreamReader()
+        client_state.reader.feed_data(data)
+        client_state.reader.feed_eof()
+        server.client_states[client_state.id] = client_state
+        try:
+            while True:
+                await server.get_chunk_data(client_state.id)
+        except rtmp.DisconnectClientException:
+            pass
+        return packets
+    return asyncio.run(run())
+
+class ChunkDemuxerTest(unittest.TestCase):
+
+    def check(self, data, expected):
+        for split in SPLITS:
+            with self.subTest(split=split):
+                self.assertEqual(demux(data, split), expected)
+        with self.subTest(ingest='stream'):
+            self.assertEqual(streamIngest(data), expected)
+
+    def test_header_formats(self):
+        video, audio = payload(300, 1), payload(100, 2)
+        data = (chunkStream(0, 4, 1000, video)
+                + chunkStream(1, 4, 33, audio, type_id=8)
+                + chunkStream(2, 4, 33, audio)
+                + chunkStream(3, 4, None, audio))
+        self.check(data, [
+            (4, 1, 1000, 9, video),
+            (4, 1, 1033, 8, audio),
+            (4, 1, 1066, 8, audio),
+            (4, 1, 1099, 8, audio),   # fmt 3 starting a message repeats the last delta
+        ])
+
+    def test_fmt3_after_fmt0_repeats_timestamp(self):
+        data = chunkStream(0, 5, 40, payload(10, 3)) + chunkStream(3, 5, None, payload(10, 4))
+        self.check(data, [(5, 1, 40, 9, payload(10, 3)), (5, 1, 80, 9, payload(10, 4))])
+
+    def test_extended_timestamp_on_continuations(self):
+        body = payload(400, 5)
+        data = chunkStream(0, 6, 0x1000000, body) + chunkStream(1, 6, 0x1000000, body)
+        self.check(data, [(6, 1, 0x1000000, 9, body), (6, 1, 0x2000000, 9, body)])
+
+    def test_chunk_stream_id_forms(self):
+        data = b''.join(chunkStream(0, cid, 0, payload(200, cid & 0xff)) for cid in (2, 63, 64, 319, 320, 65599))
+        self.check(data, [(cid, 1, 0, 9, payload(200, cid & 0xff)) for cid in (2, 63, 64, 319, 320, 65599)])
+
+    def test_message_stream_id_little_endian(self):
+        data = chunkStream(0, 4, 0, payload(20, 6), stream_id=0x01020304) + chunkStream(0, 4, 0, payload(20, 7), stream_id=1)
+        self.check(data, [(4, 0x01020304, 0, 9, payload(20, 6)), (4, 1, 0, 9, payload(20, 7))])
+
+    def test_timestamp_wraparound(self):
+        body = payload(50, 8)
+        data = chunkStream(0, 4, 0xfffffff0, body) + chunkStream(1, 4, 0x20, body) + chunkStream(3, 4, None, body)
+        self.check(data, [(4, 1, 0xfffffff0, 9, body), (4, 1, 0x10, 9, body), (4, 1, 0x30, 9, body)])
+
+    def test_interleaved_chunk_streams(self):
+        # chunks of two messages interleaved on different chunk streams
+        video, audio = payload(256, 9), payload(256, 10)
+        a = chunkStream(0, 6, 100, video)
+        b = chunkStream(0, 4, 90, audio, type_id=8)
+        # each is header + 128 bytes, then a 1 byte fmt 3 header + 128 bytes
+        data = a[:12 + 128] + b[:12 + 128] + a[12 + 128:] + b[12 + 128:]
+        self.check(data, [(6, 1, 100, 9, video), (4, 1, 90, 8, audio)])
+
+    def test_set_chunk_size_applies_to_next_chunk(self):
+        body = payload(1000, 11)
+        data = chunkStream(0, 2, 0, struct.pack('>I', 4096), type_id=1, stream_id=0) + chunkStream(0, 4, 0, body, chunk_size=4096)
+        for split in SPLITS:
+            with self.subTest(split=split):
+                demuxer = chunk.ChunkDemuxer(128)
+                packets = []
+                split_size = split or len(data)
+                for offset in range(0, len(data), split_size):
+                    for p in demuxer.feed(data[offset:offset + split_size]):
+                        if p.type == 1:
+                            demuxer.chunk_size = int.from_bytes(p.payload, 'big')
+                        packets.append((p.type, bytes(p.payload)))
+                self.assertEqual(packets, [(1, struct.pack('>I', 4096)), (9, body)])
+
+    def test_chunk_stream_limit(self):
+        cids = range(2, 2 + chunk.MAX_CHUNK_STREAMS)
+        data = b''.join(chunkStream(0, cid, 0, payload(10, cid)) for cid in cids)
+        self.assertEqual(len(demux(data, None)), chunk.MAX_CHUNK_STREAMS)
+        demuxer = chunk.ChunkDemuxer()
+        list(demuxer.feed(data))
+        with self.assertRaises(budget.BudgetExceeded):
+            list(demuxer.feed(chunkStream(0, 65599, 0, payload(10, 0))))
+
+if __name__ == '__main__':
+    unittest.main()
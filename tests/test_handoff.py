@@ -0,0 +1,69 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+import rtmp
+import streams
+
+class NullWriter(object):
+    def close(self):
+        pass
+
+class HandoffTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def run_async(self, coroutine):
+        return asyncio.run(asyncio.wait_for(coroutine, 10))
+
+    def test_streams_of_the_old_process_play_during_the_drain(self):
+        path = os.path.join(self.tmp, 'handoff.sock')
+        async def run():
+            old = rtmp.RTMPServer(host='127.0.0.1', port=0, handoff_path=path, drain_timeout=1)
+            old_task = asyncio.ensure_future(old.start_server())
+            while not os.path.exists(path):
+                await asyncio.sleep(0.01)
+            address = old.server.sockets[0].getsockname()
+
+            # a stream published on the old process
+            publisher = rtmp.ClientState()
+            publisher.writer = NullWriter()
+            old.client_states[publisher.id] = publisher
+            stream = streams.LiveStream(publisher.id, 'live', 'stream', 'live', 1)
+            old.registry.publish(stream)
+            stream.gop.add(streams.Frame('video', 0, b'\x17\x01' + bytes(100), keyframe=True))
+            stream.gop.add(streams.Frame('video', 33, b'\x27\x01' + bytes(100)))
+
+            new = rtmp.RTMPServer(host='127.0.0.1', port=0, handoff_path=path)
+            new_task = asyncio.ensure_future(new.start_server())
+            while new.server is None:
+                await asyncio.sleep(0.01)
+            self.assertEqual(new.server.sockets[0].getsockname(), address)
+            self.assertIsNotNone(new.predecessor)
+
+            subscription = new.subscribe('/live/stream')
+            frames = []
+            async for frame in subscription:
+                frames.append((frame.type, frame.timestamp, frame.keyframe, frame.sequence_header))
+                if len(frames) == 2:
+                    break
+            missing = await new.pullFromPredecessor('/live/missing')
+
+            # the publisher of the old process leaves, which then has drained and stops
+            old.registry.unpublish(publisher.id)
+            await old.finishPlayers(stream)
+            del old.client_states[publisher.id]
+            await asyncio.wait_for(old_task, 5)
+            new.stopped.set()
+            await new_task
+            return frames, missing, os.listdir(self.tmp)
+        frames, missing, left = self.run_async(run())
+        self.assertEqual(frames, [('video', 0, True, False), ('video', 33, False, False)])
+        self.assertIsNone(missing)
+        self.assertEqual(left, ['handoff.sock'])
+
+if __name__ == '__main__':
+    unittest.main()
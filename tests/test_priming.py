@@ -0,0 +1,119 @@
+import asyncio
+import unittest
+import rtmp
+import streams
+
+class NullWriter(object):
+    def write(self, data):
+        pass
+
+    def writelines(self, data):
+        pass
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+AVC_HEADER = b'\x17\x00' + bytes(10)
+AAC_HEADER = b'\xaf\x00\x12\x10'
+
+def publish(server):
+    # A stream with sequence headers and a GOP cache of keyframe, inter, audio, inter
+    publisher = rtmp.ClientState()
+    server.client_states[publisher.id] = publisher
+    stream = streams.LiveStream(publisher.id, 'live', 'stream', 'live', 1, memory=server.memory)
+    server.registry.publish(stream)
+    stream.gop.avcSequenceHeader = AVC_HEADER
+    stream.gop.aacSequenceHeader = AAC_HEADER
+    stream.gop.add(streams.Frame('video', 0, b'\x17\x01' + bytes(3000), keyframe=True))
+    stream.gop.add(streams.Frame('video', 33, b'\x27\x01' + bytes(3000)))
+    stream.gop.add(streams.Frame('audio', 40, b'\xaf\x01' + bytes(300)))
+    stream.gop.add(streams.Frame('video', 66, b'\x27\x01' + bytes(3000)))
+    return stream
+
+def player(server, name='stream'):
+    client_state = rtmp.ClientState()
+    client_state.writer = NullWriter()
+    client_state.playStreamId = 1
+    client_state.playFilter = streams.playFilter(name)
+    server.client_states[client_state.id] = client_state
+    return client_state
+
+def queued(client_state):
+    # Kinds of the messages a player's send queue holds, before its writer task ran
+    kinds = [kind for kind, nbytes, buffers in client_state.sendQueue.queue]
+    client_state.sendQueue.close()
+    return kinds
+
+class PrimingTest(unittest.TestCase):
+
+    def run_async(self, coroutine):
+        return asyncio.run(coroutine)
+
+    def test_order_and_kinds(self):
+        async def run():
+            server = rtmp.RTMPServer()
+            stream = publish(server)
+            late = player(server)
+            self.assertTrue(await server.attachPlayer(late.id, stream))
+            return queued(late)
+        self.assertEqual(self.run_async(run()), [
+            streams.CONTROL, streams.CONTROL, streams.KEY_FRAME, streams.INTER_FRAME, streams.AUDIO_FRAME, streams.INTER_FRAME])
+
+    def test_overflow_keeps_headers_and_keyframe(self):
+        async def run():
+            server = rtmp.RTMPServer(send_queue_bytes=7000)
+            stream = publish(server)
+            late = player(server)
+            await server.attachPlayer(late.id, stream)
+            return queued(late)
+        kinds = self.run_async(run())
+        self.assertEqual(kinds[:3], [streams.CONTROL, streams.CONTROL, streams.KEY_FRAME])
+        self.assertNotIn(streams.INTER_FRAME, kinds)
+
+    def test_keyframes_only_player(self):
+        async def run():
+            server = rtmp.RTMPServer()
+            stream = publish(server)
+            late = player(server, 'stream?keyframes_only=1')
+            await server.attachPlayer(late.id, stream)
+            return queued(late)
+        self.assertEqual(self.run_async(run()), [
+            streams.CONTROL, streams.CONTROL, streams.KEY_FRAME])
+
+    def test_live_sequence_headers_are_control(self):
+        async def run():
+            server = rtmp.RTMPServer(send_queue_bytes=5000)
+            stream = publish(server)
+            live = player(server)
+            await server.attachPlayer(live.id, stream)
+            live.sendQueue.queue.clear()
+            live.sendQueue.bytes = 0
+            live.sendQueue.waitingKeyframe = True
+            # a new AVC sequence header must not end the wait for a keyframe, nor be dropped
+            server.relayToPlayers(stream, rtmp.RTMP_TYPE_VIDEO, 100, AVC_HEADER, keyframe=True, sequence_header=True)
+            server.relayToPlayers(stream, rtmp.RTMP_TYPE_VIDEO, 133, b'\x27\x01' + bytes(100))
+            server.relayToPlayers(stream, rtmp.RTMP_TYPE_AUDIO, 140, AAC_HEADER, sequence_header=True)
+            return queued(live)
+        self.assertEqual(self.run_async(run()), [streams.CONTROL, streams.CONTROL])
+
+    def test_subscription_priming_order(self):
+        async def run():
+            server = rtmp.RTMPServer()
+            publish(server)
+            subscription = server.subscribe('/live/stream')
+            subscription.close()
+            return [(frame.type, frame.timestamp, frame.keyframe, frame.sequence_header) async for frame in subscription]
+        self.assertEqual(self.run_async(run()), [
+            ('video', 0, False, True),
+            ('audio', 0, False, True),
+            ('video', 0, True, False),
+            ('video', 33, False, False),
+            ('audio', 40, False, False),
+            ('video', 66, False, False),
+        ])
+
+if __name__ == '__main__':
+    unittest.main()
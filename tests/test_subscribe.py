@@ -0,0 +1,46 @@
+import asyncio
+import gc
+import unittest
+import rtmp
+import streams
+
+def publish(server):
+    publisher = rtmp.ClientState()
+    server.client_states[publisher.id] = publisher
+    stream = streams.LiveStream(publisher.id, 'live', 'stream', 'live', 1, memory=server.memory)
+    server.registry.publish(stream)
+    return stream
+
+class SubscriptionsTest(unittest.TestCase):
+
+    def run_async(self, coroutine):
+        return asyncio.run(coroutine)
+
+    def test_close_forgets_the_path(self):
+        async def run():
+            server = rtmp.RTMPServer()
+            first = server.subscribe('/live/stream')
+            second = server.subscribe('/live/stream')
+            other = server.subscribe('/live/other')
+            first.close()
+            self.assertEqual(set(server.subscriptions), {'/live/stream', '/live/other'})
+            second.close()
+            second.close()
+            other.close()
+            return server
+        self.assertEqual(self.run_async(run()).subscriptions, {})
+
+    def test_collected_subscriptions_are_forgotten(self):
+        async def run():
+            server = rtmp.RTMPServer()
+            stream = publish(server)
+            server.subscribe('/live/stream')
+            server.subscribe('/live/gone')
+            gc.collect()
+            server.publishFrame(stream, streams.Frame('video', 0, b'\x17\x01', keyframe=True))
+            self.assertEqual(server.downstreamBytes(streams.LiveStream(0, 'live', 'gone', 'live', 1)), 0)
+            return server
+        self.assertEqual(self.run_async(run()).subscriptions, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import asyncio
+
+class Timer(object):
+    ''' A timeout scheduled on a TimerWheel. Cancelling is O(1).'''
+    __slots__ = ('wheel', 'slot', 'rounds', 'callback', 'args')
+
+    def __init__(self, wheel, slot, rounds, callback, args):
+        self.wheel = wheel
+        self.slot = slot
+        self.rounds = rounds
+        self.callback = callback
+        self.args = args
+
+    def cancel(self):
+        if self.slot is not None:
+            self.wheel.slots[self.slot].discard(self)
+            self.slot = None
+
+    @property
+    def cancelled(self):
+        return self.slot is None
+
+class TimerWheel(object):
+    ''' Hashed timer wheel with a fixed tick resolution.
+
+    All timers of a server share one loop.call_later() handle that advances the
+    wheel once per tick, so the number of event loop timer handles stays at one
+    no matter how many connections are open. Scheduling and cancelling a timer
+    are O(1); timers further away than one revolution wait out extra rounds.
+    '''
+
+    def __init__(self, tick=1.0, size=512):
+        self.tick = tick
+        self.slots = [set() for _ in range(size)]
+        self.ticks = 0          # ticks elapsed since start, a cheap coarse clock
+        self._handle = None
+        self._loop = None
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._deadline = self._loop.time()
+        self._schedule()
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def call_later(self, delay, callback, *args):
+        ''' Run callback(*args) after delay seconds, rounded up to the next tick.'''
+        ticks = max(1, -int(-delay // self.tick))
+        size = len(self.slots)
+        slot = (self.ticks + ticks) % size
+        timer = Timer(self, slot, (ticks - 1) // size, callback, args)
+        self.slots[slot].add(timer)
+        return timer
+
+    def _schedule(self):
+        self._deadline += self.tick
+        self._handle = self._loop.call_at(self._deadline, self._advance)
+
+    def _advance(self):
+        self.ticks += 1
+        slot = self.ticks % len(self.slots)
+        due = []
+        for timer in self.slots[slot]:
+            if timer.rounds:
+                timer.rounds -= 1
+            else:
+                due.append(timer)
+        for timer in due:
+            if timer.slot == slot:
+                timer.cancel()
+                try:
+                    timer.callback(*timer.args)
+                except Exception as e:
+                    self._loop.call_exception_handler({'message': 'Timer callback failed', 'exception': e})
+        self._schedule()
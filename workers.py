@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import directory
+import rtmp
+
+logger = logging.getLogger('Workers')
+
+def serve(workers, main=None, **server_args):
+    ''' Run `workers` RTMPServer processes that all accept on the same port.
+
+    Every worker binds host:port with SO_REUSEPORT and the kernel spreads the
+    incoming connections over them, so chunk parsing of different publishers
+    runs on different cores. The parent process only hosts the stream directory
+    that the workers use to agree on who publishes which stream. Every worker
+    also listens on a Unix socket of its own, named in the directory entries of
+    the streams it publishes; a player that lands on another worker gets the
+    stream pulled from the owner over that socket.
+
+    main(server) is the coroutine each worker runs, by default just
+    server.start_server(); use it to start per-worker subscription consumers.
+    '''
+    path = os.path.join(tempfile.mkdtemp(prefix='rtmp-'), 'directory.sock')
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen()
+
+    # Fork before the parent starts its event loop, the children must not inherit a running one
+    context = multiprocessing.get_context('fork')
+    processes = []
+    for index in range(workers):
+        process = context.Process(target=_worker, args=(index, path, listener, main, server_args), name=f'rtmp-worker-{index}')
+        process.start()
+        processes.append(process)
+        logger.info("Started worker %d, pid %d", index, process.pid)
+
+    try:
+        asyncio.run(_supervise(listener, processes))
+    finally:
+        # the directory socket and the workers' own
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+async def _supervise(listener, processes):
+    directory_server = directory.DirectoryServer(listener.getsockname())
+    await directory_server.start(listener)
+
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    running = set(processes)
+    def exited(process):
+        loop.remove_reader(process.sentinel)
+        running.discard(process)
+        process.join()
+        logger.warning("Worker %s exited with code %s", process.name, process.exitcode)
+        if not running:
+            stopping.set()
+    for process in processes:
+        loop.add_reader(process.sentinel, exited, process)
+
+    await stopping.wait()
+    for process in list(running):
+        loop.remove_reader(process.sentinel)
+        process.terminate()
+    for process in running:
+        process.join()
+    await directory_server.close()
+
+def _worker(index, path, listener, main, server_args):
+    listener.close()
+    # Ctrl-C reaches the whole process group, let the parent decide when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    unix_path = os.path.join(os.path.dirname(path), f'worker-{index}.sock')
+    server = rtmp.RTMPServer(stream_directory=directory.SharedStreamDirectory(path), worker=index, reuse_port=True,
+                             unix_path=unix_path, **server_args)
+    asyncio.run(main(server) if main is not None else server.start_server())